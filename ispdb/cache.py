@@ -0,0 +1,189 @@
+"""
+This file contains a two tier cache backend: a small least recently used
+cache in each process, in front of a cache shared by every process (file
+based or memcached). Configure it in settings.CACHES with
+
+    'default': {
+        'BACKEND': 'ispdb.cache.TwoTierCache',
+        'LOCATION': 'ispdb',
+        'OPTIONS': {
+            'SHARED': 'shared',     # the alias of the shared cache
+            'MAX_ENTRIES': 500,     # entries kept in each process
+            'LOCAL_TIMEOUT': 10,    # seconds entries are kept in a process
+        },
+    },
+
+Deleting through the backend empties both tiers of the process doing it.
+Clearing it starts a new generation of keys instead of emptying the shared
+cache, so the entries of other users of the shared cache are kept; the old
+entries are left to expire. The other processes may keep serving their local
+copy, or using the old generation, for up to LOCAL_TIMEOUT seconds.
+"""
+
+import cPickle as pickle
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.base import BaseCache
+
+# The local tiers, by LOCATION, so every instance of the backend in a process
+# shares the same one.
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+# Seconds the current generation of keys is kept in the shared cache.
+GENERATION_TIMEOUT = 30 * 24 * 3600
+
+
+def _new_generation():
+    return uuid.uuid4().hex[:8]
+
+
+def open_cache(alias):
+    """
+    Return get_cache(alias). Opening a file based cache fails when another
+    thread creates its directory at the same time, so try again if the
+    directory exists after the failure.
+    """
+    try:
+        return get_cache(alias)
+    except EnvironmentError:
+        location = settings.CACHES.get(alias, {}).get('LOCATION')
+        if not (location and os.path.isdir(location)):
+            raise
+        return get_cache(alias)
+
+
+class LocalTier(object):
+    """
+    A thread safe least recently used store of pickled values.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # The (expiry, value) of the generation of keys in use, see
+        # TwoTierCache.clear().
+        self.generation = (0, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return None
+            # Put it back as the most recently used.
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TwoTierCache(BaseCache):
+
+    def __init__(self, name, params):
+        BaseCache.__init__(self, params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = options.get('SHARED', 'shared')
+        self._local_timeout = int(options.get('LOCAL_TIMEOUT', 10))
+        self._shared_cache = None
+        with _tiers_lock:
+            if name not in _tiers:
+                _tiers[name] = LocalTier(self._max_entries)
+            self.local = _tiers[name]
+        # The backends sharing the shared cache and key prefix, in every
+        # process, share the generation.
+        self._generation_key = '%s:generation' % self.key_prefix
+
+    @property
+    def shared(self):
+        # Don't look the shared cache up before it is used, it may be
+        # configured after this one.
+        if self._shared_cache is None:
+            self._shared_cache = open_cache(self._shared_alias)
+        return self._shared_cache
+
+    def _generation(self):
+        expiry, generation = self.local.generation
+        if expiry <= time.time():
+            generation = self.shared.get(self._generation_key)
+            if generation is None:
+                self.shared.add(self._generation_key, _new_generation(),
+                                GENERATION_TIMEOUT)
+                generation = (self.shared.get(self._generation_key) or
+                              _new_generation())
+            self.local.generation = (time.time() + self._local_timeout,
+                                     generation)
+        return generation
+
+    def make_key(self, key, version=None):
+        key = super(TwoTierCache, self).make_key(key, version=version)
+        return '%s:%s' % (self._generation(), key)
+
+    def _local_set(self, key, value, timeout):
+        self.local.set(key, value, min(timeout, self._local_timeout))
+
+    def add(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        if timeout is None:
+            timeout = self.default_timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if not self.shared.add(key, value, timeout):
+            return False
+        self._local_set(key, value, timeout)
+        return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is None:
+                return default
+            self._local_set(key, value, self._local_timeout)
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        if timeout is None:
+            timeout = self.default_timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.shared.set(key, value, timeout)
+        self._local_set(key, value, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        generation = _new_generation()
+        self.shared.set(self._generation_key, generation, GENERATION_TIMEOUT)
+        self.local.generation = (time.time() + self._local_timeout,
+                                 generation)
@@ -0,0 +1,172 @@
+"""
+This file contains the bulk export of the approved configurations as a single
+archive. The archive holds one file per format version and domain, laid out
+like the output of tools/convert.py -d:
+
+    1.0/example.com
+    1.1/example.com
+
+Archives built with a "since" time only hold the documents which changed after
+that time, plus a "removed" file listing the domains which are not served
+anymore, so mirrors can be kept in sync cheaply.
+"""
+
+import calendar
+import datetime
+import tarfile
+import zipfile
+from StringIO import StringIO
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ispdb.config import serializers
+from ispdb.config.models import (Config, ConfigSnapshot, Domain,
+    RemovedDomain)
+
+FORMATS = {
+    "tgz": "application/x-gzip",
+    "zip": "application/zip",
+}
+
+
+class _Buffer(object):
+    """
+    A write-only file object whose contents are handed out in chunks, so the
+    archive can be streamed while it is being written.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+
+    def tell(self):
+        return self._size
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = ''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parse_since(value):
+    """
+    Parse a "since" time given either as seconds since the epoch or as an
+    ISO 8601 date and time (UTC unless it says otherwise).
+    """
+    try:
+        return datetime.datetime.fromtimestamp(float(value), timezone.utc)
+    except (ValueError, OverflowError):
+        pass
+    since = parse_datetime(value)
+    if since is None:
+        raise ValueError("Invalid time %s" % value)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.utc)
+    return since
+
+
+def _domains():
+    """
+    Return a dictionary with the domain names of every approved config.
+    """
+    domains = {}
+    rows = Domain.objects.filter(config__status='approved').values_list(
+            'config', 'name')
+    for config_id, name in rows:
+        domains.setdefault(config_id, []).append(name)
+    return domains
+
+
+def documents(since=None, versions=None):
+    """
+    Yield a (path, XML document, modification time) tuple for each domain of
+    every approved configuration, under each format version. If since is
+    given, only the documents which changed after it are returned.
+    """
+    if not versions:
+        versions = [version for version, _ in serializers.versions()]
+    domains = _domains()
+    snapshots = ConfigSnapshot.objects.filter(config__status='approved',
+            version__in=versions)
+    stored = set(snapshots.values_list('config', 'version'))
+    configs = Config.objects.filter(status='approved')
+    if since is not None:
+        snapshots = snapshots.filter(last_update_datetime__gt=since)
+        configs = configs.filter(last_update_datetime__gt=since)
+    rows = snapshots.order_by('config', 'version').values_list('config',
+            'version', 'xml', 'last_update_datetime')
+    for config_id, version, xml, last_update in rows.iterator():
+        xml = xml.encode('utf-8')
+        for name in domains.get(config_id, []):
+            yield ("%s/%s" % (version, name), xml, last_update)
+    # Approved configurations whose documents aren't stored (yet) are
+    # serialized on demand.
+    for config in serializers.prefetch(configs):
+        for version in versions:
+            if (config.id, version) in stored:
+                continue
+            xml = serializers.get(version)(config)
+            for name in domains.get(config.id, []):
+                yield ("%s/%s" % (version, name), xml,
+                       config.last_update_datetime)
+
+
+def removed(since):
+    """
+    Return the names of the domains which stopped being served after since:
+    those whose configuration stopped being approved, and those deleted,
+    renamed or moved (see RemovedDomain) that no approved configuration
+    serves now.
+    """
+    names = set(Domain.objects.filter(config__last_update_datetime__gt=since)
+                .exclude(config__status='approved')
+                .values_list('name', flat=True))
+    names.update(RemovedDomain.objects.filter(removed_datetime__gt=since)
+                 .values_list('name', flat=True))
+    served = Domain.objects.filter(name__in=names, config__status='approved')
+    names.difference_update(served.values_list('name', flat=True))
+    return sorted(names)
+
+
+def generate(format="tgz", since=None, versions=None):
+    """
+    Yield the archive in chunks.
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown archive format %s" % format)
+    output = _Buffer()
+    if format == "zip":
+        archive = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED)
+
+        def add(path, data, mtime):
+            info = zipfile.ZipInfo(path, mtime.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0644 << 16
+            archive.writestr(info, data)
+    else:
+        archive = tarfile.open(mode="w|gz", fileobj=output)
+
+        def add(path, data, mtime):
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mtime = calendar.timegm(mtime.utctimetuple())
+            info.mode = 0644
+            archive.addfile(info, StringIO(data))
+    for path, data, mtime in documents(since, versions):
+        add(path, data, mtime)
+        chunk = output.drain()
+        if chunk:
+            yield chunk
+    if since is not None:
+        data = "".join("%s\n" % name for name in removed(since))
+        add("removed", data.encode('utf-8'), since)
+    archive.close()
+    yield output.drain()
@@ -0,0 +1,230 @@
+"""
+This file contains the circuit breakers of the sanity check probes. A server
+(host and port) whose probes keep timing out is not probed again for
+settings.PROBE_BREAKER_COOLDOWN seconds: its probes fail at once instead of
+costing the full timeout. After that a single probe is let through, and the
+breaker closes again if it gets an answer. The state of the breakers is kept
+in the cache named by settings.PROBE_CACHE, so every process shares it. It is
+only changed with add, incr, set and delete, so concurrent probes don't
+overwrite each other's updates (with a cache whose incr is atomic, such as
+memcached).
+
+The number of probes of a host run at once by a process is also capped to
+settings.PROBE_HOST_CONCURRENCY, for as long as the budget of the probe (see
+ispdb.config.deadlines) allows.
+"""
+
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+
+from ispdb.cache import open_cache
+from ispdb.config import deadlines
+
+# Used when the settings don't say otherwise.
+THRESHOLD = 3
+COOLDOWN = 300
+HOST_CONCURRENCY = 4
+
+# Seconds the servers are listed by states() after their first timeout.
+INDEX_TTL = 86400
+_INDEX = 'breaker:index'
+
+
+class Open(Exception):
+    """
+    Raised by Breakers.call for the servers whose breaker is open.
+    """
+
+
+class Busy(Exception):
+    """
+    Raised by Breakers.call when the budget of the probe ran out while it
+    waited for the other probes of the host.
+    """
+
+
+def _incr(cache, key, timeout):
+    cache.add(key, 0, timeout=timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # It expired since the add.
+        cache.set(key, 1, timeout=timeout)
+        return 1
+
+
+def _acquire(slot, end):
+    """
+    Acquire a semaphore, giving up at end (a time.time() value, None to
+    wait for as long as it takes). Return whether it was acquired.
+    """
+    if end is None:
+        return slot.acquire()
+    delay = 0.0005
+    while not slot.acquire(False):
+        remaining = end - time.time()
+        if remaining <= 0:
+            return False
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+    return True
+
+
+class Breakers(object):
+    """
+    The circuit breakers of the servers probed. Probes taking timeout
+    seconds (the connect timeout of ispdb.config.deadlines by default) or
+    more to fail count as timeouts.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def _cache(self):
+        return open_cache(getattr(settings, 'PROBE_CACHE', 'default'))
+
+    def _settings(self):
+        return (getattr(settings, 'PROBE_BREAKER_THRESHOLD', THRESHOLD),
+                getattr(settings, 'PROBE_BREAKER_COOLDOWN', COOLDOWN))
+
+    def _key(self, hostname, port):
+        server = "%s:%s" % (hostname.lower(), port)
+        return 'breaker:%s' % hashlib.md5(server).hexdigest()
+
+    def _keys(self, hostname, port):
+        """
+        Return the keys of the number of timeouts of a server, when its
+        breaker opened, and whether its half open trial probe was sent.
+        """
+        key = self._key(hostname, port)
+        return (key + ':failures', key + ':opened', key + ':trial')
+
+    def _index(self, cache, hostname, port):
+        # Remember the server for states(), once.
+        key = self._key(hostname, port) + ':indexed'
+        if cache.add(key, True, timeout=INDEX_TTL):
+            slot = _incr(cache, _INDEX, INDEX_TTL)
+            cache.set('%s:%d' % (_INDEX, slot), (hostname.lower(), port),
+                      timeout=INDEX_TTL)
+
+    def _state(self, opened):
+        if opened is None:
+            return "closed"
+        if time.time() - opened < self._settings()[1]:
+            return "open"
+        return "half-open"
+
+    def state(self, hostname, port):
+        """
+        Return the state of the breaker of a server: "closed" (probes go
+        through), "open" (they fail at once) or "half-open" (the next one
+        goes through to find out).
+        """
+        opened = self._cache().get(self._keys(hostname, port)[1])
+        return self._state(opened)
+
+    def allow(self, hostname, port):
+        """
+        Return whether a server may be probed.
+        """
+        cache = self._cache()
+        failures, opened, trial = self._keys(hostname, port)
+        current = self._state(cache.get(opened))
+        if current == "closed":
+            return True
+        if current == "open":
+            return False
+        # Half open: let the probe which adds the trial key through, and no
+        # other until it is over (or as long as the cooldown if it never
+        # reports back).
+        return cache.add(trial, True, timeout=self._settings()[1])
+
+    def success(self, hostname, port):
+        """
+        Record that a server answered (or refused) a probe in time.
+        """
+        cache = self._cache()
+        keys = self._keys(hostname, port)
+        if cache.get_many(keys):
+            cache.delete_many(keys)
+
+    def failure(self, hostname, port):
+        """
+        Record that a probe of a server timed out.
+        """
+        threshold, cooldown = self._settings()
+        cache = self._cache()
+        failures, opened, trial = self._keys(hostname, port)
+        count = _incr(cache, failures, 2 * cooldown)
+        if count >= threshold or cache.get(trial) is not None:
+            cache.set(opened, time.time(), timeout=2 * cooldown)
+            cache.delete(trial)
+        self._index(cache, hostname, port)
+
+    def reset(self, hostname, port):
+        """
+        Close the breaker of a server.
+        """
+        self._cache().delete_many(self._keys(hostname, port))
+
+    def states(self):
+        """
+        Return the breakers of the servers which timed out lately, as dicts
+        with the server, the state, the number of timeouts and when the
+        breaker opened.
+        """
+        cache = self._cache()
+        count = cache.get(_INDEX, 0)
+        slots = cache.get_many(['%s:%d' % (_INDEX, slot)
+                                for slot in range(1, count + 1)])
+        ret = []
+        for hostname, port in sorted(set(slots.values())):
+            failures, opened, trial = self._keys(hostname, port)
+            values = cache.get_many([failures, opened])
+            if not values:
+                continue
+            ret.append({"hostname": hostname, "port": port,
+                        "state": self._state(values.get(opened)),
+                        "failures": values.get(failures, 0),
+                        "opened": values.get(opened)})
+        return ret
+
+    def _slot(self, hostname):
+        hostname = hostname.lower()
+        with self._lock:
+            if hostname not in self._slots:
+                self._slots[hostname] = threading.BoundedSemaphore(
+                        getattr(settings, 'PROBE_HOST_CONCURRENCY',
+                                HOST_CONCURRENCY))
+            return self._slots[hostname]
+
+    def call(self, hostname, port, failed, func, *args):
+        """
+        Return func(*args), a probe of a server which returns failed when it
+        gets no answer. Raise Open if the breaker of the server is, or Busy
+        if the probe's budget ran out before it could start.
+        """
+        if not self.allow(hostname, port):
+            raise Open("%s:%s" % (hostname, port))
+        slot = self._slot(hostname)
+        if not _acquire(slot, deadlines.deadline()):
+            raise Busy("%s:%s" % (hostname, port))
+        try:
+            start = time.time()
+            result = func(*args)
+            elapsed = time.time() - start
+        finally:
+            slot.release()
+        timeout = self.timeout
+        if timeout is None:
+            timeout = deadlines.timeouts()["connect"]
+        if result == failed and elapsed >= timeout:
+            self.failure(hostname, port)
+        else:
+            self.success(hostname, port)
+        return result
@@ -2,36 +2,52 @@
 This file contains methods to do sanity checks on domains and configs
 """
 
-import dns.resolver
+import hashlib
 import imaplib
+import logging
 import poplib
+import Queue
 import re
-import smtplib
 import ssl
-import tldextract
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
+
+from ispdb import publicsuffix
+from ispdb.cache import open_cache
+from ispdb.config import breakers, deadlines, dnscache
+
+log = logging.getLogger(__name__)
+
+# The longest the mail libraries are asked to wait, the probe connections
+# use the shorter timeouts of ispdb.config.deadlines.
 TIMEOUT = 10
+# The number of probes run at once, and the seconds all the probes of a check
+# have to finish in. They can be changed with settings.SANITY_CHECK_WORKERS
+# and settings.SANITY_CHECK_DEADLINE.
+WORKERS = 8
+DEADLINE = 30
+# Seconds the results of server checks are kept, see cached_probe_port.
+PROBE_TTL = 900
+PROBE_NEGATIVE_TTL = 120
+# What the cached probes return instead of a result when the breaker of the
+# server is open: the server wasn't checked.
+SKIPPED = "skipped"
 
 
 def get_nameservers(domain):
-    try:
-        answers = dns.resolver.query(domain, 'NS')
-    except:
+    nservers = dnscache.resolver.query(domain, 'NS')
+    if not nservers:
         return []
-    nservers = []
-    for ns in answers:
-        nservers.append(str(ns))
     return set(nservers)
 
 
 def get_mxservers(domain):
-    try:
-        answers = dns.resolver.query(domain, 'MX')
-    except:
-        return []
     mxservers = []
-    for server in answers:
-        srv = str(server).split(' ')[1]
+    for server in dnscache.resolver.query(domain, 'MX'):
+        srv = server.split(' ')[1]
         mxservers.append(srv)
     return mxservers
 
@@ -55,7 +71,7 @@ def _smtp_parse_supported_auth(string):
 
 def smtp_check_starttls(hostname, port):
     try:
-        server = smtplib.SMTP(hostname, port, timeout=TIMEOUT)
+        server = deadlines.SMTP(hostname, port, timeout=TIMEOUT)
         server.ehlo()
         res = server.starttls()
         ehlo = server.ehlo()
@@ -73,7 +89,7 @@ def smtp_check_starttls(hostname, port):
 
 def smtp_check_ssl(hostname, port):
     try:
-        server = smtplib.SMTP_SSL(hostname, port, timeout=TIMEOUT)
+        server = deadlines.SMTP_SSL(hostname, port, timeout=TIMEOUT)
         ehlo = server.ehlo()
         server.quit()
         return _smtp_parse_supported_auth(ehlo[1])
@@ -83,7 +99,7 @@ def smtp_check_ssl(hostname, port):
 
 def smtp_check_plain(hostname, port):
     try:
-        server = smtplib.SMTP(hostname, port, timeout=TIMEOUT)
+        server = deadlines.SMTP(hostname, port, timeout=TIMEOUT)
         ehlo = server.ehlo()
         server.quit()
         return _smtp_parse_supported_auth(ehlo[1])
@@ -91,6 +107,28 @@ def smtp_check_plain(hostname, port):
         return None
 
 
+def smtp_probe_port(hostname, port):
+    ret = {"plain": None, "starttls": None}
+    try:
+        server = deadlines.SMTP(hostname, port, timeout=TIMEOUT)
+    except:
+        return ret
+    try:
+        ehlo = server.ehlo()
+        ret["plain"] = _smtp_parse_supported_auth(ehlo[1])
+        res = server.starttls()
+        ehlo = server.ehlo()
+        if res[0] == 220:
+            ret["starttls"] = _smtp_parse_supported_auth(ehlo[1])
+    except:
+        pass
+    try:
+        server.quit()
+    except:
+        pass
+    return ret
+
+
 # IMAP methods
 def IMAP_starttls(self, keyfile=None, certfile=None, cert_reqs=ssl.CERT_NONE,
                   ca_certs=None):
@@ -105,9 +143,9 @@ def IMAP_starttls(self, keyfile=None, certfile=None, cert_reqs=ssl.CERT_NONE,
         raise self.error('TLS session already established')
     typ, dat = self._simple_command(name)
     if typ == 'OK':
-        self.sock = ssl.wrap_socket(self.sock, keyfile, certfile,
-                                    cert_reqs=cert_reqs,
-                                    ca_certs=ca_certs)
+        self.sock = deadlines.wrap_socket(self.sock, keyfile, certfile,
+                                          cert_reqs=cert_reqs,
+                                          ca_certs=ca_certs)
         self.file = self.sock.makefile('rb')
         self._tls_established = True
         typ, dat = self.capability()
@@ -120,7 +158,6 @@ def IMAP_starttls(self, keyfile=None, certfile=None, cert_reqs=ssl.CERT_NONE,
 
 imaplib.IMAP4.__dict__['starttls'] = IMAP_starttls
 imaplib.Commands['STARTTLS'] = ('NONAUTH',)
-imaplib.socket.setdefaulttimeout(TIMEOUT)
 
 
 def _imap_parse_supported_auth(string):
@@ -141,7 +178,7 @@ def _imap_parse_supported_auth(string):
 
 def imap_check_starttls(hostname, port):
     try:
-        server = imaplib.IMAP4(hostname, port)
+        server = deadlines.IMAP4(hostname, port)
         server.starttls()
         capa = server.capabilities
         server.shutdown()
@@ -157,7 +194,7 @@ def imap_check_starttls(hostname, port):
 
 def imap_check_ssl(hostname, port):
     try:
-        server = imaplib.IMAP4_SSL(hostname, port)
+        server = deadlines.IMAP4_SSL(hostname, port)
         capa = server.capabilities
         server.shutdown()
         capa_str = ' '.join(str(n) for n in capa)
@@ -168,7 +205,7 @@ def imap_check_ssl(hostname, port):
 
 def imap_check_plain(hostname, port):
     try:
-        server = imaplib.IMAP4(hostname, port)
+        server = deadlines.IMAP4(hostname, port)
         capa = server.capabilities
         server.shutdown()
         capa_str = ' '.join(str(n) for n in capa)
@@ -177,6 +214,27 @@ def imap_check_plain(hostname, port):
         return None
 
 
+def imap_probe_port(hostname, port):
+    ret = {"plain": None, "starttls": None}
+    try:
+        server = deadlines.IMAP4(hostname, port)
+    except:
+        return ret
+    try:
+        capa_str = ' '.join(str(n) for n in server.capabilities)
+        ret["plain"] = _imap_parse_supported_auth(capa_str)
+        server.starttls()
+        capa_str = ' '.join(str(n) for n in server.capabilities)
+        ret["starttls"] = _imap_parse_supported_auth(capa_str)
+    except:
+        pass
+    try:
+        server.shutdown()
+    except:
+        pass
+    return ret
+
+
 # POP3 methods
 def POP_stls(self, keyfile=None, certfile=None, cert_reqs=ssl.CERT_NONE,
                   ca_certs=None):
@@ -188,9 +246,9 @@ def POP_stls(self, keyfile=None, certfile=None, cert_reqs=ssl.CERT_NONE,
         raise poplib.error_proto('-ERR TLS session already established')
     try:
         resp = self._shortcmd('STLS')
-        self.sock = ssl.wrap_socket(self.sock, keyfile, certfile,
-                                    cert_reqs=cert_reqs,
-                                    ca_certs=ca_certs)
+        self.sock = deadlines.wrap_socket(self.sock, keyfile, certfile,
+                                          cert_reqs=cert_reqs,
+                                          ca_certs=ca_certs)
         self.file = self.sock.makefile('rb')
         self._tls_established = True
     except poplib.error_proto:
@@ -198,7 +256,6 @@ def POP_stls(self, keyfile=None, certfile=None, cert_reqs=ssl.CERT_NONE,
     return resp
 
 poplib.POP3.__dict__['stls'] = POP_stls
-poplib.socket.setdefaulttimeout(TIMEOUT)
 
 
 def _pop3_parse_supported_auth(string):
@@ -219,7 +276,7 @@ def _pop3_parse_supported_auth(string):
 
 def pop3_check_starttls(hostname, port):
     try:
-        server = poplib.POP3(hostname, port, timeout=TIMEOUT)
+        server = deadlines.POP3(hostname, port, timeout=TIMEOUT)
         res = server.stls()
         try:
             res = server._longcmd('CAPA')
@@ -239,7 +296,7 @@ def pop3_check_starttls(hostname, port):
 
 def pop3_check_ssl(hostname, port):
     try:
-        server = poplib.POP3_SSL(hostname, port)
+        server = deadlines.POP3_SSL(hostname, port)
         try:
             res = server._longcmd('CAPA')
             res_str = ' '.join(str(n) for n in res[1])
@@ -254,7 +311,7 @@ def pop3_check_ssl(hostname, port):
 
 def pop3_check_plain(hostname, port):
     try:
-        server = poplib.POP3(hostname, port, timeout=TIMEOUT)
+        server = deadlines.POP3(hostname, port, timeout=TIMEOUT)
         try:
             res = server._longcmd('CAPA')
             res_str = ' '.join(str(n) for n in res[1])
@@ -267,39 +324,365 @@ def pop3_check_plain(hostname, port):
         return None
 
 
+def _pop3_capa(server):
+    try:
+        res = server._longcmd('CAPA')
+        res_str = ' '.join(str(n) for n in res[1])
+        return _pop3_parse_supported_auth(res_str)
+    except (poplib.error_proto, EnvironmentError):
+        return {}
+
+
+def pop3_probe_port(hostname, port):
+    ret = {"plain": None, "starttls": None}
+    try:
+        server = deadlines.POP3(hostname, port, timeout=TIMEOUT)
+    except:
+        return ret
+    try:
+        ret["plain"] = _pop3_capa(server)
+        server.stls()
+        ret["starttls"] = _pop3_capa(server)
+    except:
+        pass
+    try:
+        server.quit()
+    except:
+        pass
+    return ret
+
+
+_checks = {
+    "imap:ssl": (imap_check_ssl, 993),
+    "imap:starttls": (imap_check_starttls, 143),
+    "imap:plain": (imap_check_plain, 143),
+    "pop3:ssl": (pop3_check_ssl, 995),
+    "pop3:starttls": (pop3_check_starttls, 110),
+    "pop3:plain": (pop3_check_plain, 110),
+    "smtp:ssl": (smtp_check_ssl, 465),
+    "smtp:starttls": (smtp_check_starttls, 587),
+    "smtp:plain": (smtp_check_plain, 587),
+}
+
+
 def check_socket_type(hostname, proto, socket_type, port=None):
     key = proto + ":" + socket_type.lower()
-    funcs = {
-             "imap:ssl": (imap_check_ssl, 993),
-             "imap:starttls": (imap_check_starttls, 143),
-             "imap:plain": (imap_check_plain, 143),
-             "pop3:ssl": (pop3_check_ssl, 995),
-             "pop3:starttls": (pop3_check_starttls, 110),
-             "pop3:plain": (pop3_check_plain, 110),
-             "smtp:ssl": (smtp_check_ssl, 465),
-             "smtp:starttls": (smtp_check_starttls, 587),
-             "smtp:plain": (smtp_check_plain, 587),
-            }
-    (func, default_port) = funcs[key]
+    (func, default_port) = _checks[key]
     if not port:
         port = default_port
     return func(hostname, port)
 
 
-def do_domain_checks(domains):
+# The probes which check plain and STARTTLS on a port in one connection: they
+# read the capabilities, try STARTTLS and read them again over TLS.
+_port_probes = {
+    "imap": imap_probe_port,
+    "pop3": pop3_probe_port,
+    "smtp": smtp_probe_port,
+}
+
+
+def probe_port(hostname, proto, port=None):
+    """
+    Check plain and STARTTLS on a port with a single connection. Return a
+    dict with the supported authentication methods of each ("plain" and
+    "starttls"), None for the ones which aren't supported.
+    """
+    if not port:
+        port = _checks[proto + ":plain"][1]
+    return _port_probes[proto](hostname, port)
+
+
+# Probes of servers which keep timing out fail at once for a while, see
+# ispdb.config.breakers.
+server_breakers = breakers.Breakers()
+
+
+def _cached(key, func, *args):
+    cache = open_cache(getattr(settings, 'PROBE_CACHE', 'default'))
+    hostname, port = key[0], key[3]
+    failed = {"plain": None, "starttls": None} if key[2] == "port" else None
+    key = 'probe:%s' % hashlib.md5(repr(key)).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        # Tell what became of each address when the probe was run.
+        deadlines.report(cached[1])
+        return cached[0]
+    try:
+        with deadlines.recording() as attempts:
+            result = server_breakers.call(hostname, port, failed, func,
+                                          *args)
+    except breakers.Open:
+        # Not cached, the server is probed again once the breaker lets it.
+        return SKIPPED
+    except breakers.Busy:
+        # Not cached either, the server wasn't probed.
+        return failed
+    if result == failed:
+        timeout = getattr(settings, 'PROBE_NEGATIVE_TTL', PROBE_NEGATIVE_TTL)
+    else:
+        timeout = getattr(settings, 'PROBE_TTL', PROBE_TTL)
+    # Wrap the result, None means it isn't cached.
+    cache.set(key, (result, attempts), timeout=timeout)
+    return result
+
+
+def cached_probe_port(hostname, proto, port=None):
+    """
+    Same as probe_port, but the results are kept in the cache named by
+    settings.PROBE_CACHE, so checking a host again soon after (for another
+    configuration, or another sanity run) doesn't connect to it. Return
+    SKIPPED if the breaker of the server is open.
+    """
+    if not port:
+        port = _checks[proto + ":plain"][1]
+    return _cached((hostname.lower(), proto, "port", port),
+                   probe_port, hostname, proto, port)
+
+
+def cached_check_socket_type(hostname, proto, socket_type, port=None):
+    """
+    Same as check_socket_type, with the results cached like
+    cached_probe_port's. Plain and STARTTLS are checked with it.
+    """
+    socket_type = socket_type.lower()
+    if socket_type != "ssl":
+        result = cached_probe_port(hostname, proto, port)
+        if result == SKIPPED:
+            return result
+        return result[socket_type]
+    if not port:
+        port = _checks[proto + ":ssl"][1]
+    return _cached((hostname.lower(), proto, socket_type, port),
+                   check_socket_type, hostname, proto, socket_type, port)
+
+
+class Probes(object):
+    """
+    Run the DNS queries and server checks of a sanity check at the same time,
+    on a bounded number of threads. Each probe runs at most once, and the
+    results which aren't in when the deadline passes count as failures.
+    """
+
+    def __init__(self, workers=None, deadline=None):
+        if workers is None:
+            workers = getattr(settings, 'SANITY_CHECK_WORKERS', WORKERS)
+        if deadline is None:
+            deadline = getattr(settings, 'SANITY_CHECK_DEADLINE', DEADLINE)
+        self.deadline = deadline
+        self.timed_out = []
+        self._pool = ThreadPool(workers)
+        self._results = {}
+        self._finished = Queue.Queue()
+        self._finished_at = {}
+        self._attempts = {}
+        self._errors = set()
+        self._skipped = set()
+        self._end = None
+
+    def _probe(self, key, func, args):
+        try:
+            with deadlines.budget(self._end):
+                with deadlines.recording() as attempts:
+                    self._attempts[key] = attempts
+                    return func(*args)
+        finally:
+            self._finished_at[key] = time.time()
+            self._finished.put(key)
+
+    def _submit(self, key, func, *args):
+        if self._end is None:
+            self._end = time.time() + self.deadline
+        if key not in self._results:
+            self._results[key] = self._pool.apply_async(self._probe,
+                                                        (key, func, args))
+
+    def _get(self, key, default):
+        try:
+            result = self._results[key].get(max(self._end - time.time(), 0))
+        except TimeoutError:
+            result = None
+        except Exception:
+            # A probe which blew up failed, whatever went wrong.
+            if key not in self._errors:
+                self._errors.add(key)
+                log.exception("Sanity check probe %r failed", key)
+            return default
+        # Probes cut short by the deadline give up at it.
+        if self._finished_at.get(key, self._end) >= self._end:
+            if key not in self.timed_out:
+                self.timed_out.append(key)
+            return default
+        if result == SKIPPED:
+            self._skipped.add(key)
+            return default
+        return result
+
+    def _server_key(self, hostname, proto, socket_type, port):
+        # Plain and STARTTLS on the same port share a probe.
+        socket_type = socket_type.lower()
+        if not port:
+            port = _checks[proto + ":" + socket_type][1]
+        if socket_type != "ssl":
+            socket_type = "port"
+        return (hostname, proto, socket_type, port)
+
+    def query(self, domain, rdtype):
+        funcs = {'NS': get_nameservers, 'MX': get_mxservers}
+        self._submit((domain, rdtype), funcs[rdtype], domain)
+
+    def answer(self, domain, rdtype):
+        return self._get((domain, rdtype), [])
+
+    def check(self, hostname, proto, socket_type, port=None):
+        key = self._server_key(hostname, proto, socket_type, port)
+        if key[2] == "port":
+            self._submit(key, cached_probe_port, hostname, proto, key[3])
+        else:
+            self._submit(key, cached_check_socket_type, *key)
+
+    def result(self, hostname, proto, socket_type, port=None):
+        key = self._server_key(hostname, proto, socket_type, port)
+        result = self._get(key, None)
+        if key[2] == "port" and result is not None:
+            return result[socket_type.lower()]
+        return result
+
+    def skipped(self, hostname, proto, socket_type, port=None):
+        """
+        Return whether a server check was skipped because the breaker of the
+        server was open (see ispdb.config.breakers).
+        """
+        key = self._server_key(hostname, proto, socket_type, port)
+        self._get(key, None)
+        return key in self._skipped
+
+    def completed(self):
+        """
+        Yield the keys of the probes sent so far as they finish, until they
+        all have or the deadline passes. The probes sent meanwhile are left
+        out. Each probe is only yielded by one call.
+        """
+        pending = set(self._results)
+        while pending:
+            try:
+                key = self._finished.get(True,
+                                         max(self._end - time.time(), 0))
+            except Queue.Empty:
+                return
+            if key in pending:
+                pending.discard(key)
+                yield key
+
+    def findings(self, key):
+        """
+        Return what a finished probe found, as dicts: the records of a DNS
+        query, or the capabilities (None if the check failed) a server
+        reported for a socket type.
+        """
+        if len(key) == 2:
+            result = self._get(key, [])
+            domain, rdtype = key
+            if isinstance(result, set):
+                result = sorted(result)
+            return [{"domain": domain, "rdtype": rdtype,
+                     "records": list(result)}]
+        names = {"plain": "plain", "starttls": "STARTTLS", "ssl": "SSL"}
+        hostname, proto, socket_type, port = key
+        if socket_type == "port":
+            result = self._get(key, {"plain": None, "starttls": None})
+            results = [("plain", result["plain"]),
+                       ("starttls", result["starttls"])]
+        else:
+            results = [(socket_type, self._get(key, None))]
+        addresses = self.addresses(key)
+        return [{"hostname": hostname, "type": proto,
+                 "socket_type": names[socket_type], "port": port,
+                 "capabilities": capa, "addresses": addresses}
+                for socket_type, capa in results]
+
+    def addresses(self, key):
+        """
+        Return what became of each address a server probe connected to: its
+        address, family (IPv4 or IPv6) and result ("connected", "failed" or
+        "abandoned" when another address answered first), and the error if
+        it failed.
+        """
+        ret = []
+        for attempt in self._attempts.get(key, []):
+            address = dict((k, v) for k, v in attempt.items()
+                           if k in ("address", "family", "result", "error"))
+            if address not in ret:
+                ret.append(address)
+        return ret
+
+    def capabilities(self):
+        """
+        Return what the servers checked so far reported (see findings).
+        Checks which didn't finish are left out.
+        """
+        ret = []
+        # Server checks have four part keys, DNS queries two.
+        for key in sorted(k for k in self._results if len(k) == 4):
+            if key not in self.timed_out and self._results[key].ready():
+                ret += self.findings(key)
+        return ret
+
+    def warnings(self):
+        ret = []
+        if self.timed_out:
+            ret.append("%d checks didn't finish within %s seconds." %
+                       (len(self.timed_out), self.deadline))
+        # Servers only answering over IPv4.
+        broken = {}
+        for key in sorted(k for k in self._results if len(k) == 4):
+            if key in self.timed_out:
+                continue
+            attempts = self.addresses(key)
+            if any(a["family"] == "IPv4" and a["result"] == "connected"
+                   for a in attempts):
+                failed = broken.setdefault(key[0], [])
+                for a in attempts:
+                    if (a["family"] == "IPv6" and a["result"] == "failed"
+                        and a["address"] not in failed):
+                        failed.append(a["address"])
+        for hostname in sorted(broken):
+            if broken[hostname]:
+                ret.append("Server '%s' can't be reached over IPv6 (%s), "
+                           "only over IPv4." %
+                           (hostname, ", ".join(broken[hostname])))
+        return ret
+
+    def close(self):
+        # The probes still running give up at the deadline.
+        self._pool.close()
+        self._pool.join()
+
+
+def _query_domains(probes, domains):
+    if not domains:
+        return
+    probes.query(domains[0].name, 'NS')
+    for domain in domains[1:]:
+        probes.query(str(domain), 'NS')
+    for domain in domains:
+        probes.query(domain.name, 'MX')
+
+
+def _domain_checks(probes, domains):
     domain_errors = []
     domain_warnings = []
     if not domains:
         return (domain_errors, domain_warnings)
     # Check and compare nameservers
-    ns = get_nameservers(domains[0].name)
+    ns = probes.answer(domains[0].name, 'NS')
     if not ns:
         domain_warnings.append("Could not compare name servers because DNS "
                                "query of the first domain (%s) returned "
                                "None." % (domains[0].name))
     else:
         for domain in domains[1:]:
-            sub_ns = get_nameservers(str(domain))
+            sub_ns = probes.answer(str(domain), 'NS')
             if not sub_ns or not sub_ns.issubset(ns):
                 domain_warnings.append("Name servers of domain '%s' differ"
                                        " from name servers of the main "
@@ -307,42 +690,38 @@ def do_domain_checks(domains):
                                        % (domains[0].name, domain.name))
     # Check MX records
     tlds = set()
-    extract = tldextract.TLDExtract(fetch=False)
+    psl = publicsuffix.get()
     for domain in domains:
-        mxservers = get_mxservers(domain.name)
+        mxservers = probes.answer(domain.name, 'MX')
         # check if domain is valid and add it to tlds
-        tld = extract(domain.name)
-        if not (tld.tld and tld.domain):
+        if not psl.registered_domain(domain.name):
             domain_errors.append("Domain '%s' is not valid." %
                                  (domain.name))
         else:
             tlds.add(domain.name)
         # get domain and tld from MX servers
-        for server in mxservers:
-            tld = extract(server)
-            if tld.tld and tld.domain:
-                tlds.add(tld.domain + '.' + tld.tld)
+        for split in psl.split_many(mxservers):
+            if split.registered_domain:
+                tlds.add(split.registered_domain)
         # Check if domain has at least one MX server
         if not mxservers or len(mxservers) < 1:
             domain_errors.append("Couldn't find MX record for '%s'." %
                                  (domain,))
     # Compare incoming/outgoing server TLD with tlds
-    tld = extract(domains[0].config.incoming_hostname)
-    if not (tld.tld and tld.domain):
+    d = psl.registered_domain(domains[0].config.incoming_hostname)
+    if not d:
         domain_errors.append("Domain '%s' is not valid." %
                              (domains[0].config.incoming_hostname))
     else:
-        d = tld.domain + '.' + tld.tld
         if not d in tlds:
             domain_errors.append("Incoming server domain '%s' is different"
                                  " from the configured domains and its MX "
                                  "servers domains." % (d))
-    tld = extract(domains[0].config.outgoing_hostname)
-    if not (tld.tld and tld.domain):
+    d = psl.registered_domain(domains[0].config.outgoing_hostname)
+    if not d:
         domain_errors.append("Domain '%s' is not valid." %
                              (domains[0].config.outgoing_hostname))
     else:
-        d = tld.domain + '.' + tld.tld
         if not d in tlds:
             domain_errors.append("Outgoing server domain '%s' is different"
                                  " from the configured domains and its MX "
@@ -350,32 +729,57 @@ def do_domain_checks(domains):
     return (domain_errors, domain_warnings)
 
 
-def do_config_checks(config):
+def _check_servers(probes, config):
+    # Check the socket types do_config_checks may ask for, whether or not
+    # it ends up needing them.
+    for hostname, proto, socket_type, port in (
+            (config.incoming_hostname, config.incoming_type,
+             config.incoming_socket_type, config.incoming_port),
+            (config.outgoing_hostname, 'smtp',
+             config.outgoing_socket_type, config.outgoing_port)):
+        if socket_type in ('plain', 'STARTTLS'):
+            probes.check(hostname, proto, 'SSL')
+            if socket_type == 'plain':
+                probes.check(hostname, proto, 'STARTTLS')
+        probes.check(hostname, proto, socket_type, port=port)
+
+
+_SKIPPED_WARNING = ("%s server '%s' not checked: server temporarily skipped "
+                    "after repeated failures.")
+
+
+def _config_checks(probes, config):
     config_errors = []
     config_warnings = []
     # Incoming server checks
     # Check if there is a better socket type available
     if config.incoming_socket_type == 'plain' or (
         config.incoming_socket_type == 'STARTTLS'):
-        if check_socket_type(config.incoming_hostname,
+        if probes.result(config.incoming_hostname,
                              config.incoming_type,
                              'SSL') is not None:
             config_warnings.append("Incoming server '%s' supports SSL "
                                    "using default port." %
                                    (config.incoming_hostname))
         elif config.incoming_socket_type == 'plain':
-            if check_socket_type(config.incoming_hostname,
+            if probes.result(config.incoming_hostname,
                                  config.incoming_type,
                                  'STARTTLS') is not None:
                 config_warnings.append("Incoming server '%s' supports "
                                        "STARTTLS using default port." %
                                        (config.incoming_hostname,))
     # Check if current options are working
-    capa = check_socket_type(config.incoming_hostname,
+    capa = probes.result(config.incoming_hostname,
                              config.incoming_type,
                              config.incoming_socket_type,
                              port=config.incoming_port)
-    if capa is None:
+    if capa is None and probes.skipped(config.incoming_hostname,
+                                       config.incoming_type,
+                                       config.incoming_socket_type,
+                                       port=config.incoming_port):
+        config_warnings.append(_SKIPPED_WARNING %
+                               ("Incoming", config.incoming_hostname))
+    elif capa is None:
         config_errors.append("Incoming server '%s' does not support "
                              "socket type %s on port %s." %
                               (config.incoming_hostname,
@@ -403,25 +807,30 @@ def do_config_checks(config):
     # Check if there is a better socket type available
     if (config.outgoing_socket_type == 'plain') or (
             config.outgoing_socket_type == 'STARTTLS'):
-        if check_socket_type(config.outgoing_hostname,
+        if probes.result(config.outgoing_hostname,
                              'smtp',
                              'SSL') is not None:
             config_warnings.append("Outgoing server '%s' supports SSL "
                                    "using default port." %
                                    (config.outgoing_hostname))
         elif config.outgoing_socket_type == 'plain':
-            if check_socket_type(config.outgoing_hostname,
+            if probes.result(config.outgoing_hostname,
                                  'smtp',
                                  'STARTTLS') is not None:
                 config_warnings.append("Outgoing server supports '%s' "
                                        "STARTTLS using default port." %
                                        (config.outgoing_hostname,))
     # Check if current options are working
-    capa = check_socket_type(config.outgoing_hostname,
+    capa = probes.result(config.outgoing_hostname,
                              'smtp',
                              config.outgoing_socket_type,
                              port=config.outgoing_port)
-    if capa is None:
+    if capa is None and probes.skipped(config.outgoing_hostname, 'smtp',
+                                       config.outgoing_socket_type,
+                                       port=config.outgoing_port):
+        config_warnings.append(_SKIPPED_WARNING %
+                               ("Outgoing", config.outgoing_hostname))
+    elif capa is None:
         config_errors.append("Outgoing server '%s' does not support "
                              "socket type %s on port %s." %
                              (config.outgoing_hostname,
@@ -446,3 +855,129 @@ def do_config_checks(config):
                                        "auth type %s." %
                                        (config.outgoing_hostname, auth))
     return (config_errors, config_warnings)
+
+
+def _server_problems(probes, config):
+    problems = []
+    for server, hostname, proto, socket_type, port in (
+            ("incoming", config.incoming_hostname, config.incoming_type,
+             config.incoming_socket_type, config.incoming_port),
+            ("outgoing", config.outgoing_hostname, 'smtp',
+             config.outgoing_socket_type, config.outgoing_port)):
+        if (probes.result(hostname, proto, socket_type, port=port) is not None
+                or probes.skipped(hostname, proto, socket_type, port=port)):
+            continue
+        # A server which still answers without TLS on the port lost it.
+        problem = "unreachable"
+        if socket_type != 'plain':
+            probes.check(hostname, proto, 'plain', port=port)
+            if probes.result(hostname, proto, 'plain', port=port) is not None:
+                problem = "tls_lost"
+        problems.append({"server": server, "hostname": hostname,
+                         "type": proto, "socket_type": socket_type,
+                         "port": port, "problem": problem})
+    return problems
+
+
+def _run(domains, config, details=None):
+    probes = Probes()
+    try:
+        # Send every probe first, then wait for the results as they are
+        # needed.
+        _query_domains(probes, domains)
+        if config is not None:
+            _check_servers(probes, config)
+        errors, warnings = _domain_checks(probes, domains)
+        if config is not None:
+            config_errors, config_warnings = _config_checks(probes, config)
+            errors += config_errors
+            warnings += config_warnings
+            if details is not None:
+                details["problems"] = _server_problems(probes, config)
+                details["capabilities"] = probes.capabilities()
+        return (errors, warnings + probes.warnings())
+    finally:
+        probes.close()
+
+
+def iter_checks(config, domains):
+    """
+    Run the same checks as do_checks, yielding what they find as soon as it
+    is known, as dicts with an "event" key:
+    - "dns" and "server" for each finished probe (see Probes.findings),
+    - "domains" and "servers" with the errors and warnings of the domain and
+      config checks, once the probes they need are done,
+    - "summary" last, with all the errors and warnings as do_checks returns
+      them.
+    """
+    probes = Probes()
+    try:
+        _query_domains(probes, domains)
+        _check_servers(probes, config)
+        sections = {
+            "domains": (_domain_checks, domains,
+                        set(k for k in probes._results if len(k) == 2)),
+            "servers": (_config_checks, config,
+                        set(k for k in probes._results if len(k) == 4)),
+        }
+        messages = {}
+
+        def finish(section):
+            func, arg, pending = sections[section]
+            messages[section] = func(probes, arg)
+            return {"event": section, "errors": messages[section][0],
+                    "warnings": messages[section][1]}
+
+        for section in sorted(sections):
+            if not sections[section][2]:
+                yield finish(section)
+        for key in probes.completed():
+            event = "dns" if len(key) == 2 else "server"
+            for finding in probes.findings(key):
+                finding["event"] = event
+                yield finding
+            for section in sorted(sections):
+                pending = sections[section][2]
+                if key in pending:
+                    pending.discard(key)
+                    if not pending:
+                        yield finish(section)
+        # The probes which didn't finish in time count as failures.
+        for section in sorted(sections):
+            if section not in messages:
+                yield finish(section)
+        errors = messages["domains"][0] + messages["servers"][0]
+        warnings = (messages["domains"][1] + messages["servers"][1] +
+                    probes.warnings())
+        yield {"event": "summary", "errors": errors, "warnings": warnings,
+               "capabilities": probes.capabilities()}
+    finally:
+        probes.close()
+
+
+def do_domain_checks(domains):
+    return _run(domains, None)
+
+
+def do_config_checks(config):
+    return _run([], config)
+
+
+def do_checks(config, domains, details=None):
+    """
+    Run the domain and config checks of a configuration at the same time.
+    If details is a dict, the servers' problems (see do_sweep_checks) and
+    what they reported (see Probes.capabilities) are added to it.
+    """
+    return _run(domains, config, details)
+
+
+def do_sweep_checks(config, domains):
+    """
+    Same as do_checks, but also return the servers of config which stopped
+    answering ("unreachable") or only answer without TLS ("tls_lost"), as
+    dicts describing the server and the problem.
+    """
+    details = {}
+    errors, warnings = _run(domains, config, details)
+    return (errors, warnings, details["problems"])
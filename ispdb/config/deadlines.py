@@ -0,0 +1,374 @@
+"""
+This file contains the timeouts of the sanity check probes. Instead of
+changing the default timeout of every socket of the process, the probes use
+the SMTP, IMAP4 and POP3 classes below, whose connections bound each step:
+connecting (settings.PROBE_CONNECT_TIMEOUT seconds), the TLS handshake
+(settings.PROBE_TLS_TIMEOUT) and each command after that
+(settings.PROBE_READ_TIMEOUT). The mail libraries themselves are left alone,
+so sending mail from Django isn't affected. Inside budget(end), none of
+them waits past end either, so the probes of a sanity run give up when the
+run's time is over.
+
+Connections are opened with connect(), which tries the addresses of a host
+at the same time, settings.PROBE_CONNECT_STAGGER seconds apart and
+alternating IPv6 and IPv4 ("happy eyeballs"), so a broken address doesn't
+hold the probe up. What became of each address is told to recording().
+"""
+
+import imaplib
+import poplib
+import Queue
+import smtplib
+import socket as _socket
+import ssl as _ssl
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Seconds used when the settings don't say otherwise.
+CONNECT_TIMEOUT = 5
+TLS_TIMEOUT = 5
+READ_TIMEOUT = 10
+CONNECT_STAGGER = 0.25
+
+_local = threading.local()
+
+
+def timeouts():
+    """
+    Return the timeouts of each step of a probe connection.
+    """
+    return {"connect": getattr(settings, 'PROBE_CONNECT_TIMEOUT',
+                               CONNECT_TIMEOUT),
+            "tls": getattr(settings, 'PROBE_TLS_TIMEOUT', TLS_TIMEOUT),
+            "read": getattr(settings, 'PROBE_READ_TIMEOUT', READ_TIMEOUT)}
+
+
+@contextmanager
+def budget(end):
+    """
+    Don't let the probe connections opened by this thread wait past end (a
+    time.time() value) while in this block.
+    """
+    previous = getattr(_local, 'end', None)
+    _local.end = end
+    try:
+        yield
+    finally:
+        _local.end = previous
+
+
+def deadline():
+    """
+    Return the end of the budget of this thread, or None if it has none.
+    """
+    return getattr(_local, 'end', None)
+
+
+def step_timeout(step, requested=None):
+    """
+    Return the timeout of a step of a probe connection, no longer than
+    requested (if given) and the time left in the budget.
+    """
+    seconds = [timeouts()[step]]
+    if requested not in (None, _socket._GLOBAL_DEFAULT_TIMEOUT):
+        seconds.append(requested)
+    end = getattr(_local, 'end', None)
+    if end is not None:
+        # A timeout of 0 would make the socket non blocking.
+        seconds.append(max(end - time.time(), 0.001))
+    return min(seconds)
+
+
+@contextmanager
+def recording():
+    """
+    Collect the connection attempts this thread makes in this block in the
+    list it returns, as dicts with the host, port, address, family and
+    result ("connected", "failed" or "abandoned") of each.
+    """
+    attempts = []
+    outer = getattr(_local, 'attempts', None)
+    _local.attempts = attempts
+    try:
+        yield attempts
+    finally:
+        _local.attempts = outer
+        if outer is not None:
+            outer += attempts
+
+
+def report(attempts):
+    """
+    Add connection attempts made earlier (by a cached probe) to those being
+    recorded.
+    """
+    recorded = getattr(_local, 'attempts', None)
+    if recorded is not None:
+        recorded += attempts
+
+
+def addresses(host, port):
+    """
+    Return the addresses of host to try, in the order to try them: both
+    families taking turns, starting with the first one returned.
+    """
+    families = []
+    by_family = {}
+    for info in _socket.getaddrinfo(host, port, 0, _socket.SOCK_STREAM):
+        if info[0] not in by_family:
+            families.append(info[0])
+            by_family[info[0]] = []
+        by_family[info[0]].append(info)
+    ret = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                ret.append(by_family[family].pop(0))
+    return ret
+
+
+def connect(address, timeout, source_address=None):
+    """
+    Open a connection to address (a host and port) like
+    socket.create_connection, trying its addresses at the same time.
+    """
+    host, port = address
+    infos = addresses(host, port)
+    if not infos:
+        raise _socket.error("getaddrinfo returns an empty list")
+    stagger = getattr(settings, 'PROBE_CONNECT_STAGGER', CONNECT_STAGGER)
+    lock = threading.Lock()
+    # The winning socket, then False once the race is over.
+    winner = [None]
+    # The sockets still connecting.
+    pending = []
+    finished = Queue.Queue()
+    attempts = []
+
+    def attempt(info, record):
+        family, socktype, proto, canonname, sockaddr = info
+        sock = None
+        try:
+            sock = _socket.socket(family, socktype, proto)
+            with lock:
+                if winner[0] is False:
+                    # Started as the race ended.
+                    sock.close()
+                    return
+                pending.append(sock)
+            sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+        except Exception, e:
+            with lock:
+                over = winner[0] is False
+                if sock in pending:
+                    pending.remove(sock)
+            if sock is not None:
+                sock.close()
+            if not over:
+                record["result"] = "failed"
+                record["error"] = str(e) or e.__class__.__name__
+            finished.put(e)
+            return
+        with lock:
+            pending.remove(sock)
+            if winner[0] is None:
+                winner[0] = sock
+                record["result"] = "connected"
+            else:
+                sock.close()
+        finished.put(None)
+
+    end = time.time() + timeout
+    started = running = 0
+    error = _socket.timeout("timed out")
+    while time.time() < end:
+        if started < len(infos):
+            info = infos[started]
+            record = {"host": host, "port": port, "address": info[4][0],
+                      "family": "IPv6" if info[0] == _socket.AF_INET6
+                                else "IPv4",
+                      "result": "abandoned"}
+            attempts.append(record)
+            thread = threading.Thread(target=attempt, args=(info, record),
+                                      name="connect %s" % (info[4][0],))
+            thread.daemon = True
+            thread.start()
+            started += 1
+            running += 1
+        wait = end - time.time()
+        if started < len(infos):
+            wait = min(wait, stagger)
+        try:
+            result = finished.get(True, max(wait, 0))
+        except Queue.Empty:
+            continue
+        running -= 1
+        if result is None:
+            break
+        error = result
+        if not running and started == len(infos):
+            break
+    with lock:
+        sock = winner[0]
+        winner[0] = False
+        abandoned = list(pending)
+    for other in abandoned:
+        # Stops the attempt, which closes it.
+        try:
+            other.shutdown(_socket.SHUT_RDWR)
+        except _socket.error:
+            pass
+    report([dict(record) for record in attempts])
+    if not sock:
+        raise error
+    return sock
+
+
+def create_connection(address, timeout=None, source_address=None):
+    sock = connect(address, step_timeout("connect", timeout), source_address)
+    sock.settimeout(step_timeout("read"))
+    return sock
+
+
+def wrap_socket(sock, *args, **kwargs):
+    sock.settimeout(step_timeout("tls"))
+    sock = _ssl.wrap_socket(sock, *args, **kwargs)
+    sock.settimeout(step_timeout("read"))
+    return sock
+
+
+def _command(sock):
+    """
+    Give the next command of a probe connection its own read timeout.
+    """
+    if sock:
+        sock.settimeout(step_timeout("read"))
+
+
+class SMTP(smtplib.SMTP):
+    """
+    smtplib.SMTP with the probe timeouts.
+    """
+
+    def _get_socket(self, host, port, timeout):
+        return create_connection((host, port), timeout)
+
+    def send(self, str):
+        _command(getattr(self, 'sock', None))
+        smtplib.SMTP.send(self, str)
+
+    def starttls(self, keyfile=None, certfile=None):
+        """
+        Same as smtplib.SMTP.starttls, with the TLS handshake timeout.
+        """
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("starttls"):
+            raise smtplib.SMTPException("STARTTLS extension not supported "
+                                        "by server.")
+        (resp, reply) = self.docmd("STARTTLS")
+        if resp != 220:
+            raise smtplib.SMTPResponseException(resp, reply)
+        self.sock = wrap_socket(self.sock, keyfile, certfile)
+        self.file = smtplib.SSLFakeFile(self.sock)
+        self.helo_resp = None
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = 0
+        return (resp, reply)
+
+
+class SMTP_SSL(smtplib.SMTP_SSL):
+    """
+    smtplib.SMTP_SSL with the probe timeouts.
+    """
+
+    def _get_socket(self, host, port, timeout):
+        sock = wrap_socket(create_connection((host, port), timeout),
+                           self.keyfile, self.certfile)
+        self.file = smtplib.SSLFakeFile(sock)
+        return sock
+
+    def send(self, str):
+        _command(getattr(self, 'sock', None))
+        smtplib.SMTP_SSL.send(self, str)
+
+
+class IMAP4(imaplib.IMAP4):
+    """
+    imaplib.IMAP4 with the probe timeouts.
+    """
+
+    def open(self, host='', port=imaplib.IMAP4_PORT):
+        self.host = host
+        self.port = port
+        self.sock = create_connection((host, port))
+        self.file = self.sock.makefile('rb')
+
+    def send(self, data):
+        _command(self.sock)
+        imaplib.IMAP4.send(self, data)
+
+
+class IMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    imaplib.IMAP4_SSL with the probe timeouts.
+    """
+
+    def open(self, host='', port=imaplib.IMAP4_SSL_PORT):
+        self.host = host
+        self.port = port
+        self.sock = create_connection((host, port))
+        self.sslobj = wrap_socket(self.sock, self.keyfile, self.certfile)
+        self.file = self.sslobj.makefile('rb')
+
+    def send(self, data):
+        _command(self.sock)
+        imaplib.IMAP4_SSL.send(self, data)
+
+
+class POP3(poplib.POP3):
+    """
+    poplib.POP3 with the probe timeouts.
+    """
+
+    def __init__(self, host, port=poplib.POP3_PORT,
+                 timeout=_socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.sock = create_connection((host, port), timeout)
+        self.file = self.sock.makefile('rb')
+        self._debugging = 0
+        self.welcome = self._getresp()
+
+    def _putline(self, line):
+        _command(self.sock)
+        poplib.POP3._putline(self, line)
+
+
+class POP3_SSL(poplib.POP3_SSL):
+    """
+    poplib.POP3_SSL with the probe timeouts.
+    """
+
+    def __init__(self, host, port=poplib.POP3_SSL_PORT, keyfile=None,
+                 certfile=None):
+        self.host = host
+        self.port = port
+        self.keyfile = keyfile
+        self.certfile = certfile
+        self.buffer = ""
+        self.sock = create_connection((host, port))
+        self.file = self.sock.makefile('rb')
+        self.sslobj = wrap_socket(self.sock, self.keyfile, self.certfile)
+        self._debugging = 0
+        self.welcome = self._getresp()
+
+    def _putline(self, line):
+        _command(self.sock)
+        poplib.POP3_SSL._putline(self, line)
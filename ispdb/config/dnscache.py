@@ -0,0 +1,97 @@
+"""
+This file contains the resolver the sanity checks use for their NS and MX
+lookups. Answers are kept in the cache named by settings.DNS_CACHE (shared by
+every process) for as long as their TTL says. Names which don't exist or have
+no records of the asked type are remembered for settings.DNS_NEGATIVE_TTL
+seconds.
+"""
+
+import copy
+import time
+
+import dns.resolver
+from django.conf import settings
+
+from ispdb.cache import open_cache
+from ispdb.config import deadlines
+
+# Seconds used when the settings don't say otherwise.
+NEGATIVE_TTL = 300
+MAX_TTL = 86400
+
+
+def dns_lookup(name, rdtype):
+    """
+    Look name up in the DNS. Return the text of the records of the answer
+    and its TTL, or raise NXDOMAIN or NoAnswer. Inside deadlines.budget(),
+    the lookup gives up at the end of the budget.
+    """
+    resolver = dns.resolver.get_default_resolver()
+    end = deadlines.deadline()
+    if end is not None:
+        # The default resolver is shared by the threads, bound a copy.
+        resolver = copy.copy(resolver)
+        resolver.lifetime = min(resolver.lifetime,
+                                max(end - time.time(), 0.001))
+        resolver.timeout = min(resolver.timeout, resolver.lifetime)
+    answer = resolver.query(name, rdtype)
+    return ([rdata.to_text() for rdata in answer], answer.rrset.ttl)
+
+
+class CachingResolver(object):
+    """
+    Answers lookups from the cache, or with lookup (dns_lookup by default)
+    when they aren't cached.
+    """
+
+    def __init__(self, lookup=None):
+        self.lookup = lookup
+
+    def _cache(self):
+        # Cache clients can't always be shared between threads, get one for
+        # each use.
+        return open_cache(getattr(settings, 'DNS_CACHE', 'default'))
+
+    def _count(self, cache, counter):
+        key = 'dns:%s' % counter
+        cache.add(key, 0, timeout=MAX_TTL)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # It expired since the add.
+            cache.set(key, 1, timeout=MAX_TTL)
+
+    def query(self, name, rdtype):
+        """
+        Return the text of the records of the given type for name, an empty
+        list if there are none or the lookup failed.
+        """
+        cache = self._cache()
+        key = 'dns:%s:%s' % (rdtype, name.lower().rstrip('.'))
+        records = cache.get(key)
+        if records is not None:
+            self._count(cache, 'hits')
+            return records
+        self._count(cache, 'misses')
+        lookup = self.lookup or dns_lookup
+        try:
+            records, ttl = lookup(name, rdtype)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            records = []
+            ttl = getattr(settings, 'DNS_NEGATIVE_TTL', NEGATIVE_TTL)
+        except Exception:
+            # Timeouts and the like are worth trying again.
+            return []
+        if ttl > 0:
+            cache.set(key, records, timeout=min(ttl, MAX_TTL))
+        return records
+
+    def stats(self):
+        """
+        Return the number of lookups answered from the cache and not.
+        """
+        cache = self._cache()
+        return {'hits': cache.get('dns:hits', 0),
+                'misses': cache.get('dns:misses', 0)}
+
+resolver = CachingResolver()
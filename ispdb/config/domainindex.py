@@ -0,0 +1,113 @@
+"""
+This file contains the in-process index used by export_xml to resolve a mail
+domain to its configuration without going to the database. It is loaded once
+per process.
+
+Whenever a domain or configuration changes, the handlers in
+ispdb.config.signals store a new generation token in the cache shared by the
+processes (DOMAIN_INDEX_CACHE). Lookups compare it with the token the index
+was loaded under and reload the index when they differ, so every process sees
+the change within DOMAIN_INDEX_POLL seconds: the token is read again at most
+that often, sparing most requests a read of the shared cache. The process
+making the change sees it at once. The index is also reloaded after
+DOMAIN_INDEX_MAX_AGE seconds, in case the token was lost.
+
+Domain names are matched without regard to case, as DNS does.
+"""
+
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from ispdb.config.models import Domain
+
+# Seconds after which the index is reloaded from the database, and between
+# two reads of the generation token.
+DEFAULT_MAX_AGE = 300
+DEFAULT_POLL = 1
+# The shared cache key of the generation token.
+GENERATION_KEY = 'domainindex:generation'
+
+
+class DomainIndex(object):
+    """
+    Map domain names to the id of their configuration.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._domains = None
+        self._loaded = 0
+        self._checked = 0
+        self._generation = None
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(getattr(settings, 'DOMAIN_INDEX_CACHE',
+                                            'shared'))
+        return self._cache
+
+    def load(self):
+        """
+        (Re)build the index from the Domain table and return it.
+        """
+        # Read the token first, a change made while loading is then picked
+        # up by the next lookup.
+        checked = time.time()
+        generation = self.cache.get(GENERATION_KEY)
+        domains = {}
+        for name, config_id in Domain.objects.values_list('name', 'config'):
+            domains[name.lower()] = config_id
+        with self._lock:
+            self._domains = domains
+            self._loaded = time.time()
+            self._checked = checked
+            self._generation = generation
+        return domains
+
+    def changed(self):
+        """
+        Make every process, this one included, reload its index before its
+        next lookup.
+        """
+        self.cache.set(GENERATION_KEY, uuid.uuid4().hex)
+        with self._lock:
+            self._domains = None
+
+    def _table(self):
+        max_age = getattr(settings, 'DOMAIN_INDEX_MAX_AGE', DEFAULT_MAX_AGE)
+        poll = getattr(settings, 'DOMAIN_INDEX_POLL', DEFAULT_POLL)
+        now = time.time()
+        with self._lock:
+            domains = self._domains
+            generation = self._generation
+            check = now - self._checked >= poll
+        if check:
+            generation = self.cache.get(GENERATION_KEY)
+            with self._lock:
+                self._checked = now
+        with self._lock:
+            stale = (domains is None or generation != self._generation or
+                     now - self._loaded > max_age)
+        if stale:
+            return self.load()
+        return domains
+
+    def lookup(self, name):
+        """
+        Return the config id of a domain, or None if the domain is unknown.
+        "Example.com" and "example.com" are the same domain.
+        """
+        return self._table().get(name.lower())
+
+
+index = DomainIndex()
+
+
+def lookup(name):
+    return index.lookup(name)
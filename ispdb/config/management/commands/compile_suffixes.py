@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+
+from ispdb import publicsuffix
+
+
+class Command(NoArgsCommand):
+    help = ("Compile the public suffix list snapshot into the indexes the "
+            "processes map. Run it again after updating the snapshot.")
+
+    def handle_noargs(self, **options):
+        for private in (False, True):
+            rules = publicsuffix.read_rules(private=private)
+            path = publicsuffix.compiled_path(private)
+            publicsuffix.compile_index(rules, path)
+            self.stdout.write("Wrote %d rules to %s.\n" % (len(rules), path))
@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ispdb.config import archive, serializers
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--format', dest='format', default='tgz',
+            choices=sorted(archive.FORMATS.keys()),
+            help='Archive format: tgz or zip (default tgz).'),
+        make_option('-s', '--since', dest='since', default=None,
+            help='Only export the documents changed after this time, given '
+                 'in seconds since the epoch or as an ISO 8601 date.'),
+        make_option('-V', '--data-version', dest='versions', action='append',
+            default=[],
+            help='Format version to export (may be repeated, default all).'),
+        make_option('-o', '--output', dest='output', default=None,
+            help='File to write the archive to (default stdout).'),
+    )
+    help = ("Write every approved configuration into a single archive, one "
+            "file per format version and domain.")
+
+    def handle(self, *args, **options):
+        since = options.get('since')
+        if since:
+            try:
+                since = archive.parse_since(since)
+            except ValueError, e:
+                raise CommandError(str(e))
+        versions = options.get('versions')
+        for version in versions:
+            if serializers.get(version) is None:
+                raise CommandError("Unknown format version %s" % version)
+        if options.get('output'):
+            output = open(options['output'], 'wb')
+        else:
+            output = self.stdout
+        try:
+            for chunk in archive.generate(options['format'], since, versions):
+                output.write(chunk)
+        finally:
+            if output is not self.stdout:
+                output.close()
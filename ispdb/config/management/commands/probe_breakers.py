@@ -0,0 +1,31 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ispdb.config import breakers
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', dest='reset', action='append', default=[],
+            metavar='HOST:PORT',
+            help='Close the breaker of a server (may be repeated).'),
+    )
+    help = ("List the servers whose sanity check probes timed out lately, "
+            "and the state of their circuit breakers.")
+
+    def handle(self, *args, **options):
+        server_breakers = breakers.Breakers()
+        for server in options['reset']:
+            hostname, _, port = server.rpartition(':')
+            if not hostname or not port.isdigit():
+                raise CommandError("Expected HOST:PORT, got %s" % server)
+            server_breakers.reset(hostname, int(port))
+        for state in server_breakers.states():
+            opened = ""
+            if state["opened"] is not None:
+                opened = " opened %ds ago" % (time.time() - state["opened"])
+            self.stdout.write("%s:%s %s, %d timeouts%s\n" %
+                              (state["hostname"], state["port"],
+                               state["state"], state["failures"], opened))
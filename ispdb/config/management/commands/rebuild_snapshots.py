@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from ispdb.config import snapshots
+
+
+class Command(NoArgsCommand):
+    help = ("Rebuild the stored XML documents of every approved "
+            "configuration. Run it once after syncdb to fill the store.")
+
+    def handle_noargs(self, **options):
+        count = snapshots.rebuild_all()
+        self.stdout.write("Rebuilt the XML documents of %d configurations.\n"
+                          % count)
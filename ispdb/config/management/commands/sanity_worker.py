@@ -0,0 +1,44 @@
+import threading
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ispdb.config import sanityjobs
+
+
+def _work(once, poll):
+    try:
+        sanityjobs.work(once=once, poll=poll)
+    finally:
+        # Each thread has its own database connection.
+        connection.close()
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--workers', dest='workers', type='int',
+            default=getattr(settings, 'SANITY_JOB_WORKERS', 2),
+            help='Number of jobs run at once (default '
+                 'settings.SANITY_JOB_WORKERS).'),
+        make_option('--poll', dest='poll', type='float', default=1,
+            help='Seconds between looks for new jobs (default 1).'),
+        make_option('--once', dest='once', action='store_true',
+            default=False,
+            help='Exit once there are no jobs left instead of waiting for '
+                 'new ones.'),
+    )
+    help = "Run the sanity checks queued from the details pages."
+
+    def handle(self, *args, **options):
+        threads = [threading.Thread(target=_work,
+                                    args=(options['once'], options['poll']))
+                   for i in range(options['workers'])]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Join with a timeout so Ctrl-C still stops the command.
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
@@ -0,0 +1,65 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import simplejson
+
+from ispdb.config import sweep
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-c', '--config', dest='ids', action='append', type='int',
+            default=[],
+            help='Id of a configuration to check (may be repeated, default '
+                 'every approved one).'),
+        make_option('--host', dest='host', default=None,
+            help='Only check the configurations using this server.'),
+        make_option('-w', '--workers', dest='workers', type='int',
+            default=getattr(settings, 'SWEEP_WORKERS', sweep.WORKERS),
+            help='Number of configurations checked at once (default '
+                 'settings.SWEEP_WORKERS).'),
+        make_option('--host-concurrency', dest='host_concurrency',
+            type='int', default=None,
+            help='Number of configurations using a server checked at once '
+                 '(default settings.SWEEP_HOST_CONCURRENCY).'),
+        make_option('--host-interval', dest='host_interval', type='float',
+            default=None,
+            help='Seconds between the checks of a server (default '
+                 'settings.SWEEP_HOST_INTERVAL).'),
+        make_option('--state', dest='state', default=None,
+            help='File recording the progress of the sweep. Run again with '
+                 'the same file to resume an interrupted sweep.'),
+        make_option('-o', '--output', dest='output', default=None,
+            help='File to write the JSON report to (default stdout).'),
+    )
+    help = ("Check every approved configuration again and report the ones "
+            "whose servers stopped answering or lost TLS.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        configs = sweep.approved_configs(options['ids'], options['host'])
+        limiter = sweep.HostLimiter(options['host_concurrency'],
+                                    options['host_interval'])
+        checked = [0]
+
+        def progress(result):
+            checked[0] += 1
+            if verbosity >= 2 or (verbosity and result["problems"]):
+                problems = ", ".join("%(server)s %(hostname)s: %(problem)s" %
+                                     problem for problem in result["problems"])
+                self.stderr.write("%d %s\n" % (result["id"], problems or "ok"))
+
+        results = sweep.sweep(configs, options['workers'], limiter,
+                              options['state'], progress)
+        data = simplejson.dumps(sweep.report(results), indent=2)
+        if options.get('output'):
+            with open(options['output'], 'w') as output:
+                output.write(data + "\n")
+        else:
+            self.stdout.write(data + "\n")
+        if verbosity:
+            self.stderr.write("Checked %d configurations (%d resumed), %d "
+                             "with problems.\n" %
+                             (len(results), len(results) - checked[0],
+                              len(sweep.report(results)["problems"])))
@@ -236,3 +236,87 @@ EnableURL._meta.get_field('url').verbose_name = ("URL of the page with enable "
 class EnableURLInst(CommonURLDesc):
     enableurl = models.ForeignKey(EnableURL, related_name="instructions")
 EnableURLInst._meta.get_field('description').verbose_name = ('Instruction')
+
+
+class ConfigSnapshot(models.Model):
+    """
+    The serialized XML of an approved Config for one format version. Rows
+    are kept up to date by the handlers in ispdb.config.signals so that
+    export_xml can serve them without building the document.
+    last_update_datetime is the last time the document itself changed.
+    """
+    config = models.ForeignKey(Config, related_name="snapshots")
+    version = models.CharField(max_length=10)
+    xml = models.TextField()
+    etag = models.CharField(max_length=40)
+    last_update_datetime = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('config', 'version'),)
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.config_id, self.version)
+
+
+class RemovedDomain(models.Model):
+    """
+    A domain name taken away from its configuration (deleted, renamed or
+    moved to another configuration). Recorded by the handlers in
+    ispdb.config.signals so the archive export can tell mirrors which
+    domains to drop.
+    """
+    name = models.CharField(max_length=100)
+    removed_datetime = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+class SanityJob(models.Model):
+    """
+    A run of the sanity checks of a Config, queued by the sanity view and
+    carried out by the sanity_worker command. errors and warnings hold the
+    JSON lists of messages once the job is done.
+    """
+    config = models.ForeignKey(Config, related_name="sanity_jobs")
+    STATUS_CHOICES = [
+        ("queued", "queued"),
+        ("running", "running"),
+        ("done", "done"),
+        ("failed", "failed"),
+    ]
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default="queued", db_index=True)
+    errors = models.TextField(blank=True)
+    warnings = models.TextField(blank=True)
+    created_datetime = models.DateTimeField(auto_now_add=True)
+    started_datetime = models.DateTimeField(null=True, blank=True)
+    finished_datetime = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.config_id, self.status)
+
+
+class SanityResult(models.Model):
+    """
+    The results of a run of the sanity checks of a Config, kept so the
+    details page can show them without probing the servers again. errors
+    and warnings hold JSON lists of messages, capabilities the JSON list of
+    what the servers reported for each socket type checked.
+    """
+    config = models.ForeignKey(Config, related_name="sanity_results")
+    created_datetime = models.DateTimeField(auto_now_add=True, db_index=True)
+    errors = models.TextField(blank=True)
+    warnings = models.TextField(blank=True)
+    capabilities = models.TextField(blank=True)
+
+    class Meta:
+        get_latest_by = "created_datetime"
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.config_id, self.created_datetime)
+
+
+# Connect the handlers which keep ConfigSnapshot rows in sync. This has to
+# happen after all of the models above are defined.
+import ispdb.config.signals
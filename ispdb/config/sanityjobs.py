@@ -0,0 +1,173 @@
+"""
+This file contains the queue of sanity check runs. The sanity view submits
+jobs, the sanity_worker command runs them and the sanity_job view reports
+their results. Jobs are SanityJob rows, so no message broker is needed.
+The results of each run are also kept as a SanityResult, which the sanity
+view returns instead of queueing a job until it is SANITY_RESULT_MAX_AGE
+hours old.
+"""
+
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import simplejson, timezone
+
+from ispdb.config import configChecks
+from ispdb.config.models import Config, SanityJob, SanityResult
+
+log = logging.getLogger(__name__)
+
+ACTIVE = ("queued", "running")
+# Hours a SanityResult is used for when the settings don't say otherwise.
+MAX_AGE = 24
+
+
+def submit(config):
+    """
+    Queue a run of the sanity checks of config and return its job. If one
+    is queued or running for config already, return that one instead.
+    """
+    with transaction.commit_on_success():
+        # Lock the config row, so that concurrent submissions for it queue
+        # a single job.
+        Config.objects.select_for_update().filter(pk=config.pk).exists()
+        jobs = SanityJob.objects.filter(config=config,
+                                        status__in=ACTIVE).order_by('id')[:1]
+        if jobs:
+            return jobs[0]
+        return SanityJob.objects.create(config=config)
+
+
+def _claimable():
+    # Jobs whose worker went away are given to another one once they ran
+    # for much longer than the checks are allowed to.
+    deadline = getattr(settings, 'SANITY_CHECK_DEADLINE',
+                       configChecks.DEADLINE)
+    cutoff = timezone.now() - timedelta(seconds=2 * deadline)
+    return SanityJob.objects.filter(Q(status="queued") |
+                                    Q(status="running",
+                                      started_datetime__lt=cutoff))
+
+
+def claim():
+    """
+    Mark the oldest queued job as running and return it, or return None if
+    there is nothing to run. Several workers can claim jobs at once, each job
+    goes to one of them.
+    """
+    while True:
+        ids = _claimable().order_by('id').values_list('id', flat=True)[:10]
+        if not ids:
+            return None
+        for id in ids:
+            # Only the worker whose update matched the row gets the job.
+            if _claimable().filter(pk=id).update(
+                    status="running", started_datetime=timezone.now()):
+                return SanityJob.objects.get(pk=id)
+
+
+def run(job):
+    """
+    Run the sanity checks of a claimed job and store their results. A job
+    which can't be run or whose results can't be stored fails.
+    """
+    try:
+        config = job.config
+        domains = config.domains.all() or config.domainrequests.all()
+        details = {}
+        errors, warnings = configChecks.do_checks(config, domains, details)
+        save_result(config, errors, warnings, details["capabilities"])
+        status = "done"
+    except Exception, e:
+        log.exception("Sanity check job %s failed", job.pk)
+        transaction.rollback_unless_managed()
+        errors, warnings = ["Error running sanity checks: %s" % e], []
+        status = "failed"
+    SanityJob.objects.filter(pk=job.pk).update(
+            status=status, errors=simplejson.dumps(errors),
+            warnings=simplejson.dumps(warnings),
+            finished_datetime=timezone.now())
+
+
+def work(once=False, poll=1):
+    """
+    Run queued jobs until there are none left if once is true, forever
+    otherwise, looking for new ones every poll seconds. Errors are logged
+    and don't stop the worker, a job left running is claimed again once it
+    is stale.
+    """
+    while True:
+        # End the transaction of the previous look, or the database may keep
+        # showing this worker the jobs table as it first saw it.
+        transaction.commit_unless_managed()
+        try:
+            job = claim()
+            if job is not None:
+                run(job)
+                continue
+        except Exception:
+            log.exception("Sanity check worker error")
+            transaction.rollback_unless_managed()
+        if once:
+            return
+        time.sleep(poll)
+
+
+def result(job):
+    """
+    Return the state of a job, with its errors and warnings once it is over.
+    """
+    data = {"id": job.id, "status": job.status}
+    if job.status not in ACTIVE:
+        data["errors"] = simplejson.loads(job.errors or "[]")
+        data["warnings"] = simplejson.loads(job.warnings or "[]")
+    return data
+
+
+def save_result(config, errors, warnings, capabilities):
+    """
+    Store the results of a run of the sanity checks of config.
+    """
+    return SanityResult.objects.create(
+            config=config, errors=simplejson.dumps(errors),
+            warnings=simplejson.dumps(warnings),
+            capabilities=simplejson.dumps(capabilities))
+
+
+def latest(config):
+    """
+    Return the most recent SanityResult of config, or None if the checks
+    never ran.
+    """
+    try:
+        return config.sanity_results.latest()
+    except SanityResult.DoesNotExist:
+        return None
+
+
+def is_fresh(sanity_result):
+    """
+    Return whether sanity_result is recent enough to be shown instead of
+    running the checks again.
+    """
+    if sanity_result is None:
+        return False
+    max_age = getattr(settings, 'SANITY_RESULT_MAX_AGE', MAX_AGE)
+    return (timezone.now() - sanity_result.created_datetime <
+            timedelta(hours=max_age))
+
+
+def stored(sanity_result):
+    """
+    Return a SanityResult in the same form as the result of a finished job.
+    """
+    return {"status": "done",
+            "checked": sanity_result.created_datetime.isoformat(),
+            "errors": simplejson.loads(sanity_result.errors or "[]"),
+            "warnings": simplejson.loads(sanity_result.warnings or "[]"),
+            "capabilities":
+                simplejson.loads(sanity_result.capabilities or "[]")}
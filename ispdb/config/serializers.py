@@ -1,179 +1,223 @@
 # -*- coding: utf-8 -*-
 
+import operator
+
 import lxml.etree as ET
 from StringIO import StringIO
 
-from ispdb.config.models import Domain, DomainRequest
+from django.db.models import BooleanField
 
-# The serializers in reverse order, newest at the top.
+from ispdb.config.models import Config
 
+# The related rows the serializers read, see prefetch().
+PREFETCH = (
+    "domains",
+    "domainrequests",
+    "enableurl_set__instructions",
+    "docurl_set__descriptions",
+)
 
-def xmlOneDotOne(data):
+
+def prefetch(queryset):
     """
-    Return the configuration using the XML document that Thunderbird is
-    expecting.
+    Return the Config queryset with the related rows the serializers need
+    prefetched, so serializing one of its configs (under any number of
+    versions) doesn't cost any further queries.
     """
-    desiredOutput = {
-      "display_name": "displayName",
-      "display_short_name": "displayShortName",
-      "incoming_hostname": "hostname",
-      "incoming_port": "port",
-      "incoming_socket_type": "socketType",
-      "incoming_username_form": "username",
-      "incoming_authentication": "authentication",
-      "outgoing_hostname": "hostname",
-      "outgoing_port": "port",
-      "outgoing_socket_type": "socketType",
-      "outgoing_username_form": "username",
-      "outgoing_authentication": "authentication",
-    }
-    incoming = None
-    outgoing = None
-    config = ET.Element("clientConfig")
-    config.attrib["version"] = "1.1"
-    emailProvider = ET.SubElement(config, "emailProvider")
-    qs = Domain.objects.filter(config=data) or (
-        DomainRequest.objects.filter(config=data))
-    for domain in qs:
-        if not data.email_provider_id:
-            data.email_provider_id = domain.name
-        ET.SubElement(emailProvider, "domain").text = domain.name
-    emailProvider.attrib["id"] = data.email_provider_id
-    for field in data._meta.fields:
-        if field.name not in desiredOutput:
-            continue
-        if field.name.startswith("incoming"):
-            if incoming is None:
-                incoming = ET.SubElement(emailProvider, "incomingServer")
-                incoming.attrib["type"] = data.incoming_type
-            name = field.name
-            currParent = incoming
-        elif field.name.startswith("outgoing"):
-            if outgoing is None:
-                outgoing = ET.SubElement(emailProvider, "outgoingServer")
-                outgoing.attrib["type"] = "smtp"
-            name = field.name
-            currParent = outgoing
-        else:
-            name = field.name
-            currParent = emailProvider
-        if (name == "incoming_username_form") and (
-                data.incoming_username_form == ""):
-            data.incoming_username_form = data.outgoing_username_form
-        name = desiredOutput[name]
-        e = ET.SubElement(currParent, name)
-        text = getattr(data, field.name)
-
-        if type(text) is bool:
-            # Force boolean values to use lowercase.
-            text = unicode(text).lower()
-        else:
-            # Force other values to be converted into unicode strings.
-            text = unicode(text)
-        e.text = text
-    # EnableURL
-    for enableurl in data.enableurl_set.all():
-        enable = ET.SubElement(emailProvider, "enable")
-        enable.attrib["visiturl"] = enableurl.url
-        for inst in enableurl.instructions.all():
-            d = ET.SubElement(enable, "instruction")
-            d.attrib["lang"] = inst.language
-            d.text = unicode(inst.description)
-    # DocURL
-    for docurl in data.docurl_set.all():
-        doc = ET.SubElement(emailProvider, "documentation")
-        doc.attrib["url"] = docurl.url
-        for desc in docurl.descriptions.all():
-            d = ET.SubElement(doc, "descr")
-            d.attrib["lang"] = desc.language
-            d.text = unicode(desc.description)
+    return queryset.prefetch_related(*PREFETCH)
 
-    retval = StringIO("w")
-    xml = ET.ElementTree(config)
-    xml.write(retval, encoding="UTF-8", xml_declaration=True)
-    return retval.getvalue()
+
+def record(config):
+    """
+    Return the data the serializers need from a Config as a plain dictionary.
+    Records can be kept around and serialized without touching the database.
+    """
+    data = dict((field.attname, getattr(config, field.attname))
+                for field in config._meta.fields)
+    data["domains"] = [domain.name for domain in config.domains.all()]
+    data["domainrequests"] = [domain.name for domain in
+                              config.domainrequests.all()]
+    data["enableurls"] = [(enableurl.url,
+                           [(inst.language, inst.description)
+                            for inst in enableurl.instructions.all()])
+                          for enableurl in config.enableurl_set.all()]
+    data["docurls"] = [(docurl.url,
+                        [(desc.language, desc.description)
+                         for desc in docurl.descriptions.all()])
+                       for docurl in config.docurl_set.all()]
+    return data
+
+
+# Schemas.
+#
+# A schema lists the (Config field, element name) pairs of a version in
+# document order. Fields starting with incoming_ or outgoing_ go in the
+# incomingServer or outgoingServer element, the others straight under
+# emailProvider. _compile turns a schema into the list of steps a serializer
+# walks through, so the fields are only looked at once, at import.
+
+def _text(value):
+    # Force values to be converted into unicode strings.
+    return unicode(value)
+
+
+def _boolean(value):
+    # Force boolean values to use lowercase.
+    return unicode(value).lower()
+
+
+def _translate(convert, values):
+    return lambda value: values.get(convert(value), convert(value))
+
+
+def _incoming_username_form(data):
+    # Fall back to the outgoing username if there is no incoming one.
+    if data["incoming_username_form"] == "":
+        return data["outgoing_username_form"]
+    return data["incoming_username_form"]
+
+# The element of each server, and how to get its type.
+_servers = {
+    "incoming": ("incomingServer", operator.itemgetter("incoming_type")),
+    "outgoing": ("outgoingServer", lambda data: "smtp"),
+}
 
 
-def xmlOneDotZero(data):
+def _compile(schema, values=None):
     """
-    Return the configuration using the XML document that Thunderbird is
-    expecting.
+    Compile a schema into a list of (server, elements) steps, where server is
+    None or one of the _servers, and elements a list of (element name,
+    getter, converter) tuples. values maps element names to a dictionary
+    translating their text.
     """
-    desiredOutput = {
-      "display_name": "displayName",
-      "display_short_name": "displayShortName",
-      "incoming_hostname": "hostname",
-      "incoming_port": "port",
-      "incoming_socket_type": "socketType",
-      "incoming_username_form": "username",
-      "incoming_authentication": "authentication",
-      "outgoing_hostname": "hostname",
-      "outgoing_port": "port",
-      "outgoing_socket_type": "socketType",
-      "outgoing_username_form": "username",
-      "outgoing_authentication": "authentication",
-      "outgoing_add_this_server": "addThisServer",
-      "outgoing_use_global_preferred_server": "useGlobalPreferredServer",
-    }
-    authentication_values = {
-      "password-cleartext": "plain",
-      "password-encrypted": "secure",
-      "client-ip-address": "none",
-      "smtp-after-pop": "none",
-    }
-    incoming = None
-    outgoing = None
-    config = ET.Element("clientConfig")
-    config.attrib["version"] = "1.0"
-    emailProvider = ET.SubElement(config, "emailProvider")
-    for domain in Domain.objects.filter(config=data):
-        ET.SubElement(emailProvider, "domain").text = domain.name
-        if not data.email_provider_id:
-            data.email_provider_id = domain.name
-    emailProvider.attrib["id"] = data.email_provider_id
-    for field in data._meta.fields:
-        if field.name not in desiredOutput:
-            continue
-        if field.name.startswith("incoming"):
-            if incoming is None:
-                incoming = ET.SubElement(emailProvider, "incomingServer")
-                incoming.attrib["type"] = data.incoming_type
-            name = field.name
-            currParent = incoming
-        elif field.name.startswith("outgoing"):
-            if outgoing is None:
-                outgoing = ET.SubElement(emailProvider, "outgoingServer")
-                outgoing.attrib["type"] = "smtp"
-            name = field.name
-            currParent = outgoing
+    steps = []
+    for name, tag in schema:
+        field = Config._meta.get_field(name)
+        server = _servers.get(name.split("_")[0])
+        if not steps or steps[-1][0] is not server:
+            steps.append((server, []))
+        if name == "incoming_username_form":
+            getter = _incoming_username_form
         else:
-            name = field.name
-            currParent = emailProvider
-        if (name == "incoming_username_form") and (
-                data.incoming_username_form == ""):
-            data.incoming_username_form = data.outgoing_username_form
-        name = desiredOutput[name]
-        e = ET.SubElement(currParent, name)
-        text = getattr(data, field.name)
-
-        if type(text) is bool:
-            # Force boolean values to use lowercase.
-            text = unicode(text).lower()
+            getter = operator.itemgetter(field.attname)
+        if isinstance(field, BooleanField):
+            convert = _boolean
         else:
-            # Force other values to be converted into unicode strings.
-            text = unicode(text)
+            convert = _text
+        if values and tag in values:
+            convert = _translate(convert, values[tag])
+        steps[-1][1].append((tag, getter, convert))
+    return steps
+
 
-        # Fix up the data to make it 1.0 compliant.
-        if name == "authentication":
-            text = authentication_values.get(text, text)
+def _add_urls(parent, tag, attrib, child, urls):
+    for url, descriptions in urls:
+        element = ET.SubElement(parent, tag)
+        element.attrib[attrib] = url
+        for language, description in descriptions:
+            d = ET.SubElement(element, child)
+            d.attrib["lang"] = language
+            d.text = unicode(description)
 
-        e.text = text
+
+def _serialize(data, version, steps, domains, urls):
+    """
+    Return the XML document of a Config or a record, built by walking the
+    compiled steps of a version.
+    """
+    if not isinstance(data, dict):
+        data = record(data)
+    config = ET.Element("clientConfig")
+    config.attrib["version"] = version
+    emailProvider = ET.SubElement(config, "emailProvider")
+    names = domains(data)
+    for name in names:
+        ET.SubElement(emailProvider, "domain").text = name
+    provider_id = data["email_provider_id"]
+    if not provider_id and names:
+        provider_id = names[0]
+    emailProvider.attrib["id"] = provider_id
+    for server, elements in steps:
+        parent = emailProvider
+        if server is not None:
+            parent = ET.SubElement(emailProvider, server[0])
+            parent.attrib["type"] = server[1](data)
+        for tag, getter, convert in elements:
+            ET.SubElement(parent, tag).text = convert(getter(data))
+    if urls:
+        _add_urls(emailProvider, "enable", "visiturl", "instruction",
+                  data["enableurls"])
+        _add_urls(emailProvider, "documentation", "url", "descr",
+                  data["docurls"])
 
     retval = StringIO("w")
     xml = ET.ElementTree(config)
     xml.write(retval, encoding="UTF-8", xml_declaration=True)
     return retval.getvalue()
 
+
+_oneDotOne = _compile([
+    ("display_name", "displayName"),
+    ("display_short_name", "displayShortName"),
+    ("incoming_hostname", "hostname"),
+    ("incoming_port", "port"),
+    ("incoming_socket_type", "socketType"),
+    ("incoming_username_form", "username"),
+    ("incoming_authentication", "authentication"),
+    ("outgoing_hostname", "hostname"),
+    ("outgoing_port", "port"),
+    ("outgoing_socket_type", "socketType"),
+    ("outgoing_username_form", "username"),
+    ("outgoing_authentication", "authentication"),
+])
+
+_oneDotZero = _compile([
+    ("display_name", "displayName"),
+    ("display_short_name", "displayShortName"),
+    ("incoming_hostname", "hostname"),
+    ("incoming_port", "port"),
+    ("incoming_socket_type", "socketType"),
+    ("incoming_username_form", "username"),
+    ("incoming_authentication", "authentication"),
+    ("outgoing_hostname", "hostname"),
+    ("outgoing_port", "port"),
+    ("outgoing_socket_type", "socketType"),
+    ("outgoing_username_form", "username"),
+    ("outgoing_authentication", "authentication"),
+    ("outgoing_add_this_server", "addThisServer"),
+    ("outgoing_use_global_preferred_server", "useGlobalPreferredServer"),
+], values={
+    # Fix up the data to make it 1.0 compliant.
+    "authentication": {
+        "password-cleartext": "plain",
+        "password-encrypted": "secure",
+        "client-ip-address": "none",
+        "smtp-after-pop": "none",
+    },
+})
+
+# The serializers in reverse order, newest at the top.
+
+
+def xmlOneDotOne(data):
+    """
+    Return the configuration (a Config or its record) using the XML document
+    that Thunderbird is expecting.
+    """
+    # Configurations which aren't approved yet list their requested domains.
+    return _serialize(data, "1.1", _oneDotOne,
+                      lambda data: data["domains"] or data["domainrequests"],
+                      urls=True)
+
+
+def xmlOneDotZero(data):
+    """
+    Return the configuration (a Config or its record) using the XML document
+    that Thunderbird is expecting.
+    """
+    return _serialize(data, "1.0", _oneDotZero,
+                      operator.itemgetter("domains"), urls=False)
+
 # This is the data format version, not the application version.
 # It only needs to change when the data format needs to change in a way
 # that breaks old clients, which are hopefully exceptional cases.
@@ -183,9 +227,19 @@ _serializers = {
     "1.1": xmlOneDotOne,
 }
 
+# The version served when the client doesn't ask for one.
+DEFAULT_VERSION = "1.0"
+
 
 def get(version):
-    # If there is no version requested, return the most recent version.
+    # If there is no version requested, return the default version.
     if version is None:
-        return xmlOneDotZero
+        version = DEFAULT_VERSION
     return _serializers.get(version, None)
+
+
+def versions():
+    """
+    Return the (version, serializer) pairs for every data format version.
+    """
+    return sorted(_serializers.items())
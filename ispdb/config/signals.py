@@ -0,0 +1,119 @@
+"""
+This file contains the signal handlers which keep the data derived from a
+configuration (its stored XML documents, the domain index, the cached pages)
+in step with the Config, Domain and URL rows it is built from.
+"""
+
+from django.conf import settings
+from django.contrib.comments.models import Comment
+from django.core.cache import get_cache
+from django.db.models import signals
+
+from ispdb.config import snapshots
+from ispdb.config.domainindex import index
+from ispdb.config.models import (Config, DocURL, DocURLDesc, Domain,
+    DomainRequest, EnableURL, EnableURLInst, Issue, RemovedDomain)
+
+
+def clear_cache():
+    """
+    Empty the cache the pages are kept in, some of them may show what changed.
+    This only starts a new generation of page keys (see ispdb.cache), the
+    rest of the shared cache is kept.
+    """
+    get_cache(settings.CACHE_MIDDLEWARE_ALIAS).clear()
+
+
+def config_changed(config_id):
+    """
+    Called whenever something that is part of a configuration changed.
+    """
+    if config_id is None:
+        return
+    snapshots.rebuild(config_id)
+    clear_cache()
+    index.changed()
+
+
+def _config_saved(sender, instance, raw=False, **kwargs):
+    # Fixtures are loaded with raw=True, their children may not exist yet.
+    if raw:
+        return
+    config_changed(instance.pk)
+
+
+def _domain_pre_save(sender, instance, raw=False, **kwargs):
+    # Remember the config the domain had, it may be moved to a different
+    # config. A name that is renamed or moved is gone from its config.
+    instance._old_config_id = None
+    if raw or instance.pk is None:
+        return
+    old = Domain.objects.filter(pk=instance.pk).values_list('name', 'config')
+    if old:
+        old_name, instance._old_config_id = old[0]
+        if (old_name != instance.name or
+                instance._old_config_id != instance.config_id):
+            RemovedDomain.objects.create(name=old_name)
+
+
+def _domain_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        # Let the index load the fixture data on its next lookup.
+        clear_cache()
+        index.changed()
+        return
+    old_config_id = getattr(instance, '_old_config_id', None)
+    if old_config_id is not None and old_config_id != instance.config_id:
+        config_changed(old_config_id)
+    config_changed(instance.config_id)
+
+
+def _domain_deleted(sender, instance, **kwargs):
+    RemovedDomain.objects.create(name=instance.name)
+    config_changed(instance.config_id)
+
+
+def _url_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    config_changed(instance.config_id)
+
+
+def _docurldesc_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # The DocURL may be gone already if it is being deleted along with its
+    # descriptions, its own handler takes care of that case.
+    config_id = DocURL.objects.filter(pk=instance.docurl_id).values_list(
+            'config', flat=True)
+    if config_id:
+        config_changed(config_id[0])
+
+
+def _enableurlinst_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    config_id = EnableURL.objects.filter(pk=instance.enableurl_id).values_list(
+            'config', flat=True)
+    if config_id:
+        config_changed(config_id[0])
+
+
+def _page_changed(sender, instance, **kwargs):
+    # Requested domains, issues and comments are only shown on the pages.
+    clear_cache()
+
+
+signals.post_save.connect(_config_saved, sender=Config)
+signals.pre_save.connect(_domain_pre_save, sender=Domain)
+signals.post_save.connect(_domain_saved, sender=Domain)
+signals.post_delete.connect(_domain_deleted, sender=Domain)
+for model in (DocURL, EnableURL):
+    signals.post_save.connect(_url_changed, sender=model)
+    signals.post_delete.connect(_url_changed, sender=model)
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(_docurldesc_changed, sender=DocURLDesc)
+    signal.connect(_enableurlinst_changed, sender=EnableURLInst)
+for model in (DomainRequest, Issue, Comment):
+    signals.post_save.connect(_page_changed, sender=model)
+    signals.post_delete.connect(_page_changed, sender=model)
@@ -0,0 +1,111 @@
+"""
+This file contains the store of pre-serialized XML documents for approved
+configurations. export_xml reads from it instead of serializing on every
+request; the handlers in ispdb.config.signals rebuild the entries of a
+configuration whenever it or one of its children changes.
+"""
+
+import hashlib
+
+from django.utils import timezone
+
+from ispdb.config import serializers
+from ispdb.config.models import Config, ConfigSnapshot
+
+
+def make_etag(xml):
+    """
+    Return the (unquoted) strong ETag of a serialized document.
+    """
+    return hashlib.sha1(xml).hexdigest()
+
+
+def rebuild(config_id):
+    """
+    Serialize the configuration under every format version and store the
+    documents which changed. Configurations that are not approved (or don't
+    exist anymore) have their documents removed instead.
+
+    Return a dictionary with the ETag of each stored version.
+    """
+    etags = {}
+    try:
+        # Load a fresh copy with the rows the serializers read prefetched.
+        config = serializers.prefetch(Config.objects).get(pk=config_id)
+    except Config.DoesNotExist:
+        return etags
+    if config.status != 'approved':
+        ConfigSnapshot.objects.filter(config=config).delete()
+        return etags
+    stored = dict(ConfigSnapshot.objects.filter(config=config).values_list(
+            'version', 'etag'))
+    now = timezone.now()
+    for version, serialize in serializers.versions():
+        xml = serialize(config)
+        etag = make_etag(xml)
+        etags[version] = etag
+        if stored.get(version) == etag:
+            continue
+        fields = {'xml': xml.decode('utf-8'),
+                  'etag': etag,
+                  'last_update_datetime': now}
+        if version in stored:
+            ConfigSnapshot.objects.filter(config=config,
+                    version=version).update(**fields)
+        else:
+            ConfigSnapshot.objects.create(config=config, version=version,
+                                          **fields)
+    return etags
+
+
+def rebuild_all():
+    """
+    Rebuild the documents of every approved configuration and remove the
+    ones left over from configurations which are not approved anymore.
+    """
+    ConfigSnapshot.objects.exclude(config__status='approved').delete()
+    ids = Config.objects.filter(status='approved').values_list('id',
+                                                                flat=True)
+    for config_id in ids:
+        rebuild(config_id)
+    return len(ids)
+
+
+def fetch(config_id, version=None):
+    """
+    Return the stored (XML document, ETag) pair of a configuration, or None
+    if there is no document stored for it.
+    """
+    if version is None:
+        version = serializers.DEFAULT_VERSION
+    row = ConfigSnapshot.objects.filter(config=config_id,
+            version=version).values_list('xml', 'etag')[:1]
+    if not row:
+        return None
+    xml, etag = row[0]
+    return (xml.encode('utf-8'), etag)
+
+
+def state(config_id, version=None):
+    """
+    Return the (ETag, last update) pair of the stored document of a
+    configuration, or None if there is no document stored for it.
+    """
+    if version is None:
+        version = serializers.DEFAULT_VERSION
+    row = ConfigSnapshot.objects.filter(config=config_id,
+            version=version).values_list('etag', 'last_update_datetime')[:1]
+    if not row:
+        return None
+    return row[0]
+
+
+def get(config_id, version=None):
+    """
+    Return the stored XML document of a configuration, or None if there is
+    no document stored for it.
+    """
+    snapshot = fetch(config_id, version)
+    if snapshot is None:
+        return None
+    return snapshot[0]
@@ -0,0 +1,183 @@
+"""
+This file contains the revalidation sweep of the approved configurations run
+by the sweep_configs command. Configurations are checked on a pool of
+threads, HostLimiter keeps the sweep from hammering a server shared by many
+of them, and each result is appended to a state file as it comes in so an
+interrupted sweep can be resumed.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import simplejson
+
+from ispdb.config import configChecks
+from ispdb.config.models import Config
+
+# Used when the settings don't say otherwise.
+WORKERS = 16
+HOST_CONCURRENCY = 2
+HOST_INTERVAL = 0.2
+
+
+class HostLimiter(object):
+    """
+    Lets at most concurrency sweepers use a host at once, and starts them at
+    least interval seconds apart.
+    """
+
+    def __init__(self, concurrency=None, interval=None):
+        if concurrency is None:
+            concurrency = getattr(settings, 'SWEEP_HOST_CONCURRENCY',
+                                  HOST_CONCURRENCY)
+        if interval is None:
+            interval = getattr(settings, 'SWEEP_HOST_INTERVAL', HOST_INTERVAL)
+        self.concurrency = concurrency
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_start = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.Semaphore(
+                        self.concurrency)
+            return self._semaphores[host]
+
+    def _wait(self, host):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_start.get(host, 0))
+            self._next_start[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    @contextmanager
+    def hold(self, hosts):
+        # Take the hosts in order, so two sweepers can't wait on each other.
+        hosts = sorted(set(host.lower() for host in hosts))
+        held = []
+        try:
+            for host in hosts:
+                self._semaphore(host).acquire()
+                held.append(host)
+            for host in hosts:
+                self._wait(host)
+            yield
+        finally:
+            for host in reversed(held):
+                self._semaphore(host).release()
+
+
+def approved_configs(ids=None, host=None):
+    """
+    Return the approved configurations to sweep: those with the given ids
+    if there are any, and using host for their incoming or outgoing server
+    if given.
+    """
+    queryset = Config.objects.filter(status="approved")
+    if ids:
+        queryset = queryset.filter(pk__in=ids)
+    if host:
+        queryset = queryset.filter(Q(incoming_hostname__iexact=host) |
+                                   Q(outgoing_hostname__iexact=host))
+    # Prefetched so the sweepers don't need a database connection.
+    return queryset.order_by('id').prefetch_related('domains',
+                                                    'domainrequests')
+
+
+def check(config, limiter):
+    """
+    Run the checks of a configuration and return their results as a dict.
+    """
+    domains = list(config.domains.all()) or list(config.domainrequests.all())
+    # The checks read domain.config, don't query it again.
+    for domain in domains:
+        domain.config = config
+    with limiter.hold([config.incoming_hostname, config.outgoing_hostname]):
+        try:
+            errors, warnings, problems = configChecks.do_sweep_checks(
+                    config, domains)
+        except Exception, e:
+            errors, warnings, problems = (
+                    ["Error running sanity checks: %s" % e], [], [])
+    return {"id": config.id,
+            "domains": [domain.name for domain in domains],
+            "problems": problems,
+            "errors": errors,
+            "warnings": warnings}
+
+
+def load_state(path):
+    """
+    Return the results recorded in a state file, by configuration id.
+    """
+    results = {}
+    try:
+        state = open(path)
+    except IOError:
+        return results
+    with state:
+        for line in state:
+            try:
+                result = simplejson.loads(line)
+            except ValueError:
+                # The last line of an interrupted sweep may be cut short.
+                continue
+            results[result["id"]] = result
+    return results
+
+
+def sweep(configs, workers=None, limiter=None, state=None, progress=None):
+    """
+    Check configs and return their results in the same order. If state is
+    the path of a state file, the configurations it has results for aren't
+    checked again, and the new results are added to it. progress is called
+    with each new result.
+    """
+    if workers is None:
+        workers = getattr(settings, 'SWEEP_WORKERS', WORKERS)
+    if limiter is None:
+        limiter = HostLimiter()
+    configs = list(configs)
+    results = load_state(state) if state else {}
+    todo = [config for config in configs if config.id not in results]
+    if not todo:
+        return [results[config.id] for config in configs]
+    output = None
+    if state:
+        output = open(state, 'a+')
+        # Don't append to a line an interrupted sweep cut short.
+        output.seek(0, 2)
+        if output.tell():
+            output.seek(-1, 2)
+            if output.read(1) != "\n":
+                output.write("\n")
+    pool = ThreadPool(min(workers, len(todo)))
+    try:
+        for result in pool.imap_unordered(lambda c: check(c, limiter), todo):
+            results[result["id"]] = result
+            if output is not None:
+                output.write(simplejson.dumps(result) + "\n")
+                output.flush()
+            if progress is not None:
+                progress(result)
+    finally:
+        pool.terminate()
+        if output is not None:
+            output.close()
+    return [results[config.id] for config in configs]
+
+
+def report(results):
+    """
+    Return the report of a sweep: the number of configurations checked and
+    the results of those with a server which stopped answering or lost TLS.
+    """
+    return {"checked": len(results),
+            "problems": [result for result in results if result["problems"]]}
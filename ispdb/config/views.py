@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import lxml.etree as ET
-import StringIO
 
 from django.conf import settings
 from django.contrib import comments
@@ -13,21 +12,23 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.db.models import Q, Max
 from django.forms.models import modelformset_factory
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+    HttpResponseRedirect)
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
 from django.utils import simplejson, timezone
 from django.utils.cache import patch_cache_control
-from django.views.decorators.cache import cache_control
-from django.views.decorators.http import last_modified
+from django.utils.http import quote_etag
+from django.views.decorators.cache import cache_control, never_cache
+from django.views.decorators.http import condition, last_modified
 
-from ispdb.config import serializers
-from ispdb.config.configChecks import do_config_checks, do_domain_checks
+from ispdb.config import (archive, configChecks, domainindex, sanityjobs,
+    serializers, snapshots)
 from ispdb.config.forms import (BaseDocURLFormSet, BaseDomainFormSet,
     BaseEnableURLFormSet, ConfigForm, DocURLForm, DomainForm, EnableURLForm,
     IssueForm)
 from ispdb.config.models import (Config, DocURL, Domain, DomainRequest,
-    EnableURL, Issue)
+    EnableURL, Issue, SanityJob)
 
 
 @login_required
@@ -76,24 +77,28 @@ def last_modified_list_xml(request, format="html"):
     return None
 
 
+def _list_xml():
+    """
+    Yield the /list/xml/ document one provider at a time, so the response can
+    be streamed however many configurations are approved.
+    """
+    yield "<?xml version='1.0' encoding='UTF-8'?>\n<providers>"
+    configs = Config.objects.filter(status='approved').order_by('id')
+    rows = configs.values_list('id', 'last_update_datetime')
+    for id, last_update in rows.iterator():
+        provider = ET.Element("provider")
+        ET.SubElement(provider, "id").text = unicode(id)
+        ET.SubElement(provider, "export").text = reverse(
+                "ispdb_export_xml", kwargs={"id": id})
+        ET.SubElement(provider, "lastUpdated").text = unicode(last_update)
+        yield ET.tostring(provider)
+    yield "</providers>"
+
+
 @last_modified(last_modified_list_xml)
 def list(request, format="html"):
     if format == "xml":
-        providers = ET.Element("providers")
-        configs = Config.objects.filter(status='approved')
-        for config in configs:
-            provider = ET.SubElement(providers, "provider")
-            ET.SubElement(provider, "id").text = unicode(config.id)
-            ET.SubElement(provider, "export").text = reverse(
-                    "ispdb_export_xml", kwargs={"id": config.id})
-            ET.SubElement(provider, "lastUpdated").text = unicode(
-                config.last_update_datetime)
-        xml = ET.ElementTree(providers)
-        output = StringIO.StringIO("w")
-        xml.write(output, encoding="UTF-8", xml_declaration=True)
-        response = HttpResponse(mimetype="text/xml")
-        response.write(output.getvalue())
-        output.close()
+        response = HttpResponse(_list_xml(), mimetype="text/xml")
         # set cache settings
         patch_cache_control(response, no_cache=True)
         return response
@@ -130,6 +135,14 @@ def details(request, id, error=None):
     EnableURLFormSet = modelformset_factory(EnableURL, extra=0,
             form=EnableURLForm, formset=BaseEnableURLFormSet)
     enableurl_formset = EnableURLFormSet(queryset=config.enableurl_set.all())
+    # The last results of the sanity checks, for the reviewers.
+    sanity_result = None
+    if request.user.has_perm('config.can_approve'):
+        latest = sanityjobs.latest(config)
+        if latest is not None:
+            sanity_result = sanityjobs.stored(latest)
+            sanity_result["datetime"] = latest.created_datetime
+            sanity_result["fresh"] = sanityjobs.is_fresh(latest)
     return render_to_response("config/details.html", {
             'config': config,
             'incoming': incoming,
@@ -138,34 +151,98 @@ def details(request, id, error=None):
             'error': error,
             'issues': config.reported_issues.filter(status="open"),
             'docurls': docurl_formset,
-            'enableurls': enableurl_formset},
+            'enableurls': enableurl_formset,
+            'sanity_result': sanity_result},
         context_instance=RequestContext(request))
 
 
-def last_modified_export_xml(request, version=None, id=None, domain=None):
-    config = None
+def _export_xml_config(request, version=None, id=None, domain=None):
+    """
+    Return the (config id, ETag, last modified) of the document requested
+    from export_xml. Domains are resolved through the in-process index, so
+    unknown domains are answered without going to the database. The ETag
+    and last modification time come from the stored document, or from the
+    configuration itself if it has none. The result is kept on the request,
+    the conditional GET functions and the view all need it.
+    """
+    if hasattr(request, '_export_xml_config'):
+        return request._export_xml_config
     if id is not None:
-        config = get_object_or_404(Config, pk=int(id))
-    elif domain is not None:
-        config = Domain.objects.filter(name=domain)[0].config
-    if not config:
-        return None
-    return config.last_update_datetime
+        config_id = int(id)
+    else:
+        config_id = domainindex.lookup(domain)
+        if config_id is None:
+            raise Http404
+    state = snapshots.state(config_id, version)
+    if state is not None:
+        entry = (config_id,) + state
+    else:
+        config = get_object_or_404(Config.objects.only(
+                'last_update_datetime'), pk=config_id)
+        entry = (config_id, None, config.last_update_datetime)
+    request._export_xml_config = entry
+    return entry
+
+
+def etag_export_xml(request, version=None, id=None, domain=None):
+    return _export_xml_config(request, version, id, domain)[1]
+
+
+def last_modified_export_xml(request, version=None, id=None, domain=None):
+    return _export_xml_config(request, version, id, domain)[2]
 
 
 @cache_control(no_cache=True)
-@last_modified(last_modified_export_xml)
+@condition(etag_func=etag_export_xml,
+           last_modified_func=last_modified_export_xml)
 def export_xml(request, version=None, id=None, domain=None):
-    config = None
-    if id is not None:
-        config = get_object_or_404(Config, pk=int(id))
-    elif domain is not None:
-        config = Domain.objects.filter(name=domain)[0].config
     serialize = serializers.get(version)
     if serialize is None:
         raise Http404
-    data = serialize(config)
-    return HttpResponse(data, mimetype='text/xml')
+    config_id = _export_xml_config(request, version, id, domain)[0]
+    # Approved configurations are served from the snapshot store, the others
+    # are serialized on demand.
+    snapshot = snapshots.fetch(config_id, version)
+    if snapshot is not None:
+        data, etag = snapshot
+    else:
+        config = get_object_or_404(serializers.prefetch(Config.objects),
+                                   pk=config_id)
+        data = serialize(config)
+        etag = snapshots.make_etag(data)
+    response = HttpResponse(data, mimetype='text/xml')
+    # Use the ETag of the document we are sending, it may have changed since
+    # the conditional GET functions looked.
+    response['ETag'] = quote_etag(etag)
+    return response
+
+
+def export_archive(request, format):
+    """
+    Return every approved configuration in a single archive. The "since" and
+    "version" parameters restrict it to the documents changed after a given
+    time and to some format versions.
+    """
+    since = request.GET.get('since')
+    if since:
+        try:
+            since = archive.parse_since(since)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid since parameter.",
+                                          mimetype="text/plain")
+    else:
+        since = None
+    versions = request.GET.getlist('version')
+    for version in versions:
+        if serializers.get(version) is None:
+            raise Http404
+    response = HttpResponse(archive.generate(format, since, versions),
+                            mimetype=archive.FORMATS[format])
+    response['Content-Disposition'] = ('attachment; filename=ispdb.%s' %
+                                       format)
+    # Don't let the cache middleware keep the whole archive around.
+    patch_cache_control(response, no_cache=True, max_age=0)
+    return response
 
 
 @login_required
@@ -388,16 +465,62 @@ def approve(request, id):
     return HttpResponseRedirect('/details/' + id)  # Redirect after POST
 
 
+def _sanity_job_response(job, status=200):
+    data = sanityjobs.result(job)
+    data["url"] = reverse("ispdb_sanity_job", args=[job.id])
+    response = HttpResponse(simplejson.dumps(data),
+                            mimetype='application/json')
+    response.status_code = status
+    return response
+
+
+@never_cache
 @permission_required("config.can_approve")
 def sanity(request, id):
+    """
+    Return the stored results of the sanity checks of a configuration if
+    they are recent enough, or queue a run of the checks and return the URL
+    to poll for its results. Pass rerun=1 to run the checks in any case.
+    """
+    config = get_object_or_404(Config, pk=id)
+    if not request.GET.get('rerun'):
+        sanity_result = sanityjobs.latest(config)
+        if sanityjobs.is_fresh(sanity_result):
+            return HttpResponse(
+                    simplejson.dumps(sanityjobs.stored(sanity_result)),
+                    mimetype='application/json')
+    job = sanityjobs.submit(config)
+    return _sanity_job_response(job, status=202)
+
+
+@never_cache
+@permission_required("config.can_approve")
+def sanity_job(request, id):
+    job = get_object_or_404(SanityJob, pk=id)
+    return _sanity_job_response(job)
+
+
+def _sanity_lines(config, domains):
+    for event in configChecks.iter_checks(config, domains):
+        if event["event"] == "summary":
+            sanityjobs.save_result(config, event["errors"],
+                                   event["warnings"],
+                                   event.pop("capabilities"))
+        yield simplejson.dumps(event) + "\n"
+
+
+@never_cache
+@permission_required("config.can_approve")
+def sanity_stream(request, id):
+    """
+    Run the sanity checks of a configuration, streaming what they find as
+    it comes in, one JSON object per line (see configChecks.iter_checks).
+    The summary on the last line is stored like the results of a job.
+    """
     config = get_object_or_404(Config, pk=id)
     domains = config.domains.all() or config.domainrequests.all()
-    domain_errors, domain_warnings = do_domain_checks(domains)
-    config_errors, config_warnings = do_config_checks(config)
-    data = simplejson.dumps({"errors": domain_errors + config_errors,
-                             "warnings": domain_warnings + config_warnings,
-                            })
-    return HttpResponse(data, mimetype='application/json')
+    return HttpResponse(_sanity_lines(config, domains),
+                        mimetype='application/x-ndjson')
 
 
 @login_required
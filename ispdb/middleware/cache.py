@@ -0,0 +1,61 @@
+from django.middleware import cache
+from django.utils.cache import (cc_delim_re, get_max_age,
+    patch_response_headers)
+
+
+def _no_cache(response):
+    if not response.has_header('Cache-Control'):
+        return False
+    directives = cc_delim_re.split(response['Cache-Control'])
+    return 'no-cache' in [d.split('=', 1)[0].strip().lower()
+                          for d in directives]
+
+
+def _new_cookies(request, response):
+    """
+    Whether the response sets cookies the request didn't have, e.g. the CSRF
+    token given to a visitor without one.
+    """
+    for name, morsel in response.cookies.items():
+        if request.COOKIES.get(name) != morsel.value:
+            return True
+    return False
+
+
+class UpdateCacheMiddleware(cache.UpdateCacheMiddleware):
+    """
+    Django's UpdateCacheMiddleware, except that streamed responses, responses
+    marked no-cache (e.g. export_xml, which answers conditional requests
+    itself) and responses setting new cookies only get the caching headers:
+    the first can't be stored without reading them all in memory first, the
+    second have to be revalidated by the view and the last would give every
+    visitor the same cookies (and CSRF token).
+    """
+
+    def process_response(self, request, response):
+        if not (getattr(response, '_base_content_is_iter', False) or
+                _no_cache(response) or _new_cookies(request, response)):
+            return super(UpdateCacheMiddleware, self).process_response(
+                    request, response)
+        if (self._should_update_cache(request, response) and
+                response.status_code == 200):
+            timeout = get_max_age(response)
+            if timeout is None:
+                timeout = self.cache_timeout
+            if timeout:
+                patch_response_headers(response, timeout)
+        return response
+
+
+class FetchFromCacheMiddleware(cache.FetchFromCacheMiddleware):
+    """
+    Django's FetchFromCacheMiddleware, except that conditional requests go
+    through to the views, which can answer them with a 304.
+    """
+
+    def process_request(self, request):
+        if ('HTTP_IF_NONE_MATCH' in request.META or
+                'HTTP_IF_MODIFIED_SINCE' in request.META):
+            request._cache_update_cache = False
+            return None
+        return super(FetchFromCacheMiddleware, self).process_request(request)
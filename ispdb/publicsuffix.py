@@ -0,0 +1,328 @@
+"""
+This file contains the public suffix list (the effective TLDs, such as "com"
+or "co.uk") shared by the whole project. The rules of the bundled snapshot,
+effective_tld_names.dat, are loaded into a trie of labels once per process
+(see get()), and hostnames are split by walking it from their last label.
+
+compile_index() turns the list into a binary index (the compile_suffixes
+command writes it next to the snapshot). When it is there, get() maps it read
+only instead, so the processes share one copy of it and don't parse the list:
+lookups hash the suffixes of a hostname straight into the mapped file.
+
+Only the ICANN section of the list is used by default, like tldextract, so
+hostnames such as "foo.blogspot.com" belong to "blogspot.com".
+"""
+
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import zlib
+from collections import namedtuple
+
+SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'effective_tld_names.dat')
+# Where the compiled indexes are looked for.
+COMPILED_DIR = os.path.dirname(SNAPSHOT)
+
+# The kinds of rules a node of the trie can end, kept under the None key.
+# In the compiled index, the flags of a suffix also tell whether "*.suffix"
+# is a rule, and whether longer rules end with it.
+_RULE = 1
+_EXCEPTION = 2
+_WILDCARD = 4
+_NODE = 8
+
+# The compiled index: a header (magic, number of slots), a hash table of
+# slots holding the offsets of the entries (0 when empty), then the entries:
+# the flags and length of a suffix (one byte each), and the suffix in UTF-8.
+_MAGIC = 'PSL1'
+_HEADER = struct.Struct('<4sI')
+_SLOT = struct.Struct('<I')
+
+_IPV4 = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+class Split(namedtuple('Split', 'subdomain domain suffix')):
+    """
+    The parts of a hostname: "forums.bbc.co.uk" is split into "forums",
+    "bbc" and "co.uk". The suffix is empty when no rule matches.
+    """
+
+    __slots__ = ()
+
+    @property
+    def registered_domain(self):
+        if self.domain and self.suffix:
+            return self.domain + '.' + self.suffix
+        return ''
+
+
+def read_rules(path=SNAPSHOT, private=False):
+    """
+    Return the rules of a public suffix list file, as unicode strings.
+    """
+    rules = []
+    with open(path) as lines:
+        for line in lines:
+            line = line.decode('utf-8').strip()
+            if line.startswith('//'):
+                if 'BEGIN PRIVATE DOMAINS' in line and not private:
+                    break
+                continue
+            if line:
+                # A rule stops at the first white space.
+                rules.append(line.split()[0].lower())
+    return rules
+
+
+class PublicSuffixList(object):
+    """
+    A public suffix list, looked up through a trie of the labels of its
+    rules, last label first.
+    """
+
+    def __init__(self, rules):
+        self._root = {}
+        for rule in _forms(rules):
+            self._add(rule)
+
+    @classmethod
+    def load(cls, path=SNAPSHOT, private=False):
+        return cls(read_rules(path, private))
+
+    def _add(self, rule):
+        kind = _RULE
+        if rule.startswith('!'):
+            kind = _EXCEPTION
+            rule = rule[1:]
+        node = self._root
+        for label in reversed(rule.split('.')):
+            node = node.setdefault(label, {})
+        node[None] = kind
+
+    def suffix_length(self, labels):
+        """
+        Return the number of labels at the end of labels (lower case) which
+        are a public suffix, 0 if no rule matches.
+        """
+        node = self._root
+        length = 0
+        depth = 0
+        for label in reversed(labels):
+            child = node.get(label)
+            if child is not None and child.get(None) == _EXCEPTION:
+                # The rule's parent is the suffix.
+                return depth
+            if '*' in node:
+                length = depth + 1
+            if child is None:
+                break
+            depth += 1
+            if child.get(None) == _RULE:
+                length = depth
+            node = child
+        return length
+
+    def split(self, hostname):
+        """
+        Return the Split of a hostname. The parts keep its case, a trailing
+        dot is dropped.
+        """
+        hostname = hostname.strip().rstrip('.')
+        labels = hostname.split('.')
+        count = len(labels)
+        length = self.suffix_length(hostname.lower().split('.'))
+        if not length and _IPV4.match(hostname):
+            return Split('', hostname, '')
+        if length == count:
+            return Split('', '', hostname)
+        return Split('.'.join(labels[:count - length - 1]),
+                     labels[count - length - 1],
+                     '.'.join(labels[count - length:]))
+
+    def split_many(self, hostnames):
+        """
+        Return the Splits of hostnames, in the same order. Hostnames seen
+        more than once are only looked up once.
+        """
+        splits = {}
+        split = self.split
+        ret = []
+        for hostname in hostnames:
+            result = splits.get(hostname)
+            if result is None:
+                result = splits[hostname] = split(hostname)
+            ret.append(result)
+        return ret
+
+    def registered_domain(self, hostname):
+        """
+        Return the domain a hostname belongs to ("bbc.co.uk" for
+        "forums.bbc.co.uk"), or '' if it has none.
+        """
+        return self.split(hostname).registered_domain
+
+
+class MappedPublicSuffixList(PublicSuffixList):
+    """
+    A public suffix list looked up in an index written by compile_index(),
+    mapped read only.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as index:
+            self._map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _HEADER.size:
+            raise ValueError("%s is not a public suffix index" % path)
+        magic, self._slots = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC:
+            raise ValueError("%s is not a public suffix index" % path)
+        self._root_flags = self._flags('')
+
+    def _flags(self, key, crc32=zlib.crc32, unpack=_SLOT.unpack_from):
+        buf = self._map
+        mask = self._slots - 1
+        slot = crc32(key) & mask
+        size = len(key)
+        while True:
+            offset = unpack(buf, _HEADER.size + 4 * slot)[0]
+            if not offset:
+                return 0
+            if buf[offset + 2:offset + 2 + size] == key and \
+               ord(buf[offset + 1]) == size:
+                return ord(buf[offset])
+            slot = (slot + 1) & mask
+
+    def suffix_length(self, labels):
+        length = 0
+        parent = self._root_flags
+        key = ''
+        for depth, label in enumerate(reversed(labels)):
+            if isinstance(label, unicode):
+                label = label.encode('utf-8')
+            key = label + '.' + key if depth else label
+            flags = self._flags(key)
+            if flags & _EXCEPTION:
+                return depth
+            if parent & _WILDCARD:
+                length = depth + 1
+            if not flags:
+                break
+            if flags & _RULE:
+                length = depth + 1
+            parent = flags
+        return length
+
+
+def _forms(rules):
+    """
+    Yield rules, and the ASCII (punycode) form of the internationalized
+    ones.
+    """
+    for rule in rules:
+        yield rule
+        try:
+            ascii = rule.encode('idna')
+        except UnicodeError:
+            continue
+        if ascii != rule:
+            yield ascii
+
+
+def compile_index(rules, path):
+    """
+    Write the index of a list of rules (see read_rules) to path. The file is
+    replaced at once, so the processes which mapped the previous one keep
+    using it safely.
+    """
+    flags = {}
+    for rule in _forms(rules):
+        if isinstance(rule, unicode):
+            rule = rule.encode('utf-8')
+        if rule.startswith('!'):
+            rule, kind = rule[1:], _EXCEPTION
+        elif rule == '*' or rule.startswith('*.'):
+            rule, kind = rule[2:], _WILDCARD
+        else:
+            kind = _RULE
+        if len(rule) > 255:
+            continue
+        flags[rule] = flags.get(rule, 0) | kind
+        # The suffixes the lookups go through to reach the rule.
+        labels = rule.split('.')
+        for i in range(1, len(labels)):
+            parent = '.'.join(labels[i:])
+            flags[parent] = flags.get(parent, 0) | _NODE
+    slots = 1
+    while slots < 2 * len(flags):
+        slots *= 2
+    table = [0] * slots
+    entries = []
+    offset = _HEADER.size + slots * _SLOT.size
+    for key in sorted(flags):
+        slot = zlib.crc32(key) & (slots - 1)
+        while table[slot]:
+            slot = (slot + 1) & (slots - 1)
+        table[slot] = offset
+        entries.append(chr(flags[key]) + chr(len(key)) + key)
+        offset += len(entries[-1])
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.psl')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            output.write(_HEADER.pack(_MAGIC, slots))
+            output.write(struct.pack('<%dI' % slots, *table))
+            output.write(''.join(entries))
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def compiled_path(private=False):
+    """
+    Return the path of the index get() maps.
+    """
+    name = 'effective_tld_names-private.idx' if private \
+           else 'effective_tld_names.idx'
+    return os.path.join(COMPILED_DIR, name)
+
+
+def _load(private):
+    path = compiled_path(private)
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(SNAPSHOT):
+            return MappedPublicSuffixList(path)
+    except (EnvironmentError, ValueError):
+        pass
+    return PublicSuffixList.load(private=private)
+
+
+def get(private=False):
+    """
+    Return the public suffix list of the bundled snapshot, loaded by the
+    first call of the process: mapped from its index if it was compiled
+    since the snapshot changed, read from the snapshot otherwise.
+    """
+    psl = _shared.get(private)
+    if psl is None:
+        with _shared_lock:
+            psl = _shared.get(private)
+            if psl is None:
+                psl = _shared[private] = _load(private)
+    return psl
+
+
+def split(hostname):
+    return get().split(hostname)
+
+
+def split_many(hostnames):
+    return get().split_many(hostnames)
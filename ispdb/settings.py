@@ -1,4 +1,6 @@
 import os
+import sys
+import tempfile
 # Django settings for ispdb project.
 
 DEBUG = True
@@ -25,6 +27,7 @@ DATABASES = {
 #Test Runner
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 NOSE_ARGS = ['--with-doctest', '--doctest-extension=.doctest']
+NOSE_PLUGINS = ['ispdb.tests.plugins.ClearCaches']
 
 #Fixtures
 FIXTURE_DIRS = (
@@ -100,7 +103,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
-    'django.middleware.cache.UpdateCacheMiddleware',
+    'ispdb.middleware.cache.UpdateCacheMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -108,7 +111,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
+    'ispdb.middleware.cache.FetchFromCacheMiddleware',
 )
 
 ROOT_URLCONF = 'ispdb.urls'
@@ -158,8 +161,94 @@ TEMPLATE_CONTEXT_PROCESSORS = (
     "django_browserid.context_processors.browserid_form",
 )
 
+# The pages are cached in each process for LOCAL_TIMEOUT seconds, in front of
+# the 'shared' cache, which can be any cache shared by the processes
+# (e.g. 'django.core.cache.backends.memcached.MemcachedCache'). The pages get
+# a new generation of keys whenever a configuration changes, the other entries
+# of the shared cache are kept.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
-    }
+        'BACKEND': 'ispdb.cache.TwoTierCache',
+        'LOCATION': 'ispdb',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'MAX_ENTRIES': 500,
+            'LOCAL_TIMEOUT': 10,
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/ispdb_cache',
+        'TIMEOUT': 600,
+    },
+    # The DNS answers and server checks of the sanity checks, see DNS_CACHE
+    # and PROBE_CACHE.
+    'sanity': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/ispdb_sanity_cache',
+    },
 }
+# The tests empty the caches before each test, they get their own.
+if sys.argv[1:2] == ['test']:
+    TEST_CACHE_ROOT = tempfile.mkdtemp(prefix='ispdb_test_cache_')
+    for alias in ('shared', 'sanity'):
+        CACHES[alias]['LOCATION'] = os.path.join(TEST_CACHE_ROOT, alias)
+CACHE_MIDDLEWARE_SECONDS = 600
+# Pages seen by logged in users show who they are.
+CACHE_MIDDLEWARE_ANONYMOUS_ONLY = True
+
+# The cache shared by the processes in which the export_xml domain index
+# records that it changed, the seconds between two looks at it and the seconds
+# after which each process reloads its index anyway.
+DOMAIN_INDEX_CACHE = 'shared'
+DOMAIN_INDEX_POLL = 1
+DOMAIN_INDEX_MAX_AGE = 300
+
+# The number of DNS queries and server checks a sanity check runs at once, and
+# the seconds they all have to finish in.
+SANITY_CHECK_WORKERS = 8
+SANITY_CHECK_DEADLINE = 30
+
+# The cache the NS and MX answers of the sanity checks are kept in (for their
+# TTL), and the seconds names without records are remembered.
+DNS_CACHE = 'sanity'
+DNS_NEGATIVE_TTL = 300
+
+# The cache the results of the server checks (the supported authentication
+# methods) are kept in, and for how many seconds. Failed checks are kept for
+# PROBE_NEGATIVE_TTL seconds.
+PROBE_CACHE = 'sanity'
+PROBE_TTL = 900
+PROBE_NEGATIVE_TTL = 120
+
+# Seconds a sanity check probe waits to connect to a server, for the TLS
+# handshake and for each answer after that. The probes of a run also give up
+# once SANITY_CHECK_DEADLINE is over.
+PROBE_CONNECT_TIMEOUT = 5
+PROBE_TLS_TIMEOUT = 5
+PROBE_READ_TIMEOUT = 10
+# Seconds between the connection attempts to each address of a server, which
+# race each other until one connects.
+PROBE_CONNECT_STAGGER = 0.25
+
+# The probes of a server stop for PROBE_BREAKER_COOLDOWN seconds after
+# PROBE_BREAKER_THRESHOLD of them timed out. Each process runs at most
+# PROBE_HOST_CONCURRENCY probes of a host at once.
+PROBE_BREAKER_THRESHOLD = 3
+PROBE_BREAKER_COOLDOWN = 300
+PROBE_HOST_CONCURRENCY = 4
+
+# The number of sanity check jobs each sanity_worker command runs at once.
+SANITY_JOB_WORKERS = 2
+
+# Hours the results of the sanity checks of a configuration are shown for
+# before asking for them runs the checks again.
+SANITY_RESULT_MAX_AGE = 24
+
+# The sweep_configs command checks SWEEP_WORKERS configurations at once, at
+# most SWEEP_HOST_CONCURRENCY of them using the same server, started at least
+# SWEEP_HOST_INTERVAL seconds apart.
+SWEEP_WORKERS = 16
+SWEEP_HOST_CONCURRENCY = 2
+SWEEP_HOST_INTERVAL = 0.2
@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import httplib
+import os
+import sys
+
+# The scripts in tools/
+TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                     os.pardir, 'tools')
 
 # Redirect to /add/ on success
 success_code = httplib.FOUND
@@ -94,3 +100,12 @@ def adding_domain_form():
             "inst_0-0-language": "en",
             "inst_0-0-description": "test"
            }
+
+
+def import_tool(name):
+    """
+    Import one of the scripts in tools/ as a module.
+    """
+    if TOOLS not in sys.path:
+        sys.path.insert(0, TOOLS)
+    return __import__(name)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal IMAP, POP3 and SMTP servers listening on localhost, which answer just
+enough of each protocol for the sanity checks to read the capabilities, and
+optionally upgrade the connection with STARTTLS.
+"""
+
+import os
+import socket
+import SocketServer
+import ssl
+import struct
+import threading
+import time
+
+# A self signed certificate and its key, for STARTTLS.
+CERTFILE = os.path.join(os.path.dirname(__file__), "fakeservers.pem")
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def send(self, *lines):
+        self.wfile.write("".join("%s\r\n" % line for line in lines))
+
+    def start_tls(self):
+        self.wfile.flush()
+        self.connection = ssl.wrap_socket(self.connection, server_side=True,
+                                          certfile=CERTFILE)
+        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.wfile = self.connection.makefile('wb', self.wbufsize)
+        self.tls = True
+
+    def handle(self):
+        self.tls = False
+        self.server.connections += 1
+        time.sleep(self.server.delay)
+        self.send(self.greeting)
+        # Read from self.rfile each time, STARTTLS replaces it.
+        while True:
+            line = self.rfile.readline()
+            if not line or not self.answer(line.strip()):
+                break
+
+
+class IMAPHandler(_Handler):
+    greeting = "* OK IMAP4rev1 ready"
+
+    def answer(self, line):
+        tag, command = (line.split(" ", 1) + [""])[:2]
+        if command.upper() == "CAPABILITY":
+            if self.tls:
+                capa = "IMAP4rev1 AUTH=PLAIN AUTH=LOGIN AUTH=CRAM-MD5"
+            elif self.server.starttls:
+                capa = "IMAP4rev1 STARTTLS AUTH=PLAIN"
+            else:
+                capa = "IMAP4rev1 AUTH=PLAIN AUTH=LOGIN"
+            self.send("* CAPABILITY %s" % capa,
+                      "%s OK CAPABILITY completed" % tag)
+            return True
+        if command.upper() == "STARTTLS" and self.server.starttls:
+            self.send("%s OK begin TLS" % tag)
+            self.start_tls()
+            return True
+        self.send("%s BAD unknown command" % tag)
+        return command.upper() != "LOGOUT"
+
+
+class POP3Handler(_Handler):
+    greeting = "+OK POP3 ready"
+
+    def answer(self, line):
+        if line.upper() == "CAPA":
+            if self.tls:
+                self.send("+OK", "USER", "SASL PLAIN LOGIN CRAM-MD5", ".")
+            elif self.server.starttls:
+                self.send("+OK", "USER", "STLS", "SASL PLAIN", ".")
+            else:
+                self.send("+OK", "USER", "SASL PLAIN LOGIN", ".")
+            return True
+        if line.upper() == "STLS" and self.server.starttls:
+            self.send("+OK begin TLS")
+            self.start_tls()
+            return True
+        if line.upper() == "QUIT":
+            self.send("+OK bye")
+            return False
+        self.send("-ERR unknown command")
+        return True
+
+
+class DroppingPOP3Handler(_Handler):
+    greeting = "+OK POP3 ready"
+
+    def answer(self, line):
+        # Reset the connection instead of answering.
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.connection.close()
+        return False
+
+
+class SMTPHandler(_Handler):
+    greeting = "220 localhost ESMTP ready"
+
+    def answer(self, line):
+        if line.upper().startswith("EHLO"):
+            if self.tls:
+                self.send("250-localhost", "250-AUTH PLAIN LOGIN CRAM-MD5",
+                          "250 HELP")
+            elif self.server.starttls:
+                self.send("250-localhost", "250-STARTTLS", "250-AUTH PLAIN",
+                          "250 HELP")
+            else:
+                self.send("250-localhost", "250-AUTH PLAIN LOGIN", "250 HELP")
+            return True
+        if line.upper() == "STARTTLS" and self.server.starttls:
+            self.send("220 begin TLS")
+            self.start_tls()
+            return True
+        if line.upper() == "QUIT":
+            self.send("221 bye")
+            return False
+        self.send("502 unknown command")
+        return True
+
+
+class RefusingSMTPHandler(_Handler):
+    greeting = "554 go away"
+
+    def answer(self, line):
+        return False
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def start(handler, delay=0, starttls=False):
+    """
+    Start a server with the given handler on a free port of localhost, and
+    return it. delay is the number of seconds it waits before greeting each
+    client, server.connections counts them. If starttls is true the server
+    offers STARTTLS, and more authentication methods once it is used.
+    """
+    server = _Server(("127.0.0.1", 0), handler)
+    server.delay = delay
+    server.starttls = starttls
+    server.connections = 0
+    server.port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,28 @@
+import shutil
+
+from django.conf import settings
+from django.core.cache import get_cache
+from nose.plugins import Plugin
+
+
+class ClearCaches(Plugin):
+    """
+    Empty the caches before each test, the database is rolled back after each
+    one but the pages cached by the cache middleware are not. The caches are
+    those of the test settings (TEST_CACHE_ROOT), removed at the end.
+    """
+    name = 'clear-caches'
+    enabled = True
+
+    def configure(self, options, conf):
+        # Always enabled.
+        pass
+
+    def beforeTest(self, test):
+        for alias in settings.CACHES:
+            get_cache(alias).clear()
+
+    def finalize(self, result):
+        root = getattr(settings, 'TEST_CACHE_ROOT', None)
+        if root:
+            shutil.rmtree(root, ignore_errors=True)
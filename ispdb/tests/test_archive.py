@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import tarfile
+import zipfile
+from datetime import timedelta
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils import timezone
+from nose.tools import assert_equal
+
+from ispdb.config import serializers, snapshots
+from ispdb.config.models import Config, Domain
+
+
+class ArchiveTest(TestCase):
+
+    fixtures = ['xml_testdata']
+
+    def setUp(self):
+        snapshots.rebuild_all()
+
+    def get_tar(self, **params):
+        response = self.client.get(reverse("ispdb_export_archive",
+                                           args=["tgz"]), params)
+        assert_equal(response.status_code, 200)
+        return tarfile.open(fileobj=StringIO(response.content), mode="r:gz")
+
+    def test_tar(self):
+        tar = self.get_tar()
+        assert_equal(sorted(tar.getnames()), ["1.0/test.com", "1.1/test.com"])
+        config = Config.objects.get(pk=1)
+        assert_equal(tar.extractfile("1.1/test.com").read(),
+                     serializers.xmlOneDotOne(config))
+
+    def test_zip(self):
+        response = self.client.get(reverse("ispdb_export_archive",
+                                           args=["zip"]), {"version": "1.0"})
+        assert_equal(response["Content-Type"], "application/zip")
+        archive = zipfile.ZipFile(StringIO(response.content))
+        assert_equal(archive.namelist(), ["1.0/test.com"])
+        config = Config.objects.get(pk=1)
+        assert_equal(archive.read("1.0/test.com"),
+                     serializers.xmlOneDotZero(config))
+
+    def test_since(self):
+        since = timezone.now() + timedelta(seconds=1)
+        tar = self.get_tar(since=since.isoformat())
+        assert_equal(tar.getnames(), ["removed"])
+        assert_equal(tar.extractfile("removed").read(), "")
+        # Invalidate the config, its domain shows up as removed.
+        config = Config.objects.get(pk=1)
+        config.status = 'invalid'
+        config.save()
+        tar = self.get_tar(since=(since - timedelta(days=1)).isoformat())
+        assert_equal(tar.getnames(), ["removed"])
+        assert_equal(tar.extractfile("removed").read(), "test.com\n")
+
+    def test_since_removed_domains(self):
+        since = timezone.now() - timedelta(seconds=1)
+        Domain.objects.create(name="test3.com", config_id=1)
+        Domain.objects.create(name="test4.com", config_id=1)
+        domain = Domain.objects.create(name="test5.com", config_id=1)
+        # Renamed, deleted and moved to a config which isn't approved.
+        domain = Domain.objects.get(name="test.com")
+        domain.name = "test6.com"
+        domain.save()
+        Domain.objects.get(name="test3.com").delete()
+        config = Config.objects.get(pk=1)
+        # test2.com of the fixture points to the id 2.
+        config.pk = 3
+        config.status = 'suggested'
+        config.save()
+        domain = Domain.objects.get(name="test4.com")
+        domain.config = config
+        domain.save()
+        # Deleted, then added back.
+        Domain.objects.get(name="test5.com").delete()
+        Domain.objects.create(name="test5.com", config_id=1)
+        tar = self.get_tar(since=since.isoformat(), version="1.1")
+        assert_equal(tar.extractfile("removed").read(),
+                     "test.com\ntest3.com\ntest4.com\n")
+
+    def test_since_changed(self):
+        since = timezone.now() - timedelta(seconds=1)
+        config = Config.objects.get(pk=1)
+        config.display_name = "Changed"
+        config.save()
+        tar = self.get_tar(since=calendar.timegm(since.utctimetuple()),
+                           version="1.1")
+        assert_equal(sorted(tar.getnames()), ["1.1/test.com", "removed"])
+
+    def test_invalid_parameters(self):
+        response = self.client.get(reverse("ispdb_export_archive",
+                                           args=["tgz"]), {"since": "foo"})
+        assert_equal(response.status_code, 400)
+        for since in ("inf", "nan", "1e20", "-1e20"):
+            response = self.client.get(reverse("ispdb_export_archive",
+                                               args=["tgz"]), {"since": since})
+            assert_equal(response.status_code, 400)
+        response = self.client.get(reverse("ispdb_export_archive",
+                                           args=["tgz"]), {"version": "9.9"})
+        assert_equal(response.status_code, 404)
+
+    def test_command(self):
+        output = StringIO()
+        call_command("export_archive", format="zip", versions=["1.1"],
+                     stdout=output)
+        archive = zipfile.ZipFile(StringIO(output.getvalue()))
+        assert_equal(archive.namelist(), ["1.1/test.com"])
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from ispdb.config import breakers, configChecks, deadlines
+from ispdb.tests import fakeservers
+
+
+class SlowProbe(object):
+    "A probe which gives up after some time, counting its calls."
+
+    def __init__(self, delay=0.02, result=None):
+        self.delay = delay
+        self.result = result
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.result
+
+
+@override_settings(PROBE_BREAKER_THRESHOLD=2, PROBE_BREAKER_COOLDOWN=0.2)
+class BreakersTest(TestCase):
+
+    def setUp(self):
+        self.breakers = breakers.Breakers(timeout=0.02)
+
+    def test_open_after_timeouts(self):
+        probe = SlowProbe()
+        for i in range(2):
+            assert_equal(self.breakers.call('mail.test.com', 993, None,
+                                            probe), None)
+        assert_equal(self.breakers.state('mail.test.com', 993), "open")
+        assert_raises(breakers.Open, self.breakers.call, 'mail.test.com',
+                      993, None, probe)
+        assert_equal(probe.calls, 2)
+        # Other servers aren't affected.
+        assert_equal(self.breakers.state('mail.test.com', 143), "closed")
+        assert_equal(self.breakers.state('MAIL.test.com', 993), "open")
+
+    def test_quick_failures(self):
+        # Refused connections don't count.
+        probe = SlowProbe(delay=0)
+        for i in range(3):
+            self.breakers.call('mail.test.com', 993, None, probe)
+        assert_equal(self.breakers.state('mail.test.com', 993), "closed")
+        assert_equal(self.breakers.states(), [])
+
+    def test_half_open(self):
+        probe = SlowProbe()
+        for i in range(2):
+            self.breakers.call('mail.test.com', 993, None, probe)
+        time.sleep(0.2)
+        assert_equal(self.breakers.state('mail.test.com', 993), "half-open")
+        # One probe goes through, and opens the breaker again if it fails.
+        assert_true(self.breakers.allow('mail.test.com', 993))
+        assert_true(not self.breakers.allow('mail.test.com', 993))
+        self.breakers.failure('mail.test.com', 993)
+        assert_equal(self.breakers.state('mail.test.com', 993), "open")
+        time.sleep(0.2)
+        # An answer closes it.
+        answering = SlowProbe(result={})
+        assert_equal(self.breakers.call('mail.test.com', 993, None,
+                                        answering), {})
+        assert_equal(self.breakers.state('mail.test.com', 993), "closed")
+
+    @override_settings(PROBE_HOST_CONCURRENCY=2)
+    def test_concurrency(self):
+        running = []
+        most = []
+
+        def probe():
+            running.append(1)
+            most.append(len(running))
+            time.sleep(0.05)
+            running.pop()
+            return {}
+
+        threads = [threading.Thread(target=self.breakers.call,
+                                    args=('mail.test.com', port, None, probe))
+                   for port in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(max(most), 2)
+
+    @override_settings(PROBE_HOST_CONCURRENCY=1)
+    def test_busy(self):
+        # Probes waiting for a slot give up at the end of their budget.
+        thread = threading.Thread(target=self.breakers.call,
+                                  args=('mail.test.com', 993, None,
+                                        SlowProbe(delay=0.2)))
+        thread.start()
+        self.addCleanup(thread.join)
+        time.sleep(0.05)
+        start = time.time()
+        with deadlines.budget(time.time() + 0.05):
+            assert_raises(breakers.Busy, self.breakers.call,
+                          'mail.test.com', 995, None, SlowProbe())
+        assert_true(time.time() - start < 0.1)
+
+    def test_inspection(self):
+        self.breakers.failure('mail.test.com', 993)
+        self.breakers.failure('mail.test.com', 465)
+        self.breakers.failure('mail.test.com', 465)
+        assert_equal([(s["hostname"], s["port"], s["state"], s["failures"])
+                      for s in self.breakers.states()],
+                     [('mail.test.com', 465, "open", 2),
+                      ('mail.test.com', 993, "closed", 1)])
+        output = StringIO()
+        call_command('probe_breakers', reset=['mail.test.com:465'],
+                     stdout=output)
+        assert_equal(output.getvalue(), "mail.test.com:993 closed, 1 "
+                                        "timeouts\n")
+
+    def test_sanity_checks(self):
+        # The probes of a server whose breaker is open are skipped, and
+        # their result isn't cached.
+        smtp = fakeservers.start(fakeservers.SMTPHandler)
+        self.addCleanup(fakeservers.stop, smtp)
+        server_breakers = configChecks.server_breakers
+        for i in range(2):
+            server_breakers.failure('127.0.0.1', smtp.port)
+        assert_equal(configChecks.cached_check_socket_type(
+                '127.0.0.1', 'smtp', 'plain', smtp.port), configChecks.SKIPPED)
+        assert_equal(smtp.connections, 0)
+        server_breakers.reset('127.0.0.1', smtp.port)
+        assert_true(configChecks.cached_check_socket_type(
+                '127.0.0.1', 'smtp', 'plain', smtp.port))
+        assert_equal(smtp.connections, 1)
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
-from nose.tools import assert_true
+import mox
+from nose.tools import assert_raises, assert_true
 
+from django.conf import settings
+from django.core.cache import get_cache
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.client import Client
+from django.test.utils import override_settings
 from django.utils.timezone import utc
 
-from ispdb.config.models import Config
+from ispdb.cache import open_cache
+from ispdb.config import domainindex, snapshots
+from ispdb.config.models import Config, ConfigSnapshot
 
 
 class CacheTest(TestCase):
@@ -40,3 +47,178 @@ class CacheTest(TestCase):
             "%Z").replace(tzinfo=utc)
         c = config.last_update_datetime.replace(microsecond=0)
         assert_true(d == c)
+
+    def test_export_xml_etag(self):
+        snapshots.rebuild_all()
+        domainindex.index.load()
+        res = self.client.get(reverse("ispdb_export_xml", args=["test.com"]))
+        assert_true('ETag' in res)
+        assert_true(res['ETag'] == '"%s"' % snapshots.make_etag(res.content))
+        # The 1.1 document has its own ETag
+        res_1_1 = self.client.get(reverse("ispdb_export_xml",
+                                          args=["1.1", "test.com"]))
+        assert_true(res_1_1['ETag'] != res['ETag'])
+        # Conditional requests only read the ETag of the stored document
+        with self.assertNumQueries(1):
+            res_304 = self.client.get(reverse("ispdb_export_xml",
+                                              args=["test.com"]),
+                                      HTTP_IF_NONE_MATCH=res['ETag'])
+        assert_true(res_304.status_code == 304)
+        with self.assertNumQueries(1):
+            res_304 = self.client.get(reverse("ispdb_export_xml",
+                                              args=["test.com"]),
+                                      HTTP_IF_MODIFIED_SINCE=res[
+                                          'Last-Modified'])
+        assert_true(res_304.status_code == 304)
+        # Changing the config changes the ETag
+        config = Config.objects.get(pk=1)
+        config.display_name = "Changed"
+        config.save()
+        res_changed = self.client.get(reverse("ispdb_export_xml",
+                                              args=["test.com"]),
+                                      HTTP_IF_NONE_MATCH=res['ETag'])
+        assert_true(res_changed.status_code == 200)
+        assert_true(res_changed['ETag'] != res['ETag'])
+
+    def test_export_xml_state_read_once(self):
+        snapshots.rebuild_all()
+        domainindex.index.load()
+        res = self.client.get(reverse("ispdb_export_xml", args=["test.com"]))
+        state = snapshots.state(1)
+        # The ETag and the last modification time come from the same read.
+        m = mox.Mox()
+        m.StubOutWithMock(snapshots, 'state')
+        snapshots.state(1, None).AndReturn(state)
+        m.ReplayAll()
+        try:
+            res_304 = self.client.get(reverse("ispdb_export_xml",
+                                              args=["test.com"]),
+                                      HTTP_IF_NONE_MATCH=res['ETag'],
+                                      HTTP_IF_MODIFIED_SINCE=res[
+                                          'Last-Modified'])
+            m.VerifyAll()
+        finally:
+            m.UnsetStubs()
+        assert_true(res_304.status_code == 304)
+
+    def test_export_xml_changed_elsewhere(self):
+        snapshots.rebuild_all()
+        ConfigSnapshot.objects.update(
+                last_update_datetime=datetime(2012, 1, 1, tzinfo=utc))
+        domainindex.index.load()
+        res = self.client.get(reverse("ispdb_export_xml", args=["test.com"]))
+        # The document changes without this process hearing about it.
+        Config.objects.filter(pk=1).update(display_name="Changed")
+        snapshots.rebuild(1)
+        res_changed = self.client.get(reverse("ispdb_export_xml",
+                                              args=["test.com"]),
+                                      HTTP_IF_NONE_MATCH=res['ETag'])
+        assert_true(res_changed.status_code == 200)
+        assert_true("Changed" in res_changed.content)
+        res_changed = self.client.get(reverse("ispdb_export_xml",
+                                              args=["test.com"]),
+                                      HTTP_IF_MODIFIED_SINCE=res[
+                                          'Last-Modified'])
+        assert_true(res_changed.status_code == 200)
+
+    def test_cached_page(self):
+        res = self.client.get(reverse("ispdb_list"))
+        assert_true("Changed" not in res.content)
+        # The page varies on the cookies, ask again with the CSRF cookie set.
+        res = self.client.get(reverse("ispdb_list"))
+        # The next request is answered from the cache.
+        with self.assertNumQueries(0):
+            res_cached = self.client.get(reverse("ispdb_list"))
+        assert_true(res_cached.content == res.content)
+        # Changing a config empties the cache.
+        config = Config.objects.get(pk=1)
+        config.display_name = "Changed"
+        config.save()
+        res = self.client.get(reverse("ispdb_list"))
+        assert_true("Changed" in res.content)
+
+    def test_csrf_token_not_shared(self):
+        # Visitors without a CSRF cookie each get their own token.
+        tokens = []
+        for i in range(2):
+            res = Client().get(reverse("ispdb_list"))
+            token = res.cookies[settings.CSRF_COOKIE_NAME].value
+            assert_true(token in res.content)
+            tokens.append(token)
+        assert_true(tokens[0] != tokens[1])
+
+    def test_export_xml_not_cached(self):
+        snapshots.rebuild_all()
+        self.client.get(reverse("ispdb_export_xml", args=["test.com"]))
+        ConfigSnapshot.objects.update(xml="<changed/>")
+        res = self.client.get(reverse("ispdb_export_xml", args=["test.com"]))
+        assert_true(res.content == "<changed/>")
+
+    def test_streamed_page(self):
+        # The streamed list isn't kept in the cache.
+        self.client.get(reverse("ispdb_list", args=['xml']))
+        res = self.client.get(reverse("ispdb_list", args=['xml']))
+        assert_true(res._base_content_is_iter)
+
+
+@override_settings(CACHES=dict(settings.CACHES, test_shared={
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'test_shared',
+}))
+class TwoTierCacheTest(TestCase):
+
+    def get_cache(self, location):
+        cache = get_cache('ispdb.cache.TwoTierCache', LOCATION=location,
+                          OPTIONS={'SHARED': 'test_shared',
+                                   'MAX_ENTRIES': 2})
+        # Start like a new process.
+        cache.shared.clear()
+        cache.local.clear()
+        cache.local.generation = (0, None)
+        return cache
+
+    def test_local_tier(self):
+        cache = self.get_cache('test_local')
+        cache.set('a', 1)
+        cache.set('b', {'b': 2})
+        cache.set('c', None)
+        # The least recently used entry only stays in the shared tier.
+        assert_true(len(cache.local) == 2)
+        assert_true(cache.local.get(cache.make_key('a')) is None)
+        assert_true(cache.get('a') == 1)
+        assert_true(cache.get('b') == {'b': 2})
+        assert_true(cache.get('c', 'default') is None)
+        assert_true(cache.get('d', 'default') == 'default')
+        assert_true(not cache.add('a', 2))
+        cache.delete('a')
+        assert_true(cache.get('a') is None)
+
+    def test_shared_tier(self):
+        # Two processes with their own local tier.
+        cache = self.get_cache('test_process1')
+        other = self.get_cache('test_process2')
+        cache.set('a', 1)
+        assert_true(other.get('a') == 1)
+        assert_true(len(other.local) == 1)
+        other.clear()
+        assert_true(len(other.local) == 0)
+        assert_true(other.get('a') is None)
+        # Backends with the same location share their local tier.
+        assert_true(self.get_cache('test_process1').local is cache.local)
+
+    def test_clear(self):
+        cache = self.get_cache('test_clear')
+        cache.set('a', 1)
+        cache.shared.set('other', 2)
+        cache.clear()
+        assert_true(cache.get('a') is None)
+        # The other entries of the shared cache are kept.
+        assert_true(cache.shared.get('other') == 2)
+
+    @override_settings(CACHES=dict(settings.CACHES, test_broken={
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/dev/null/ispdb_cache',
+    }))
+    def test_open_cache_error(self):
+        # A directory which can't be created isn't retried.
+        assert_raises(EnvironmentError, open_cache, 'test_broken')
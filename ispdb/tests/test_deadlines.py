@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+import dns.resolver
+import imaplib
+import poplib
+import smtplib
+import socket
+import ssl
+import threading
+import time
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from ispdb.config import configChecks, deadlines
+from ispdb.config.configChecks import Probes
+from ispdb.tests import fakeservers
+
+
+class StalledTLSHandler(fakeservers.IMAPHandler):
+    "Agrees to STARTTLS, then never does the handshake."
+
+    def start_tls(self):
+        time.sleep(1)
+
+
+class SlowIMAPHandler(fakeservers.IMAPHandler):
+    "Takes its time to answer each command."
+
+    def answer(self, line):
+        time.sleep(0.4)
+        return fakeservers.IMAPHandler.answer(self, line)
+
+
+class DeadlinesTest(TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            fakeservers.stop(server)
+
+    def start(self, handler, delay=0, starttls=False):
+        server = fakeservers.start(handler, delay, starttls)
+        self.servers.append(server)
+        return server
+
+    def test_process_timeout(self):
+        # The other sockets of the process keep the default timeout.
+        assert_equal(socket.getdefaulttimeout(), None)
+        # And the mail libraries, used by Django too, are left alone.
+        for module in (imaplib, poplib, smtplib):
+            assert_true(module.socket is socket)
+            assert_true(module.ssl is ssl)
+
+    @override_settings(PROBE_READ_TIMEOUT=0.2)
+    def test_read_timeout(self):
+        imap = self.start(fakeservers.IMAPHandler, delay=1)
+        start = time.time()
+        assert_equal(configChecks.imap_check_plain('127.0.0.1', imap.port),
+                     None)
+        assert_true(time.time() - start < 0.6)
+
+    @override_settings(PROBE_TLS_TIMEOUT=0.2)
+    def test_tls_timeout(self):
+        imap = self.start(StalledTLSHandler, starttls=True)
+        start = time.time()
+        result = configChecks.probe_port('127.0.0.1', 'imap', imap.port)
+        assert_true(time.time() - start < 0.6)
+        assert_true(result["plain"])
+        assert_equal(result["starttls"], None)
+
+    def test_budget(self):
+        pop3 = self.start(fakeservers.POP3Handler, delay=1)
+        start = time.time()
+        with deadlines.budget(time.time() + 0.2):
+            assert_equal(configChecks.pop3_check_plain('127.0.0.1',
+                                                       pop3.port), None)
+        assert_true(time.time() - start < 0.6)
+        # Outside of it the usual timeouts apply.
+        assert_true(configChecks.pop3_check_plain('127.0.0.1', pop3.port))
+
+    def test_command_budget(self):
+        # Each command only waits for what is left of the budget.
+        imap = self.start(SlowIMAPHandler, starttls=True)
+        start = time.time()
+        with deadlines.budget(time.time() + 0.6):
+            result = configChecks.probe_port('127.0.0.1', 'imap', imap.port)
+        assert_true(time.time() - start < 0.75)
+        assert_true(result["plain"])
+        assert_equal(result["starttls"], None)
+
+    def test_stalled_resolver(self):
+        # A name server which never answers.
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = ['127.0.0.1']
+        resolver.port = server.getsockname()[1]
+        resolver.timeout = resolver.lifetime = 30
+        self.addCleanup(setattr, dns.resolver, 'default_resolver',
+                        dns.resolver.default_resolver)
+        dns.resolver.default_resolver = resolver
+        start = time.time()
+        probes = Probes(deadline=0.3)
+        probes.query('test.org', 'MX')
+        assert_equal(probes.answer('test.org', 'MX'), [])
+        probes.close()
+        # The lookup gives up at the deadline, so close() doesn't wait.
+        assert_true(time.time() - start < 1)
+
+    def test_step_timeout(self):
+        assert_equal(deadlines.step_timeout("connect"),
+                     deadlines.CONNECT_TIMEOUT)
+        assert_equal(deadlines.step_timeout("connect", 2), 2)
+        with deadlines.budget(time.time() - 1):
+            assert_true(deadlines.step_timeout("read") > 0)
+            assert_true(deadlines.step_timeout("read") < 0.01)
+
+    @override_settings(PROBE_READ_TIMEOUT=0.1, PROBE_CONNECT_TIMEOUT=0.1,
+                       PROBE_BREAKER_THRESHOLD=1)
+    def test_breaker(self):
+        # Probes stopped by a timeout count for the circuit breakers.
+        smtp = self.start(fakeservers.SMTPHandler, delay=1)
+        assert_equal(configChecks.cached_check_socket_type(
+                '127.0.0.1', 'smtp', 'SSL', smtp.port), None)
+        assert_equal(configChecks.server_breakers.state('127.0.0.1',
+                                                        smtp.port), "open")
+
+
+class HappyEyeballsTest(TestCase):
+
+    def setUp(self):
+        self.imap = fakeservers.start(fakeservers.IMAPHandler)
+        self.addCleanup(fakeservers.stop, self.imap)
+        # dual.test.org resolves to the addresses in self.addresses.
+        self.addresses = []
+        getaddrinfo = socket.getaddrinfo
+        self.addCleanup(setattr, socket, 'getaddrinfo', getaddrinfo)
+
+        def fake_getaddrinfo(host, *args):
+            if host == 'dual.test.org':
+                return self.addresses
+            return getaddrinfo(host, *args)
+        socket.getaddrinfo = fake_getaddrinfo
+
+    def address(self, family, host, port):
+        sockaddr = (host, port, 0, 0) if family == socket.AF_INET6 else \
+                   (host, port)
+        self.addresses.append((family, socket.SOCK_STREAM, 6, '', sockaddr))
+
+    def listener(self, backlog=None):
+        sock = socket.socket(socket.AF_INET6)
+        sock.bind(('::1', 0))
+        port = sock.getsockname()[1]
+        if backlog is None:
+            # Nothing listens on the port.
+            sock.close()
+        else:
+            sock.listen(backlog)
+            self.addCleanup(sock.close)
+        return port
+
+    def test_order(self):
+        self.address(socket.AF_INET6, '::1', 1)
+        self.address(socket.AF_INET6, '::2', 1)
+        self.address(socket.AF_INET, '127.0.0.1', 1)
+        assert_equal([info[4][0] for info in
+                      deadlines.addresses('dual.test.org', 1)],
+                     ['::1', '127.0.0.1', '::2'])
+
+    def stalled(self):
+        """
+        Return the port of a listener whose connections hang: its backlog is
+        full.
+        """
+        port = self.listener(0)
+        filler = socket.socket(socket.AF_INET6)
+        self.addCleanup(filler.close)
+        filler.connect(('::1', port))
+        return port
+
+    @override_settings(PROBE_CONNECT_STAGGER=0.1)
+    def test_stalled_address(self):
+        self.address(socket.AF_INET6, '::1', self.stalled())
+        self.address(socket.AF_INET, '127.0.0.1', self.imap.port)
+        start = time.time()
+        with deadlines.recording() as attempts:
+            assert_true(configChecks.imap_check_plain('dual.test.org',
+                                                      self.imap.port))
+        assert_true(time.time() - start < 1)
+        assert_equal([(a["family"], a["result"]) for a in attempts],
+                     [("IPv6", "abandoned"), ("IPv4", "connected")])
+
+    @override_settings(PROBE_CONNECT_STAGGER=0.2)
+    def test_deadline(self):
+        port = self.stalled()
+        for i in range(3):
+            self.address(socket.AF_INET6, '::1', port)
+        with deadlines.recording() as attempts:
+            assert_raises(socket.timeout, deadlines.connect,
+                          ('dual.test.org', port), 0.3)
+        # No address is tried past the timeout.
+        assert_equal(len(attempts), 2)
+
+    @override_settings(PROBE_CONNECT_STAGGER=0.1)
+    def test_abandoned(self):
+        self.address(socket.AF_INET6, '::1', self.stalled())
+        self.address(socket.AF_INET, '127.0.0.1', self.imap.port)
+        threads = set(threading.enumerate())
+        deadlines.connect(('dual.test.org', self.imap.port), 5).close()
+        # The attempt which lost the race doesn't hang on.
+        time.sleep(0.3)
+        assert_equal(set(threading.enumerate()) - threads, set())
+
+    def test_unexpected_error(self):
+        self.addresses.append((socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                               ('127.0.0.1', 'port')))
+        start = time.time()
+        with deadlines.recording() as attempts:
+            assert_raises(TypeError, deadlines.connect,
+                          ('dual.test.org', 1), 5)
+        assert_true(time.time() - start < 1)
+        assert_equal(attempts[0]["result"], "failed")
+
+    def test_refused(self):
+        port = self.listener(1)
+        self.address(socket.AF_INET6, '::1', self.listener())
+        self.address(socket.AF_INET6, '::1', port)
+        with deadlines.recording() as attempts:
+            sock = deadlines.create_connection(('dual.test.org', port))
+        sock.close()
+        assert_equal([a["result"] for a in attempts],
+                     ["failed", "connected"])
+        # Nothing answers.
+        self.addresses.pop()
+        try:
+            deadlines.create_connection(('dual.test.org', port))
+        except socket.error:
+            pass
+        else:
+            raise AssertionError("socket.error not raised")
+
+    def test_ipv6_warning(self):
+        self.address(socket.AF_INET6, '::1', self.listener())
+        self.address(socket.AF_INET, '127.0.0.1', self.imap.port)
+        # The second time, the probe comes from the cache.
+        for i in range(2):
+            probes = Probes()
+            probes.check('dual.test.org', 'imap', 'plain', self.imap.port)
+            assert_true(probes.result('dual.test.org', 'imap', 'plain',
+                                      self.imap.port))
+            assert_equal(probes.warnings(),
+                         ["Server 'dual.test.org' can't be reached over "
+                          "IPv6 (::1), only over IPv4."])
+            addresses = probes.capabilities()[0]["addresses"]
+            assert_equal([(a["address"], a["result"]) for a in addresses],
+                         [("::1", "failed"), ("127.0.0.1", "connected")])
+            probes.close()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import dns.exception
+import dns.resolver
+from django.test import TestCase
+from nose.tools import assert_equal
+
+from ispdb.config import configChecks, dnscache
+from ispdb.config.models import Config
+
+
+class FakeDNS(object):
+    "A lookup function answering from a dictionary, counting its calls."
+
+    def __init__(self, records, ttl=600):
+        self.records = records
+        self.ttl = ttl
+        self.lookups = []
+
+    def __call__(self, name, rdtype):
+        self.lookups.append((name, rdtype))
+        answer = self.records.get((name, rdtype))
+        if isinstance(answer, Exception):
+            raise answer
+        if answer is None:
+            raise dns.resolver.NXDOMAIN()
+        return (answer, self.ttl)
+
+
+class DNSCacheTest(TestCase):
+
+    fixtures = ['sanity']
+
+    def setUp(self):
+        self.dns = FakeDNS({
+            ('test.org', 'NS'): ['ns1.test.org.', 'ns2.test.org.'],
+            ('test.com', 'NS'): ['ns1.test.org.'],
+            ('test.org', 'MX'): ['10 mail.test.com.'],
+            ('test.com', 'MX'): ['10 mail.test.com.'],
+            ('timeout.org', 'MX'): dns.exception.Timeout(),
+        })
+        self.resolver = dnscache.CachingResolver(self.dns)
+
+    def test_cached(self):
+        assert_equal(self.resolver.query('test.org', 'NS'),
+                     ['ns1.test.org.', 'ns2.test.org.'])
+        assert_equal(self.resolver.query('TEST.org.', 'NS'),
+                     ['ns1.test.org.', 'ns2.test.org.'])
+        assert_equal(self.dns.lookups, [('test.org', 'NS')])
+        assert_equal(self.resolver.stats(), {'hits': 1, 'misses': 1})
+
+    def test_ttl(self):
+        self.dns.ttl = 0
+        self.resolver.query('test.org', 'NS')
+        self.resolver.query('test.org', 'NS')
+        assert_equal(len(self.dns.lookups), 2)
+
+    def test_negative_answers(self):
+        assert_equal(self.resolver.query('unknown.org', 'MX'), [])
+        assert_equal(self.resolver.query('unknown.org', 'MX'), [])
+        assert_equal(len(self.dns.lookups), 1)
+        # Failed lookups are not remembered.
+        assert_equal(self.resolver.query('timeout.org', 'MX'), [])
+        assert_equal(self.resolver.query('timeout.org', 'MX'), [])
+        assert_equal(len(self.dns.lookups), 3)
+
+    def test_domain_checks(self):
+        default = dnscache.resolver
+        dnscache.resolver = self.resolver
+        try:
+            domains = Config.objects.get(pk=1).domains.all()
+            first = configChecks.do_domain_checks(domains)
+            lookups = len(self.dns.lookups)
+            assert_equal(configChecks.do_domain_checks(domains), first)
+        finally:
+            dnscache.resolver = default
+        assert_equal(lookups, 4)
+        assert_equal(len(self.dns.lookups), 4)
+        assert_equal(first, ([], []))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
+from nose.tools import assert_equal, assert_true
+
+from ispdb.config import domainindex
+from ispdb.config.models import Domain
+
+
+class UnreadableCache(object):
+
+    def get(self, key, default=None):
+        raise AssertionError("read %s" % key)
+
+
+class DomainIndexTest(TestCase):
+
+    fixtures = ['xml_testdata']
+
+    def setUp(self):
+        domainindex.index.load()
+
+    def test_lookup(self):
+        with self.assertNumQueries(0):
+            assert_equal(domainindex.lookup("test.com"), 1)
+            assert_equal(domainindex.lookup("TEST.com"), 1)
+            assert_true(domainindex.lookup("unknown.com") is None)
+
+    def test_unknown_domain(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("ispdb_export_xml",
+                                               args=["unknown.com"]))
+        assert_equal(response.status_code, 404)
+
+    def test_known_domain(self):
+        response = self.client.get(reverse("ispdb_export_xml",
+                                           args=["test.com"]))
+        assert_equal(response.status_code, 200)
+        assert_true("<domain>test.com</domain>" in response.content)
+
+    def test_domain_case(self):
+        # Domain names are matched without regard to case.
+        response = self.client.get(reverse("ispdb_export_xml",
+                                           args=["Test.COM"]))
+        assert_equal(response.status_code, 200)
+        assert_true("<domain>test.com</domain>" in response.content)
+
+    def test_domain_changes(self):
+        domain = Domain.objects.create(name="test3.com", config_id=1)
+        assert_equal(domainindex.lookup("test3.com"), 1)
+        domain.name = "test4.com"
+        domain.save()
+        assert_true(domainindex.lookup("test3.com") is None)
+        assert_equal(domainindex.lookup("test4.com"), 1)
+        domain.delete()
+        assert_true(domainindex.lookup("test4.com") is None)
+
+    @override_settings(DOMAIN_INDEX_POLL=0)
+    def test_other_process(self):
+        # The index of another process sees the changes once it reads the
+        # generation token again, here on its next lookup.
+        other = domainindex.DomainIndex()
+        other.load()
+        domain = Domain.objects.create(name="test3.com", config_id=1)
+        assert_equal(other.lookup("test3.com"), 1)
+        domain.delete()
+        assert_true(other.lookup("test3.com") is None)
+
+    @override_settings(DOMAIN_INDEX_POLL=60)
+    def test_token_read(self):
+        # Within DOMAIN_INDEX_POLL seconds, lookups don't read the token.
+        other = domainindex.DomainIndex()
+        other.load()
+        other._cache = UnreadableCache()
+        assert_equal(other.lookup("test.com"), 1)
+        # Changes made by the process are seen at once.
+        domainindex.index.load()
+        Domain.objects.create(name="test3.com", config_id=1)
+        assert_equal(domainindex.lookup("test3.com"), 1)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from nose.tools import assert_equal, assert_true
+
+from ispdb import publicsuffix
+
+RULES = [u'com', u'uk', u'co.uk', u'ck', u'*.ck', u'!www.ck', u'jp',
+         u'*.kawasaki.jp', u'!city.kawasaki.jp', u'中国']
+
+
+class PublicSuffixTest(TestCase):
+
+    def setUp(self):
+        self.psl = publicsuffix.PublicSuffixList(RULES)
+
+    def split(self, hostname):
+        return tuple(self.psl.split(hostname))
+
+    def test_rules(self):
+        assert_equal(self.split('forums.bbc.co.uk'),
+                     ('forums', 'bbc', 'co.uk'))
+        assert_equal(self.split('mail.example.com.'),
+                     ('mail', 'example', 'com'))
+        # Wildcards and exceptions.
+        assert_equal(self.split('a.b.c.ck'), ('a', 'b', 'c.ck'))
+        assert_equal(self.split('www.ck'), ('', 'www', 'ck'))
+        assert_equal(self.split('a.city.kawasaki.jp'),
+                     ('a', 'city', 'kawasaki.jp'))
+        assert_equal(self.split('b.x.kawasaki.jp'),
+                     ('', 'b', 'x.kawasaki.jp'))
+        # The parts keep the case of the hostname.
+        assert_equal(self.split('Mail.Example.COM'),
+                     ('Mail', 'Example', 'COM'))
+
+    def test_invalid(self):
+        assert_equal(self.split('co.uk'), ('', '', 'co.uk'))
+        assert_equal(self.split('mail.example.invalid'),
+                     ('mail.example', 'invalid', ''))
+        assert_equal(self.split('127.0.0.1'), ('', '127.0.0.1', ''))
+        assert_equal(self.psl.registered_domain('co.uk'), '')
+        assert_equal(self.psl.registered_domain('example.invalid'), '')
+
+    def test_idna(self):
+        assert_equal(self.split(u'mail.example.中国'),
+                     (u'mail', u'example', u'中国'))
+        assert_equal(self.split('mail.example.xn--fiqs8s'),
+                     ('mail', 'example', 'xn--fiqs8s'))
+
+    def test_split_many(self):
+        hostnames = ['a.example.com', 'b.bbc.co.uk', 'a.example.com']
+        assert_equal(self.psl.split_many(hostnames),
+                     [self.psl.split(h) for h in hostnames])
+
+    def test_snapshot(self):
+        psl = publicsuffix.get()
+        assert_true(psl is publicsuffix.get())
+        assert_equal(psl.registered_domain('forums.bbc.co.uk'), 'bbc.co.uk')
+        # The private section is left out by default.
+        assert_equal(psl.registered_domain('foo.blogspot.com'),
+                     'blogspot.com')
+        assert_equal(publicsuffix.get(private=True).registered_domain(
+                'foo.blogspot.com'), 'foo.blogspot.com')
+
+
+class MappedPublicSuffixTest(PublicSuffixTest):
+    "The same lookups, in a compiled index."
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        path = os.path.join(self.tmpdir, 'rules.idx')
+        publicsuffix.compile_index(RULES, path)
+        self.psl = publicsuffix.MappedPublicSuffixList(path)
+
+    def test_command(self):
+        self.addCleanup(setattr, publicsuffix, 'COMPILED_DIR',
+                        publicsuffix.COMPILED_DIR)
+        self.addCleanup(publicsuffix._shared.update,
+                        publicsuffix._shared.copy())
+        self.addCleanup(publicsuffix._shared.clear)
+        publicsuffix.COMPILED_DIR = self.tmpdir
+        call_command('compile_suffixes', stdout=open(os.devnull, 'w'))
+        publicsuffix._shared.clear()
+        psl = publicsuffix.get()
+        assert_true(isinstance(psl, publicsuffix.MappedPublicSuffixList))
+        assert_equal(psl.registered_domain('forums.bbc.co.uk'), 'bbc.co.uk')
+        assert_equal(publicsuffix.get(private=True).registered_domain(
+                'foo.blogspot.com'), 'foo.blogspot.com')
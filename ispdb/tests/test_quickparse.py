@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_true
+
+from ispdb.tests.common import import_tool
+
+try:
+    import DNS
+except ImportError:
+    # pyDNS is only used for the MX lookups, which FakeDNS answers.
+    sys.modules['DNS'] = types.ModuleType('DNS')
+quickparse = import_tool('quickparse')
+
+LOG_LINE = ('%s - - [18/Oct/2026:00:00:00 +0000] "GET http://'
+            'live.mozillamessaging.com/autoconfig/%s HTTP/1.1" %s 12\n')
+
+
+class FakeDNS(object):
+    """
+    Stands for pyDNS: the MX server of each name is mx.<name>, the lookups
+    of names starting with "broken" blow up.
+    """
+
+    class DNSError(Exception):
+        pass
+
+    def __init__(self):
+        self.defaults = {"server": []}
+        self.queries = []
+        self.discovered = 0
+
+    def DiscoverNameServers(self):
+        self.discovered += 1
+        self.defaults["server"] = ["127.0.0.1"]
+
+    def DnsRequest(self, name, qtype):
+        return FakeRequest(self, name)
+
+
+class FakeResponse(object):
+
+    def __init__(self, name):
+        self.header = {"status": "NOERROR"}
+        self.answers = [{"typename": "MX", "ttl": 300,
+                         "data": (10, "mx." + name)}]
+
+
+class FakeRequest(object):
+
+    def __init__(self, dns, name):
+        self.dns = dns
+        self.name = name
+
+    def req(self):
+        self.dns.queries.append(self.name)
+        if self.name.startswith("broken"):
+            raise KeyError("answers")
+        return FakeResponse(self.name)
+
+
+class QuickParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.dns = FakeDNS()
+        self.addCleanup(setattr, quickparse, 'DNS', quickparse.DNS)
+        quickparse.DNS = self.dns
+
+    def write_log(self, name, requests):
+        """
+        Write a log of (ip, domain, code) requests, return its path.
+        """
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as log:
+            for request in requests:
+                log.write(LOG_LINE % request)
+        return path
+
+    def run_main(self, *args):
+        """
+        Run quickparse with the state and MX store in self.dir, return its
+        exit status and output.
+        """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO()
+        try:
+            status = quickparse.main(['quickparse',
+                '-s', os.path.join(self.dir, 'quickparse.sqlite'),
+                '-m', os.path.join(self.dir, 'mx.sqlite'), '-j', '1'] +
+                list(args))
+            return status, sys.stdout.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def test_empty_day(self):
+        log = self.write_log('20261018.log', [('10.0.0.1', 'a.com', '200')])
+        assert_equal(self.run_main(log)[0], 0)
+        # A day without requests, from the state alone.
+        status, output = self.run_main('-d', '2011-01-01')
+        assert_equal(status, 1)
+        assert_true('Nothing to report.' in output)
+
+    def test_backfill(self):
+        yesterday = self.write_log('20261017.log',
+                                   [('10.0.0.1', 'old.com', '404')])
+        today = self.write_log('20261018.log',
+                               [('10.0.0.2', 'new.com', '404')])
+        status, output = self.run_main(yesterday, today)
+        assert_equal(status, 0)
+        assert_true('Fastest rising misses:' in output)
+        # The totals of the day before are made without looking its MX
+        # servers up.
+        assert_equal(self.dns.queries, ['new.com'])
+
+    def test_shards(self):
+        # Lines of different lengths, so the shards split some of them.
+        log = self.write_log('20261018.log',
+                             [('10.0.%d.%d' % (i % 7, i % 13),
+                               'domain%d.com' % (i % 11) * (i % 3 + 1),
+                               ('200', '404')[i % 2]) for i in range(500)])
+        whole = quickparse.countLogs([log], 1)
+        sharded = quickparse.countLogs([log], 2, 1000)
+        assert_true(len(quickparse.shardLogs([log], 1000)) > 10)
+        assert_equal(sharded, whole)
+        assert_equal(sum(whole[log][0].values()), 500)
+
+    def test_shard_size(self):
+        try:
+            self.run_main('--shard-size', '0')
+        except SystemExit, e:
+            assert_equal(e.code, 2)
+        else:
+            raise AssertionError("SystemExit not raised")
+
+    def test_lookup_error(self):
+        store = quickparse.MXStore(os.path.join(self.dir, 'mx.sqlite'))
+        self.addCleanup(store.close)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            mxs = quickparse.resolveMXs(store, ['a.com', 'broken.com',
+                                                'b.com'], 2)
+        finally:
+            sys.stderr = stderr
+        # The other lookups go on, and the name servers are only looked for
+        # once.
+        assert_equal(mxs, {'a.com': 'a.com', 'broken.com': '',
+                           'b.com': 'b.com'})
+        assert_equal(self.dns.discovered, 1)
+        assert_equal(store.get(['broken.com']), {'broken.com': ''})
@@ -1,21 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import dns.resolver
-import imaplib
 import mox
-import poplib
 import smtplib
+import socket
+import time
 
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import simplejson
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_true
 
-from ispdb.config.configChecks import (do_domain_checks, do_config_checks,
-    get_nameservers, get_mxservers, imap_check_plain, imap_check_ssl,
-    imap_check_starttls, pop3_check_plain, pop3_check_ssl, pop3_check_starttls,
-    smtp_check_plain, smtp_check_ssl, smtp_check_starttls, TIMEOUT)
-from ispdb.config.models import Config
+from ispdb.config import configChecks, deadlines, dnscache, sanityjobs
+from ispdb.config.configChecks import (do_checks, do_domain_checks,
+    do_config_checks, get_nameservers, get_mxservers, imap_check_plain,
+    imap_check_ssl, imap_check_starttls, iter_checks, pop3_check_plain,
+    pop3_check_ssl, pop3_check_starttls, probe_port, Probes, smtp_check_plain,
+    smtp_check_ssl, smtp_check_starttls, TIMEOUT)
+from ispdb.config.models import Config, SanityJob, SanityResult
+from ispdb.tests import fakeservers
+from ispdb.tests.test_dnscache import FakeDNS
 
 
 def ns_message_text(domain, ndomain):
@@ -48,6 +53,8 @@ def mx_message_text(domain, ndomain):
             % {'domain': domain, 'ndomain': ndomain})
 
 
+# The mocks expect the probes in the order they are sent, run them one by one.
+@override_settings(SANITY_CHECK_WORKERS=1)
 class SanityTest(TestCase):
     "A class to test the sanity view."
 
@@ -55,13 +62,13 @@ class SanityTest(TestCase):
 
     def setUp(self):
         self.mox = mox.Mox()
-        self.mox.StubOutWithMock(dns.resolver, "query")
-        self.mox.StubOutClassWithMocks(smtplib, 'SMTP')
-        self.mox.StubOutClassWithMocks(smtplib, 'SMTP_SSL')
-        self.mox.StubOutClassWithMocks(imaplib, 'IMAP4')
-        self.mox.StubOutClassWithMocks(imaplib, 'IMAP4_SSL')
-        self.mox.StubOutClassWithMocks(poplib, 'POP3')
-        self.mox.StubOutClassWithMocks(poplib, 'POP3_SSL')
+        self.mox.StubOutWithMock(dns.resolver.Resolver, "query")
+        self.mox.StubOutClassWithMocks(deadlines, 'SMTP')
+        self.mox.StubOutClassWithMocks(deadlines, 'SMTP_SSL')
+        self.mox.StubOutClassWithMocks(deadlines, 'IMAP4')
+        self.mox.StubOutClassWithMocks(deadlines, 'IMAP4_SSL')
+        self.mox.StubOutClassWithMocks(deadlines, 'POP3')
+        self.mox.StubOutClassWithMocks(deadlines, 'POP3_SSL')
 
     def tearDown(self):
         self.mox.UnsetStubs()
@@ -73,12 +80,12 @@ class SanityTest(TestCase):
                                                         'test.org'))
         answer = dns.resolver.Answer(name, dns.rdatatype.NS,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.org', 'NS').AndReturn(answer)
+        dns.resolver.Resolver.query('test.org', 'NS').AndReturn(answer)
         message = dns.message.from_text(mx_message_text('test.org',
                                                         'test.org'))
         answer = dns.resolver.Answer(name, dns.rdatatype.MX,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.org', 'MX').AndReturn(answer)
+        dns.resolver.Resolver.query('test.org', 'MX').AndReturn(answer)
         self.mox.ReplayAll()
 
         #Test methods
@@ -97,14 +104,14 @@ class SanityTest(TestCase):
     def test_smtp_methods(self):
         # Set up our mock expectations.
         #plain
-        server = smtplib.SMTP('smtp.test.org', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP('smtp.test.org', 465, timeout=TIMEOUT)
         server.ehlo().AndReturn((250,
             'mx2.mail.corp.phx1.test.com\nPIPELINING\nSIZE '
             '31457280\nETRN\nAUTH LOGIN PLAIN'
             '\nENHANCEDSTATUSCODES\n8BITMIME\nDSN'))
         server.quit()
         #STARTTLS
-        server = smtplib.SMTP('smtp.test.org', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP('smtp.test.org', 465, timeout=TIMEOUT)
         server.ehlo()
         server.starttls().AndReturn((220, ''))
         server.ehlo().AndReturn((250,
@@ -113,7 +120,7 @@ class SanityTest(TestCase):
             'PLAIN\nENHANCEDSTATUSCODES\n8BITMIME\nDSN'))
         server.quit()
         #SSL
-        server = smtplib.SMTP_SSL('smtp.test.org', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP_SSL('smtp.test.org', 465, timeout=TIMEOUT)
         server.ehlo().AndReturn((250,
             'mx2.mail.corp.phx1.test.com\nPIPELINING\nSIZE '
             '31457280\nETRN\nAUTH LOGIN PLAIN NTLM CRAM-MD5 GSSAPI UNSUPPORTED'
@@ -153,14 +160,14 @@ class SanityTest(TestCase):
     def test_imap_methods(self):
         # Set up our mock expectations.
         #plain
-        server = imaplib.IMAP4('imap.test.org', 465)
+        server = deadlines.IMAP4('imap.test.org', 465)
         server.capabilities = ('IMAP4REV1', 'SASL-IR', 'SORT',
                 'THREAD=REFERENCES', 'MULTIAPPEND',
                 'UNSELECT', 'LITERAL+', 'IDLE', 'CHILDREN', 'NAMESPACE',
                 'LOGIN-REFERRALS', 'QUOTA', 'AUTH=PLAIN', 'AUTH=LOGIN')
         server.shutdown()
         #STARTTLS
-        server = imaplib.IMAP4('imap.test.org', 465)
+        server = deadlines.IMAP4('imap.test.org', 465)
         server.starttls()
         server.capabilities = ('IMAP4REV1', 'SASL-IR', 'SORT',
                 'THREAD=REFERENCES', 'MULTIAPPEND',
@@ -170,7 +177,7 @@ class SanityTest(TestCase):
                 'AUTH=UNSUPPORTED')
         server.shutdown()
         #SSL
-        server = imaplib.IMAP4_SSL('imap.test.org', 465)
+        server = deadlines.IMAP4_SSL('imap.test.org', 465)
         server.capabilities = ('IMAP4REV1', 'SASL-IR', 'SORT',
                 'THREAD=REFERENCES', 'MULTIAPPEND',
                 'UNSELECT', 'LITERAL+', 'IDLE', 'CHILDREN', 'NAMESPACE',
@@ -210,20 +217,20 @@ class SanityTest(TestCase):
     def test_pop_methods(self):
         # Set up our mock expectations.
         #plain
-        server = poplib.POP3('pop3.test.org', 465, timeout=TIMEOUT)
+        server = deadlines.POP3('pop3.test.org', 465, timeout=TIMEOUT)
         server._longcmd('CAPA').AndReturn(('+OK', ['CAPA', 'TOP',
             'LOGIN-DELAY 180', 'UIDL', 'RESP-CODES', 'PIPELINING', 'USER',
             'SASL PLAIN LOGIN'], 82))
         server.quit()
         #STARTTLS
-        server = poplib.POP3('pop3.test.org', 465, timeout=TIMEOUT)
+        server = deadlines.POP3('pop3.test.org', 465, timeout=TIMEOUT)
         server.stls()
         server._longcmd('CAPA').AndReturn(('+OK', ['CAPA', 'TOP',
             'LOGIN-DELAY 180', 'UIDL', 'RESP-CODES', 'PIPELINING', 'USER',
             'SASL PLAIN LOGIN CRAM-MD5 UNSUPPORTED NTLM GSSAPI'], 82))
         server.quit()
         #SSL
-        server = poplib.POP3_SSL('pop3.test.org', 465)
+        server = deadlines.POP3_SSL('pop3.test.org', 465)
         server._longcmd('CAPA').AndReturn(('+OK', ['CAPA', 'TOP',
             'LOGIN-DELAY 180', 'UIDL', 'RESP-CODES', 'PIPELINING', 'USER',
             'SASL PLAIN LOGIN'], 82))
@@ -267,33 +274,33 @@ class SanityTest(TestCase):
                                                         'test.org'))
         answer = dns.resolver.Answer(name, dns.rdatatype.NS,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.org', 'NS').AndReturn(answer)
+        dns.resolver.Resolver.query('test.org', 'NS').AndReturn(answer)
         name = dns.name.from_text('test.com.')
         message = dns.message.from_text(ns_message_text('test.com',
                                                         'test.org'))
         answer = dns.resolver.Answer(name, dns.rdatatype.NS,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.com', 'NS').AndReturn(answer)
+        dns.resolver.Resolver.query('test.com', 'NS').AndReturn(answer)
         name = dns.name.from_text('test.org.')
         message = dns.message.from_text(mx_message_text('test.org',
                                                         'test.org'))
         answer = dns.resolver.Answer(name, dns.rdatatype.MX,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.org', 'MX').AndReturn(answer)
+        dns.resolver.Resolver.query('test.org', 'MX').AndReturn(answer)
         name = dns.name.from_text('test.com.')
         message = dns.message.from_text(mx_message_text('test.com',
                                                         'test.org'))
         answer = dns.resolver.Answer(name, dns.rdatatype.MX,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.com', 'MX').AndReturn(answer)
+        dns.resolver.Resolver.query('test.com', 'MX').AndReturn(answer)
         # _do config _checks (imap SSL and stmp SSL)
-        server = imaplib.IMAP4_SSL('mail.test.com', 995)
+        server = deadlines.IMAP4_SSL('mail.test.com', 995)
         server.capabilities = ('IMAP4REV1', 'SASL-IR', 'SORT',
                 'THREAD=REFERENCES', 'MULTIAPPEND',
                 'UNSELECT', 'LITERAL+', 'IDLE', 'CHILDREN', 'NAMESPACE',
                 'LOGIN-REFERRALS', 'QUOTA', 'AUTH=PLAIN', 'AUTH=LOGIN')
         server.shutdown()
-        server = smtplib.SMTP_SSL('mail.test.com', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP_SSL('mail.test.com', 465, timeout=TIMEOUT)
         server.ehlo().AndReturn((250,
             'mx2.mail.corp.phx1.test.com\nPIPELINING\nSIZE '
             '31457280\nETRN\nAUTH LOGIN PLAIN'
@@ -304,7 +311,13 @@ class SanityTest(TestCase):
         # Test the method.
         self.client.login(username='test_admin', password='test')
         response = self.client.get(reverse("ispdb_sanity", args=[1]), {})
+        assert_equal(response.status_code, 202)
         data = simplejson.loads(response.content)
+        assert_equal(data["status"], "queued")
+        sanityjobs.work(once=True)
+        response = self.client.get(data["url"], {})
+        data = simplejson.loads(response.content)
+        assert_equal(data["status"], "done")
         warnings = data["warnings"]
         errors = data["errors"]
 
@@ -312,6 +325,94 @@ class SanityTest(TestCase):
         self.mox.VerifyAll()
         assert_equal(len(warnings), 0)
         assert_equal(len(errors), 0)
+        # The results are kept with what the servers reported.
+        sanity_result = SanityResult.objects.get(config=1)
+        capabilities = simplejson.loads(sanity_result.capabilities)
+        assert_equal([(c["hostname"], c["type"], c["socket_type"], c["port"])
+                      for c in capabilities],
+                     [('mail.test.com', 'imap', 'SSL', 995),
+                      ('mail.test.com', 'smtp', 'SSL', 465)])
+        assert_equal(capabilities[0]["capabilities"]["password-cleartext"],
+                     "LOGIN")
+
+    def test_stored_results(self):
+        SanityResult.objects.create(config_id=1,
+                                    errors=simplejson.dumps(["An error."]),
+                                    warnings="[]", capabilities="[]")
+        self.client.login(username='test_admin', password='test')
+        # Recent results are returned without running the checks.
+        response = self.client.get(reverse("ispdb_sanity", args=[1]), {})
+        assert_equal(response.status_code, 200)
+        data = simplejson.loads(response.content)
+        assert_equal((data["status"], data["errors"]), ("done", ["An error."]))
+        assert_equal(SanityJob.objects.count(), 0)
+        response = self.client.get(reverse("ispdb_details", args=[1]))
+        assert_true("An error." in response.content)
+        # Unless asked to.
+        response = self.client.get(reverse("ispdb_sanity", args=[1]),
+                                   {"rerun": 1})
+        assert_equal(response.status_code, 202)
+        assert_equal(SanityJob.objects.count(), 1)
+
+    @override_settings(SANITY_RESULT_MAX_AGE=0)
+    def test_stale_results(self):
+        SanityResult.objects.create(config_id=1, errors="[]", warnings="[]",
+                                    capabilities="[]")
+        self.client.login(username='test_admin', password='test')
+        response = self.client.get(reverse("ispdb_sanity", args=[1]), {})
+        assert_equal(response.status_code, 202)
+        response = self.client.get(reverse("ispdb_details", args=[1]))
+        assert_true("(out of date)" in response.content)
+
+    def test_sanity_job_deduplication(self):
+        self.client.login(username='test_admin', password='test')
+        response = self.client.get(reverse("ispdb_sanity", args=[1]), {})
+        first = simplejson.loads(response.content)
+        response = self.client.get(reverse("ispdb_sanity", args=[1]), {})
+        assert_equal(simplejson.loads(response.content)["id"], first["id"])
+        # A claimed job is still the one returned.
+        job = sanityjobs.claim()
+        assert_equal(job.id, first["id"])
+        assert_equal(job.status, "running")
+        assert_equal(sanityjobs.claim(), None)
+        response = self.client.get(reverse("ispdb_sanity", args=[1]), {})
+        data = simplejson.loads(response.content)
+        assert_equal((data["id"], data["status"]), (job.id, "running"))
+        # Once it is over a new job is queued.
+        SanityJob.objects.filter(pk=job.id).update(status="done")
+        response = self.client.get(reverse("ispdb_sanity", args=[1]), {})
+        assert_true(simplejson.loads(response.content)["id"] != job.id)
+
+    def test_worker_transactions(self):
+        # Each look for jobs starts a new transaction.
+        self.mox.StubOutWithMock(sanityjobs.transaction,
+                                 'commit_unless_managed')
+        sanityjobs.transaction.commit_unless_managed()
+        self.mox.ReplayAll()
+        sanityjobs.work(once=True)
+        self.mox.VerifyAll()
+
+    def test_worker_errors(self):
+        # A job whose results can't be stored fails, the next one still runs.
+        first = SanityJob.objects.create(config_id=1)
+        second = SanityJob.objects.create(config_id=1)
+
+        def do_checks(config, domains, details):
+            details["capabilities"] = []
+            return [], []
+        self.mox.stubs.Set(configChecks, 'do_checks', do_checks)
+        self.mox.StubOutWithMock(sanityjobs, 'save_result')
+        sanityjobs.save_result(mox.IgnoreArg(), [], [], []).AndRaise(
+                Exception("database is locked"))
+        sanityjobs.save_result(mox.IgnoreArg(), [], [], [])
+        self.mox.ReplayAll()
+        sanityjobs.work(once=True)
+        self.mox.VerifyAll()
+        assert_equal(sanityjobs.result(SanityJob.objects.get(pk=first.pk)),
+                     {"id": first.pk, "status": "failed", "warnings": [],
+                      "errors": ["Error running sanity checks: "
+                                 "database is locked"]})
+        assert_equal(SanityJob.objects.get(pk=second.pk).status, "done")
 
     def test_do_domain_checks_errors(self):
         """ Test all import error/warnings returned by do_domain_checks
@@ -325,13 +426,13 @@ class SanityTest(TestCase):
                                                         'test.org'))
         answer = dns.resolver.Answer(name, dns.rdatatype.NS,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.org', 'NS').AndReturn(answer)
+        dns.resolver.Resolver.query('test.org', 'NS').AndReturn(answer)
         name = dns.name.from_text('test.com.')
         message = dns.message.from_text(ns_message_text('test.com',
                                                         'test.com'))
         answer = dns.resolver.Answer(name, dns.rdatatype.NS,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.com', 'NS').AndReturn(answer)
+        dns.resolver.Resolver.query('test.com', 'NS').AndReturn(answer)
         # now do_domain_checks will get domain name of all Domain objects and
         # its MX servers and compare against domain names of incoming server
         # and outgoing server. If they are different it will create an error
@@ -341,13 +442,13 @@ class SanityTest(TestCase):
                                                         'test.org'))
         answer = dns.resolver.Answer(name, dns.rdatatype.MX,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.org', 'MX').AndReturn(answer)
+        dns.resolver.Resolver.query('test.org', 'MX').AndReturn(answer)
         name = dns.name.from_text('test.com.')
         message = dns.message.from_text(mx_message_text('test.com',
                                                         'test.com'))
         answer = dns.resolver.Answer(name, dns.rdatatype.MX,
                                      dns.rdataclass.IN, message)
-        dns.resolver.query('test.com', 'MX').AndReturn(answer)
+        dns.resolver.Resolver.query('test.com', 'MX').AndReturn(answer)
 
         self.mox.ReplayAll()
 
@@ -367,14 +468,14 @@ class SanityTest(TestCase):
     def test_do_config_checks_no_errors(self):
         # Set up our mock expectations.
         #plain
-        server = smtplib.SMTP('smtp.test.org', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP('smtp.test.org', 465, timeout=TIMEOUT)
         server.ehlo().AndReturn((250,
             'mx2.mail.corp.phx1.test.com\nPIPELINING\nSIZE '
             '31457280\nETRN\nAUTH LOGIN PLAIN'
             '\nENHANCEDSTATUSCODES\n8BITMIME\nDSN'))
         server.quit()
         #STARTTLS
-        server = smtplib.SMTP('smtp.test.org', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP('smtp.test.org', 465, timeout=TIMEOUT)
         server.ehlo()
         server.starttls().AndReturn((220, ''))
         server.ehlo().AndReturn((250,
@@ -383,7 +484,7 @@ class SanityTest(TestCase):
             'PLAIN\nENHANCEDSTATUSCODES\n8BITMIME\nDSN'))
         server.quit()
         #SSL
-        server = smtplib.SMTP_SSL('smtp.test.org', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP_SSL('smtp.test.org', 465, timeout=TIMEOUT)
         server.ehlo().AndReturn((250,
             'mx2.mail.corp.phx1.test.com\nPIPELINING\nSIZE '
             '31457280\nETRN\nAUTH LOGIN PLAIN NTLM CRAM-MD5 GSSAPI UNSUPPORTED'
@@ -426,27 +527,29 @@ class SanityTest(TestCase):
         # it doesn't support STARTTLS, do_config_checks should return 1 error
         # and 1 warning for each server (incoming and outgoing)
         # IMAP SSL
-        server = imaplib.IMAP4_SSL('mail.test.com', 993)
+        server = deadlines.IMAP4_SSL('mail.test.com', 993)
         server.capabilities = ('IMAP4REV1', 'SASL-IR', 'SORT',
                 'THREAD=REFERENCES', 'MULTIAPPEND',
                 'UNSELECT', 'LITERAL+', 'IDLE', 'CHILDREN', 'NAMESPACE',
                 'LOGIN-REFERRALS', 'QUOTA', 'AUTH=PLAIN', 'AUTH=LOGIN')
         server.shutdown()
-        # IMAP STARTTLS
-        server = imaplib.IMAP4('mail.test.com', 995)
+        # IMAP plain and STARTTLS, probed with one connection
+        server = deadlines.IMAP4('mail.test.com', 995)
+        server.capabilities = ('IMAP4REV1', 'AUTH=PLAIN', 'AUTH=LOGIN')
         server.starttls().AndRaise(Exception("STARTTLS extension not supported"
                 "by server."))
         server.shutdown()
         # SMTP SSL
-        server = smtplib.SMTP_SSL('mail.test.com', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP_SSL('mail.test.com', 465, timeout=TIMEOUT)
         server.ehlo().AndReturn((250,
             'mx2.mail.corp.phx1.test.com\nPIPELINING\nSIZE '
             '31457280\nETRN\nAUTH LOGIN PLAIN NTLM CRAM-MD5 GSSAPI UNSUPPORTED'
             '\nENHANCEDSTATUSCODES\n8BITMIME\nDSN'))
         server.quit()
-        # SMTP STARTTLS
-        server = smtplib.SMTP('mail.test.com', 465, timeout=TIMEOUT)
-        server.ehlo()
+        # SMTP plain and STARTTLS, probed with one connection
+        server = deadlines.SMTP('mail.test.com', 465, timeout=TIMEOUT)
+        server.ehlo().AndReturn((250, 'mx2.mail.corp.phx1.test.com\n'
+                                      'AUTH LOGIN PLAIN'))
         server.starttls().AndRaise(smtplib.SMTPException("STARTTLS extension"
                 "not supported by server."))
         server.quit()
@@ -471,7 +574,7 @@ class SanityTest(TestCase):
         # do_config_checks should return 1 error and 1 warning for each server
         # incoming and outgoing)
         # IMAP SSL
-        server = imaplib.IMAP4_SSL('mail.test.com', 995)
+        server = deadlines.IMAP4_SSL('mail.test.com', 995)
         server.capabilities = ('IMAP4REV1', 'SASL-IR', 'SORT',
                 'THREAD=REFERENCES', 'MULTIAPPEND',
                 'UNSELECT', 'LITERAL+', 'IDLE', 'CHILDREN', 'NAMESPACE',
@@ -479,7 +582,7 @@ class SanityTest(TestCase):
                 'AUTH=GSSAPI')
         server.shutdown()
         # SMTP SSL
-        server = smtplib.SMTP_SSL('mail.test.com', 465, timeout=TIMEOUT)
+        server = deadlines.SMTP_SSL('mail.test.com', 465, timeout=TIMEOUT)
         server.ehlo().AndReturn((250,
             'mx2.mail.corp.phx1.test.com\nPIPELINING\nSIZE '
             '31457280\nETRN\nAUTH LOGIN PLAIN NTLM GSSAPI UNSUPPORTED'
@@ -498,3 +601,217 @@ class SanityTest(TestCase):
         self.mox.VerifyAll()
         assert_equal(len(errors), 2)
         assert_equal(len(warnings), 2)
+
+
+class ProbesTest(TestCase):
+    "A class to test the sanity checks against local servers."
+
+    fixtures = ['login_testdata', 'sanity']
+
+    def setUp(self):
+        self.servers = []
+        # The checks also try the default ports of the other socket types,
+        # point them to ports nothing listens on rather than to whatever
+        # runs on this host.
+        self.addCleanup(configChecks._checks.update,
+                        dict(configChecks._checks))
+        ports = {}
+        for key, (func, port) in configChecks._checks.items():
+            if port not in ports:
+                sock = socket.socket()
+                sock.bind(('127.0.0.1', 0))
+                self.addCleanup(sock.close)
+                ports[port] = sock.getsockname()[1]
+            configChecks._checks[key] = (func, ports[port])
+
+    def tearDown(self):
+        for server in self.servers:
+            fakeservers.stop(server)
+
+    def start(self, handler, delay=0, starttls=False):
+        server = fakeservers.start(handler, delay, starttls)
+        self.servers.append(server)
+        return server
+
+    def local_config(self, incoming_type, incoming, outgoing):
+        config = Config.objects.get(pk=1)
+        config.incoming_type = incoming_type
+        config.incoming_hostname = "127.0.0.1"
+        config.incoming_port = incoming.port
+        config.incoming_socket_type = 'plain'
+        config.outgoing_hostname = "127.0.0.1"
+        config.outgoing_port = outgoing.port
+        config.outgoing_socket_type = 'plain'
+        return config
+
+    def test_imap_smtp(self):
+        imap = self.start(fakeservers.IMAPHandler, delay=0.5)
+        smtp = self.start(fakeservers.SMTPHandler, delay=0.5)
+        config = self.local_config('imap', imap, smtp)
+        start = time.time()
+        errors, warnings = do_config_checks(config)
+        # Both servers are probed at the same time.
+        assert_true(time.time() - start < 0.9)
+        assert_equal(errors, [])
+        assert_equal(warnings, [])
+
+    def test_pop3(self):
+        pop3 = self.start(fakeservers.POP3Handler)
+        smtp = self.start(fakeservers.SMTPHandler)
+        config = self.local_config('pop3', pop3, smtp)
+        config.incoming_authentication = 'password-encrypted'
+        errors, warnings = do_config_checks(config)
+        assert_equal(errors, ["Incoming server '127.0.0.1' does not support "
+                              "auth type password-encrypted."])
+        assert_equal(warnings, [])
+
+    @override_settings(SANITY_CHECK_DEADLINE=0.2)
+    def test_deadline(self):
+        imap = self.start(fakeservers.IMAPHandler, delay=1)
+        smtp = self.start(fakeservers.SMTPHandler, delay=1)
+        config = self.local_config('imap', imap, smtp)
+        start = time.time()
+        errors, warnings = do_config_checks(config)
+        assert_true(time.time() - start < 0.8)
+        assert_equal(len(errors), 2)
+        assert_equal(warnings, ["2 checks didn't finish within 0.2 seconds."])
+
+    def test_skipped_server(self):
+        imap = self.start(fakeservers.IMAPHandler)
+        smtp = self.start(fakeservers.SMTPHandler)
+        config = self.local_config('imap', imap, smtp)
+        # The breaker of the outgoing server is open.
+        self.addCleanup(configChecks.server_breakers.reset, '127.0.0.1',
+                        smtp.port)
+        for i in range(3):
+            configChecks.server_breakers.failure('127.0.0.1', smtp.port)
+        assert_equal(do_config_checks(config),
+                     ([], ["Outgoing server '127.0.0.1' not checked: server "
+                           "temporarily skipped after repeated failures."]))
+        assert_equal(smtp.connections, 0)
+
+    def test_cached_probes(self):
+        imap = self.start(fakeservers.IMAPHandler)
+        smtp = self.start(fakeservers.RefusingSMTPHandler)
+        config = self.local_config('imap', imap, smtp)
+        first = do_config_checks(config)
+        assert_equal(len(first[0]), 1)
+        connections = (imap.connections, smtp.connections)
+        assert_equal(connections, (1, 1))
+        # Running the checks again only uses the cached results, including
+        # the failed one.
+        assert_equal(do_config_checks(config), first)
+        assert_equal((imap.connections, smtp.connections), connections)
+
+    def test_probe_port(self):
+        for proto, handler in (('imap', fakeservers.IMAPHandler),
+                               ('pop3', fakeservers.POP3Handler),
+                               ('smtp', fakeservers.SMTPHandler)):
+            server = self.start(handler, starttls=True)
+            result = probe_port('127.0.0.1', proto, server.port)
+            # Both socket types are checked with a single connection, and
+            # the methods offered after STARTTLS are told apart.
+            assert_equal(server.connections, 1)
+            assert_equal(result["plain"]["password-cleartext"], "PLAIN")
+            assert_equal(result["plain"]["password-encrypted"], None)
+            assert_equal(result["starttls"]["password-encrypted"], "CRAM-MD5")
+            server = self.start(handler)
+            result = probe_port('127.0.0.1', proto, server.port)
+            assert_equal(server.connections, 1)
+            assert_true(result["plain"])
+            assert_equal(result["starttls"], None)
+
+    def test_probe_port_refused(self):
+        server = self.start(fakeservers.RefusingSMTPHandler)
+        assert_equal(probe_port('127.0.0.1', 'smtp', server.port),
+                     {"plain": None, "starttls": None})
+
+    def test_probe_port_capa_dropped(self):
+        # The server answered, it just couldn't tell its capabilities.
+        server = self.start(fakeservers.DroppingPOP3Handler)
+        assert_equal(probe_port('127.0.0.1', 'pop3', server.port),
+                     {"plain": {}, "starttls": None})
+
+    def test_one_connection_per_port(self):
+        imap = self.start(fakeservers.IMAPHandler, starttls=True)
+        smtp = self.start(fakeservers.SMTPHandler, starttls=True)
+        config = self.local_config('imap', imap, smtp)
+        config.incoming_socket_type = 'STARTTLS'
+        config.outgoing_socket_type = 'STARTTLS'
+        config.incoming_authentication = 'password-encrypted'
+        config.outgoing_authentication = 'password-encrypted'
+        assert_equal(do_config_checks(config), ([], []))
+        assert_equal((imap.connections, smtp.connections), (1, 1))
+
+    def test_probe_error(self):
+        def lookup(name, rdtype):
+            raise RuntimeError("Boom")
+        self.addCleanup(setattr, dnscache, 'resolver', dnscache.resolver)
+        dnscache.resolver = dnscache.CachingResolver()
+        dnscache.resolver.query = lookup
+        probes = Probes()
+        probes.query('test.org', 'MX')
+        # A probe which raises counts as a failed one.
+        assert_equal(probes.answer('test.org', 'MX'), [])
+        assert_equal(probes.findings(('test.org', 'MX'))[0]["records"], [])
+        probes.close()
+
+    def test_probes_share_port(self):
+        imap = self.start(fakeservers.IMAPHandler, starttls=True)
+        probes = Probes()
+        probes.check('127.0.0.1', 'imap', 'plain', imap.port)
+        probes.check('127.0.0.1', 'imap', 'STARTTLS', imap.port)
+        plain = probes.result('127.0.0.1', 'imap', 'plain', imap.port)
+        starttls = probes.result('127.0.0.1', 'imap', 'STARTTLS', imap.port)
+        probes.close()
+        assert_equal(plain["password-encrypted"], None)
+        assert_equal(starttls["password-encrypted"], "CRAM-MD5")
+        assert_equal(imap.connections, 1)
+
+    def test_iter_checks(self):
+        imap = self.start(fakeservers.IMAPHandler)
+        smtp = self.start(fakeservers.SMTPHandler, delay=0.5)
+        config = self.local_config('imap', imap, smtp)
+        start = time.time()
+        events = []
+        for event in iter_checks(config, []):
+            events.append((event, time.time() - start))
+        # The incoming server is reported before the slow outgoing one.
+        server = [e for e in events if e[0]["event"] == "server" and
+                  e[0]["port"] == imap.port][0]
+        assert_equal(server[0]["capabilities"]["password-cleartext"],
+                     "LOGIN")
+        assert_true(server[1] < 0.4)
+        assert_equal(events[0][0], {"event": "domains", "errors": [],
+                                    "warnings": []})
+        assert_equal([e[0]["event"] for e in events[-2:]],
+                     ["servers", "summary"])
+        summary = events[-1][0]
+        assert_equal((summary["errors"], summary["warnings"]),
+                     do_checks(config, []))
+
+    def test_sanity_stream(self):
+        self.addCleanup(setattr, dnscache, 'resolver', dnscache.resolver)
+        dnscache.resolver = dnscache.CachingResolver(FakeDNS({
+            ('test.org', 'NS'): ['ns1.test.org.'],
+            ('test.com', 'NS'): ['ns1.test.org.'],
+            ('test.org', 'MX'): ['10 mail.test.com.'],
+            ('test.com', 'MX'): ['10 mail.test.com.'],
+        }))
+        imap = self.start(fakeservers.IMAPHandler)
+        smtp = self.start(fakeservers.SMTPHandler)
+        self.local_config('imap', imap, smtp).save()
+        self.client.login(username='test_admin', password='test')
+        response = self.client.get(reverse("ispdb_sanity_stream", args=[1]))
+        assert_equal(response["Content-Type"], "application/x-ndjson")
+        events = [simplejson.loads(line)
+                  for line in response.content.splitlines()]
+        assert_equal(sorted((e["domain"], e["rdtype"]) for e in events
+                            if e["event"] == "dns"),
+                     [('test.com', 'MX'), ('test.com', 'NS'),
+                      ('test.org', 'MX'), ('test.org', 'NS')])
+        summary = events[-1]
+        assert_equal(summary["event"], "summary")
+        # The summary is stored like the results of a job.
+        assert_equal(sanityjobs.stored(sanityjobs.latest(Config(pk=1)))[
+                "errors"], summary["errors"])
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+
+from nose.tools import assert_equal, assert_true
+
+from ispdb.tests.common import import_tool
+
+sketches = import_tool('sketches')
+
+
+def skewed_stream(keys=1000, seed=0):
+    """
+    Return a shuffled stream where key i is seen about 1 / (i + 1) as often
+    as key 0, and how many times each key is in it.
+    """
+    exact = dict(('key%d' % i, max(1, 2000 // (i + 1)))
+                 for i in range(keys))
+    stream = [key for key, count in exact.iteritems() for j in range(count)]
+    random.Random(seed).shuffle(stream)
+    return stream, exact
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stream, self.exact = skewed_stream()
+        self.k = 50
+        self.bound = len(self.stream) / float(self.k)
+
+    def summarize(self, stream):
+        summary = sketches.SpaceSaving(self.k)
+        for key in stream:
+            summary.add(key)
+        return summary
+
+    def assert_bounded(self, summary):
+        assert_equal(summary.total, len(self.stream))
+        assert_true(summary.maxError() <= self.bound)
+        for key, count in summary.counts.iteritems():
+            assert_true(self.exact[key] <= count)
+            assert_true(count <= self.exact[key] + summary.errors[key])
+        # The keys seen more than total / k times are all kept.
+        for key, count in self.exact.iteritems():
+            if count > self.bound:
+                assert_true(key in summary.counts)
+
+    def test_error(self):
+        summary = self.summarize(self.stream)
+        assert_equal(len(summary.counts), self.k)
+        self.assert_bounded(summary)
+
+    def test_merge(self):
+        half = len(self.stream) // 2
+        merged = self.summarize(self.stream[:half])
+        merged.merge(self.summarize(self.stream[half:]))
+        self.assert_bounded(merged)
+        single = self.summarize(self.stream)
+        for key, count in single.counts.iteritems():
+            assert_true(abs(merged.counts.get(key, merged.floor()) - count)
+                        <= self.bound)
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    def count(self, keys, precision=14):
+        hll = sketches.HyperLogLog(precision)
+        for key in keys:
+            hll.add(key)
+        return hll
+
+    def test_small_range(self):
+        # Few keys are counted from the empty registers, almost exactly.
+        assert_equal(self.count([]).count(), 0)
+        estimate = self.count('key%d' % i for i in range(100)).count()
+        assert_true(abs(estimate - 100) <= 2)
+
+    def test_error(self):
+        hll = self.count(('key%d' % i for i in range(20000)), 10)
+        # Three times the standard error.
+        assert_true(abs(hll.count() - 20000) <=
+                    3 * hll.relativeError() * 20000)
+
+    def test_merge(self):
+        keys = ['key%d' % i for i in range(5000)]
+        merged = self.count(keys[:3000])
+        merged.merge(self.count(keys[2000:]))
+        assert_equal(merged.count(), self.count(keys).count())
+
+
+class SampledCounterTest(unittest.TestCase):
+
+    def test_histogram(self):
+        stream, exact = skewed_stream(keys=200)
+        sample = sketches.SampledCounter(1000)
+        for key in stream:
+            sample.add(key)
+        # Everything fits, nothing is sampled out.
+        assert_equal(sample.rate(), 1)
+        histogram = {}
+        for count in exact.itervalues():
+            histogram[count] = histogram.get(count, 0) + 1
+        assert_equal(sample.histogram(), histogram)
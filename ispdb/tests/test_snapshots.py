@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from nose.tools import assert_equal, assert_true
+
+from ispdb.config import serializers, snapshots
+from ispdb.config.models import (Config, ConfigSnapshot, DocURL, DocURLDesc,
+    Domain)
+
+
+class SnapshotTest(TestCase):
+
+    fixtures = ['xml_testdata']
+
+    def setUp(self):
+        # Fixtures are loaded raw, so the store starts out empty.
+        snapshots.rebuild_all()
+
+    def test_rebuild_all(self):
+        config = Config.objects.get(pk=1)
+        for version, serialize in serializers.versions():
+            assert_equal(snapshots.get(1, version), serialize(config))
+        assert_equal(snapshots.get(1), serializers.xmlOneDotZero(config))
+
+    def test_unknown_config(self):
+        assert_true(snapshots.get(1000) is None)
+
+    def test_export_xml_uses_snapshot(self):
+        ConfigSnapshot.objects.filter(config=1, version="1.1").update(
+                xml="<snapshot/>")
+        response = self.client.get(reverse("ispdb_export_xml",
+                                           args=["1.1", "1"]))
+        assert_equal(response.content, "<snapshot/>")
+
+    def test_config_change(self):
+        config = Config.objects.get(pk=1)
+        config.display_name = "Changed Name"
+        config.save()
+        assert_true("Changed Name" in snapshots.get(1, "1.1"))
+
+    def test_domain_change(self):
+        Domain.objects.create(name="test3.com", config_id=1)
+        assert_true("test3.com" in snapshots.get(1, "1.1"))
+        Domain.objects.get(name="test3.com").delete()
+        assert_true("test3.com" not in snapshots.get(1, "1.1"))
+
+    def test_docurl_change(self):
+        docurl = DocURL.objects.create(url="http://changed.com/", config_id=1)
+        DocURLDesc.objects.create(docurl=docurl, language="fr",
+                                  description="Description changed")
+        xml = snapshots.get(1, "1.1")
+        assert_true("http://changed.com/" in xml)
+        assert_true("Description changed" in xml)
+        docurl.delete()
+        xml = snapshots.get(1, "1.1")
+        assert_true("http://changed.com/" not in xml)
+        assert_true("Description changed" not in xml)
+
+    def test_not_approved(self):
+        config = Config.objects.get(pk=1)
+        config.status = 'invalid'
+        config.save()
+        assert_true(snapshots.get(1) is None)
+        # The view still serves the configuration.
+        response = self.client.get(reverse("ispdb_export_xml", args=["1"]))
+        assert_equal(response.status_code, 200)
+        assert_equal(response.content, serializers.xmlOneDotZero(config))
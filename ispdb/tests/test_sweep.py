@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import simplejson
+from nose.tools import assert_equal, assert_true
+
+from ispdb.config import dnscache, sweep
+from ispdb.config.models import Config, Domain
+from ispdb.tests import fakeservers
+from ispdb.tests.test_dnscache import FakeDNS
+
+
+class SweepTest(TestCase):
+
+    fixtures = ['login_testdata', 'sanity']
+
+    def setUp(self):
+        self.imap = fakeservers.start(fakeservers.IMAPHandler)
+        self.addCleanup(fakeservers.stop, self.imap)
+        self.smtp = fakeservers.start(fakeservers.SMTPHandler)
+        self.addCleanup(fakeservers.stop, self.smtp)
+        self.addCleanup(setattr, dnscache, 'resolver', dnscache.resolver)
+        self.dns = FakeDNS({})
+        dnscache.resolver = dnscache.CachingResolver(self.dns)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # A working configuration, one whose incoming server doesn't answer
+        # and one whose outgoing server answers without SSL.
+        self.ok = self.local_config('ok.test.org')
+        self.down = self.local_config('down.test.org', incoming_port=1)
+        self.no_tls = self.local_config('notls.test.org',
+                                        outgoing_socket_type='SSL')
+
+    def local_config(self, domain, **fields):
+        config = Config.objects.get(pk=1)
+        config.pk = None
+        config.status = "approved"
+        config.incoming_type = "imap"
+        config.incoming_hostname = "127.0.0.1"
+        config.incoming_port = self.imap.port
+        config.incoming_socket_type = "plain"
+        config.outgoing_hostname = "127.0.0.1"
+        config.outgoing_port = self.smtp.port
+        config.outgoing_socket_type = "plain"
+        for name, value in fields.items():
+            setattr(config, name, value)
+        config.save()
+        Domain.objects.create(name=domain, config=config)
+        self.dns.records[(domain, 'NS')] = ['ns1.test.org.']
+        self.dns.records[(domain, 'MX')] = ['10 mail.test.org.']
+        return config
+
+    def test_sweep(self):
+        configs = list(sweep.approved_configs())
+        # The sweepers don't query the database.
+        with self.assertNumQueries(0):
+            results = sweep.sweep(configs, workers=4,
+                                  limiter=sweep.HostLimiter(2, 0))
+        assert_equal([r["id"] for r in results],
+                     [self.ok.id, self.down.id, self.no_tls.id])
+        report = sweep.report(results)
+        assert_equal(report["checked"], 3)
+        problems = dict((r["id"], [(p["server"], p["problem"])
+                                   for p in r["problems"]])
+                        for r in report["problems"])
+        assert_equal(problems, {self.down.id: [("incoming", "unreachable")],
+                                self.no_tls.id: [("outgoing", "tls_lost")]})
+
+    def test_filters(self):
+        assert_equal(list(sweep.approved_configs([self.down.id])),
+                     [self.down])
+        assert_equal(len(sweep.approved_configs(host="127.0.0.1")), 3)
+        assert_equal(len(sweep.approved_configs(host="mail.test.com")), 0)
+
+    def test_resume(self):
+        state = os.path.join(self.tmpdir, "state")
+        limiter = sweep.HostLimiter(2, 0)
+        first = sweep.sweep(sweep.approved_configs([self.ok.id]),
+                            limiter=limiter, state=state)
+        # An interrupted sweep may leave half a line behind.
+        with open(state, "a") as output:
+            output.write('{"id": ')
+        checked = []
+        results = sweep.sweep(sweep.approved_configs(), limiter=limiter,
+                              state=state, progress=checked.append)
+        assert_equal(results[0], first[0])
+        # Only the two other configurations were checked.
+        assert_equal(sorted(result["id"] for result in checked),
+                     [self.down.id, self.no_tls.id])
+        assert_equal(sorted(sweep.load_state(state).keys()),
+                     sorted([self.ok.id, self.down.id, self.no_tls.id]))
+
+    def test_command(self):
+        output = os.path.join(self.tmpdir, "report.json")
+        call_command('sweep_configs', output=output, host_interval=0,
+                     verbosity=0)
+        with open(output) as report:
+            report = simplejson.load(report)
+        assert_equal(report["checked"], 3)
+        assert_equal(sorted(r["id"] for r in report["problems"]),
+                     [self.down.id, self.no_tls.id])
+
+
+class HostLimiterTest(TestCase):
+
+    def test_concurrency(self):
+        limiter = sweep.HostLimiter(2, 0)
+        running = []
+        most = []
+
+        def use(host):
+            with limiter.hold([host, "shared.example.com"]):
+                running.append(host)
+                most.append(len(running))
+                time.sleep(0.05)
+                running.remove(host)
+
+        threads = [threading.Thread(target=use, args=("host%d" % i,))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(max(most), 2)
+
+    def test_interval(self):
+        limiter = sweep.HostLimiter(5, 0.1)
+        start = time.time()
+        for i in range(3):
+            with limiter.hold(["example.com", "EXAMPLE.com"]):
+                pass
+        assert_true(time.time() - start >= 0.2)
+        # Other hosts don't wait.
+        start = time.time()
+        with limiter.hold(["example.org"]):
+            pass
+        assert_true(time.time() - start < 0.1)
@@ -5,7 +5,7 @@ from lxml import etree
 
 from django.core.urlresolvers import reverse
 from django.test import TestCase
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_true
 
 from ispdb.config import models
 
@@ -132,6 +132,22 @@ class ListTest(TestCase):
         assert isinstance(domain, models.Domain)
         response = self.client.get(reverse("ispdb_list", args=["xml"]), {})
         check_returned_xml(response, 2)
+        # The document is sent as the configs are read, not after.
+        response = self.client.get(reverse("ispdb_list", args=["xml"]), {})
+        chunks = iter(response)
+        with self.assertNumQueries(0):
+            head = chunks.next()
+        with self.assertNumQueries(1):
+            rest = "".join(chunks)
+        configs = models.Config.objects.filter(status="approved")
+        assert_equal(head + rest,
+                     "<?xml version='1.0' encoding='UTF-8'?>\n<providers>" +
+                     "".join("<provider><id>%d</id>"
+                             "<export>/export_xml/%d/</export>"
+                             "<lastUpdated>%s</lastUpdated></provider>" %
+                             (c.id, c.id, c.last_update_datetime)
+                             for c in configs.order_by("id")) +
+                     "</providers>")
 
     def test_xml_reponse_invalid_domain(self):
         self.client.login(username='test_admin', password='test')
@@ -3,6 +3,7 @@
 import os
 from lxml import etree
 
+from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from nose.tools import assert_equal
@@ -38,6 +39,30 @@ def check_content(config_xml):
         assert_equal(element.text, expected_outgoing[element.tag])
 
 
+def add_urls(config, count, languages):
+    "Give the config count doc and enable URLs described in every language."
+    for n in range(count):
+        docurl = models.DocURL.objects.create(config=config,
+                url="http://test.com/doc/%d" % n)
+        enableurl = models.EnableURL.objects.create(config=config,
+                url="http://test.com/enable/%d" % n)
+        for language in languages:
+            models.DocURLDesc.objects.create(docurl=docurl,
+                    language=language, description="doc %d" % n)
+            models.EnableURLInst.objects.create(enableurl=enableurl,
+                    language=language, description="enable %d" % n)
+
+
+def check_serializer_queries(testcase, config_id, count):
+    """
+    Make sure loading the config with serializers.prefetch and serializing it
+    under every version runs count queries, and return the documents.
+    """
+    with testcase.assertNumQueries(count):
+        config = serializers.prefetch(models.Config.objects).get(pk=config_id)
+        return [serialize(config) for _, serialize in serializers.versions()]
+
+
 class XMLTest(TestCase):
 
     fixtures = ['xml_testdata']
@@ -78,3 +103,31 @@ class XMLTest(TestCase):
         response = self.client.get(reverse("ispdb_export_xml",
                                    args=["10.0", "1"]), {})
         assert_equal(response.status_code, 404)
+
+    def test_serializer_queries(self):
+        # One query for the config and one for each kind of related row, no
+        # matter how many URLs and descriptions the config has. The nested
+        # rows are not queried when there are no URLs.
+        check_serializer_queries(self, 1, 5)
+        config = models.Config.objects.get(pk=1)
+        languages = [code for code, _ in settings.LANGUAGES[:5]]
+        add_urls(config, 1, languages)
+        check_serializer_queries(self, 1, 7)
+        add_urls(config, 10, languages)
+        documents = check_serializer_queries(self, 1, 7)
+        doc = etree.XML(documents[1])
+        assert_equal(len(doc.findall("emailProvider/documentation")), 11)
+        assert_equal(len(doc.findall("emailProvider/enable/instruction")),
+                     11 * len(languages))
+        # The prefetched config serializes to the same documents.
+        config = models.Config.objects.get(pk=1)
+        assert_equal(documents[1], serializers.xmlOneDotOne(config))
+
+    def test_record(self):
+        config = serializers.prefetch(models.Config.objects).get(pk=1)
+        data = serializers.record(config)
+        with self.assertNumQueries(0):
+            for version, serialize in serializers.versions():
+                assert_equal(serialize(data), serialize(config))
+        # Serializing doesn't change the config.
+        assert_equal(serializers.record(config), data)
@@ -31,6 +31,8 @@ urlpatterns = patterns('',
         'ispdb.config.views.export_xml', name='ispdb_export_xml'),
     url(r'^export_xml/v(?P<version>\d+\.\d+)/(?P<domain>.+)/$',
         'ispdb.config.views.export_xml', name='ispdb_export_xml'),
+    url(r'^export/ispdb\.(?P<format>tgz|zip)$',
+        'ispdb.config.views.export_archive', name='ispdb_export_archive'),
     url(r'^add/(?P<domain>[\w\d\-\.]+)/$', 'ispdb.config.views.add',
         name='ispdb_add'),
     url(r'^add/$', 'ispdb.config.views.add', name='ispdb_add'),
@@ -48,6 +50,10 @@ urlpatterns = patterns('',
         name='ispdb_show_issue'),
     url(r'^sanity/(?P<id>\d+)/$', 'ispdb.config.views.sanity',
         name='ispdb_sanity'),
+    url(r'^sanity/job/(?P<id>\d+)/$', 'ispdb.config.views.sanity_job',
+        name='ispdb_sanity_job'),
+    url(r'^sanity/(?P<id>\d+)/stream/$', 'ispdb.config.views.sanity_stream',
+        name='ispdb_sanity_stream'),
 )
 
 urlpatterns += staticfiles_urlpatterns()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Time the public suffix lookups: ispdb.publicsuffix against etld.py and
+tldextract. The hostnames are read from a file (one per line), or made up
+from the rules of the list."""
+
+from optparse import OptionParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS, os.pardir))
+from ispdb import publicsuffix
+import etld
+
+
+def makeHostnames(count):
+  """Make up count hostnames below the suffixes of the list."""
+  rules = [r.lstrip("!*.") for r in publicsuffix.read_rules()]
+  rules = [r.encode("idna") for r in rules if r]
+  rand = random.Random(0)
+  return ["%s.host%d.%s" % (rand.choice(["www", "mail", "a.b"]), i,
+                            rand.choice(rules))
+          for i in range(count)]
+
+def timed(name, func, *args):
+  start = time.time()
+  result = func(*args)
+  print "%-32s %8.3f s" % (name, time.time() - start)
+  return result
+
+def etldSplit(e, hostnames):
+  ret = []
+  for hostname in hostnames:
+    try:
+      ret.append(e.parse(hostname))
+    except etld.EtldException:
+      ret.append(None)
+  return ret
+
+def main(argv=None):
+  parser = OptionParser(usage="%prog [options] [hostnames file]")
+  parser.add_option("-n", "--count", dest="count", type="int", default=50000,
+                    help="How many hostnames to make up, without a file.")
+  (options, args) = parser.parse_args(argv)
+
+  if args:
+    hostnames = [l.strip() for l in open(args[0]) if l.strip()]
+  else:
+    hostnames = makeHostnames(options.count)
+  print "%d hostnames" % len(hostnames)
+
+  psl = timed("publicsuffix load", publicsuffix.PublicSuffixList.load)
+  timed("publicsuffix split", lambda: [psl.split(h) for h in hostnames])
+  timed("publicsuffix split_many", psl.split_many, hostnames)
+
+  index = os.path.join(tempfile.mkdtemp(), "effective_tld_names.idx")
+  timed("publicsuffix compile", publicsuffix.compile_index,
+        publicsuffix.read_rules(), index)
+  mapped = timed("publicsuffix map", publicsuffix.MappedPublicSuffixList,
+                 index)
+  timed("publicsuffix mapped split_many", mapped.split_many, hostnames)
+  shutil.rmtree(os.path.dirname(index))
+
+  e = timed("etld load", etld.etld, publicsuffix.SNAPSHOT)
+  timed("etld parse", etldSplit, e, hostnames)
+
+  try:
+    import tldextract
+  except ImportError:
+    print "tldextract isn't installed, skipped."
+    return 0
+  extract = timed("tldextract load",
+                  lambda: tldextract.TLDExtract(fetch=False))
+  timed("tldextract (first call)", extract, hostnames[0])
+  timed("tldextract", lambda: [extract(h) for h in hostnames])
+  # What do_domain_checks used to do: a new extractor for every check.
+  timed("tldextract, new each (200)",
+        lambda: [tldextract.TLDExtract(fetch=False)(h)
+                 for h in hostnames[:200]])
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,71 +1,345 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bz2
 from datetime import date, timedelta
 import DNS
-import etld # <http://www.stillhq.com/python/etld/etld.py>
+import functools
+import gzip
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 import os
-import pickle
 import re
+import socket
+import sqlite3
 import sys
+import time
+
+import sketches
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from ispdb import publicsuffix
 
 
 # Constants.
 
+LOG_LINE = re.compile(r"(\d+.\d+\d.\d+).*?live.mozillamessaging.com/autoconfig/(\S*) HTTP/1.\d\" (\d*)")
+# Uncompressed logs bigger than this are split between the processes.
+SHARD_SIZE = 64 * 1024 * 1024
+# How many MX lookups run at once.
+DNS_WORKERS = 20
+# Seconds MX records are kept at least (whatever their TTL), how long names
+# without MX are, and how long until lookups which failed are tried again.
+MIN_TTL = 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+ERROR_TTL = 3600
+# The sizes of the summaries of --approximate: how many (domain, code) are
+# counted, how many IPs are sampled, and 2 ** HLL_PRECISION bytes to count
+# the unique clients.
+COUNTERS = 10000
+IP_SAMPLE = 10000
+HLL_PRECISION = 14
+
 # Utility functions.
 
-def readPrevious(pickleName):
-  """Read the previous data from the specified pickle."""
-  prevHits = None
-  prevMisses = None
-  mxs = {}
-  if os.path.exists(pickleName):
-    data = open(pickleName)
-    prevHits = pickle.load(data)
-    prevMisses = pickle.load(data)
-    try:
-      mxs = pickle.load(data)
-    except EOFError:
-      pass
-  return prevHits, prevMisses, mxs
-
-def writeNext(pickleName, hits, misses, mxs):
-  """Write the current data to the specified pickle."""
-  out = open(pickleName, "w")
-  pickle.dump(hits, out, -1)
-  pickle.dump(misses, out, -1)
-  pickle.dump(mxs, out, -1)
-  out.close()
-
-def gatherData(files, mxs):
-  """Gather all the data."""
-  domains = []
+def logDay(infile):
+  """The day of a log: from its name (20110325.log) if it starts with one,
+  else when it was last written. As a "YYYY-MM-DD" string."""
+  name = os.path.basename(infile)
+  try:
+    return date(int(name[0:4]), int(name[4:6]), int(name[6:8])).isoformat()
+  except ValueError:
+    return date.fromtimestamp(os.path.getmtime(infile)).isoformat()
+
+def daysBefore(day, days):
+  """The day |days| days before |day| (both "YYYY-MM-DD" strings)."""
+  d = date(int(day[0:4]), int(day[5:7]), int(day[8:10]))
+  return (d - timedelta(days=days)).isoformat()
+
+class DailyStore(object):
+  """The counts of the logs read so far, by day, in a sqlite database. The
+  rows of a log are only added once (again if it changed), and the totals of
+  each day reported are kept for the trends."""
+
+  def __init__(self, path):
+    self.db = sqlite3.connect(path)
+    # The domains are kept as they were in the logs.
+    self.db.text_factory = str
+    with self.db:
+      self.db.executescript("""
+        CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY,
+          path TEXT UNIQUE NOT NULL, day TEXT NOT NULL, size INTEGER NOT NULL,
+          mtime REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS counts (file INTEGER NOT NULL,
+          day TEXT NOT NULL, domain TEXT NOT NULL, code TEXT NOT NULL,
+          count INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS counts_day ON counts (day);
+        CREATE TABLE IF NOT EXISTS ip_counts (file INTEGER NOT NULL,
+          day TEXT NOT NULL, requests INTEGER NOT NULL, ips INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS ip_counts_day ON ip_counts (day);
+        CREATE TABLE IF NOT EXISTS totals (day TEXT NOT NULL,
+          kind TEXT NOT NULL, domain TEXT NOT NULL, count INTEGER NOT NULL,
+          PRIMARY KEY (day, kind, domain));
+        CREATE TABLE IF NOT EXISTS estimates (file INTEGER PRIMARY KEY,
+          day TEXT NOT NULL, clients INTEGER NOT NULL,
+          clients_error REAL NOT NULL, count_error INTEGER NOT NULL,
+          sample_rate REAL NOT NULL);
+      """)
+
+  def ingested(self, infile):
+    """Whether |infile| was read, and hasn't changed since."""
+    stat = os.stat(infile)
+    return self.db.execute(
+      "SELECT 1 FROM files WHERE path = ? AND size = ? AND mtime = ?",
+      (os.path.abspath(infile), stat.st_size, stat.st_mtime)).fetchone() \
+      is not None
+
+  def ingest(self, infile, day, domain2count, ip_histogram, estimates):
+    """Add the counts of a log to |day|, instead of those it had before if
+    it was read already. See countLogs. The totals reported for the day are
+    dropped, to be made again from the new counts."""
+    path = os.path.abspath(infile)
+    stat = os.stat(infile)
+    with self.db:
+      for fileId, oldDay in self.db.execute(
+          "SELECT id, day FROM files WHERE path = ?", (path,)).fetchall():
+        for table in ("counts", "ip_counts", "estimates", "files"):
+          column = "id" if table == "files" else "file"
+          self.db.execute("DELETE FROM %s WHERE %s = ?" % (table, column),
+                          (fileId,))
+        self.db.execute("DELETE FROM totals WHERE day = ?", (oldDay,))
+      self.db.execute("DELETE FROM totals WHERE day = ?", (day,))
+      fileId = self.db.execute(
+        "INSERT INTO files (path, day, size, mtime) VALUES (?, ?, ?, ?)",
+        (path, day, stat.st_size, stat.st_mtime)).lastrowid
+      self.db.executemany("INSERT INTO counts VALUES (?, ?, ?, ?, ?)",
+        ((fileId, day, domain, code, count)
+         for (domain, code), count in domain2count.iteritems()))
+      self.db.executemany("INSERT INTO ip_counts VALUES (?, ?, ?, ?)",
+        ((fileId, day, requests, ips)
+         for requests, ips in ip_histogram.iteritems()))
+      self.db.execute("INSERT INTO estimates VALUES (?, ?, ?, ?, ?, ?)",
+        (fileId, day, estimates["clients"], estimates["clients_error"],
+         estimates["count_error"], estimates["sample_rate"]))
+
+  def latestDay(self):
+    return self.db.execute("SELECT MAX(day) FROM files").fetchone()[0]
+
+  def domainCounts(self, day):
+    """The requests of |day| by (domain, code)."""
+    return dict(((domain, code), count) for domain, code, count in
+                self.db.execute("SELECT domain, code, SUM(count) FROM counts"
+                                " WHERE day = ? GROUP BY domain, code", (day,)))
+
+  def ipHistogram(self, day):
+    """How many IPs made each number of requests on |day|. IPs seen in two
+    logs of the day count in both."""
+    return dict(self.db.execute("SELECT requests, SUM(ips) FROM ip_counts"
+                                " WHERE day = ? GROUP BY requests", (day,)))
+
+  def estimates(self, day):
+    """How many clients |day| had, and how far off its counts may be (see
+    countLogs), from how many logs. None if its logs were read by older
+    versions. The clients of each log are added up, so with more than one
+    log those seen in several count more than once."""
+    row = self.db.execute(
+      "SELECT COUNT(*), SUM(clients), MAX(clients_error), SUM(count_error),"
+      " MIN(sample_rate) FROM estimates WHERE day = ?", (day,)).fetchone()
+    if not row[0]:
+      return None
+    return dict(zip(("logs", "clients", "clients_error", "count_error",
+                     "sample_rate"), row))
+
+  def saveTotals(self, day, hits, misses):
+    """Keep the hits and misses reported for |day|."""
+    with self.db:
+      self.db.execute("DELETE FROM totals WHERE day = ?", (day,))
+      for kind, data in (("hit", hits), ("miss", misses)):
+        self.db.executemany("INSERT INTO totals VALUES (?, ?, ?, ?)",
+          ((day, kind, domain, count) for domain, count in data.iteritems()))
+
+  def daysWithoutTotals(self, first, last):
+    """The days from |first| to |last| which were read but not reported."""
+    return [day for (day,) in self.db.execute(
+      "SELECT DISTINCT day FROM files WHERE day BETWEEN ? AND ? AND day NOT IN"
+      " (SELECT day FROM totals) ORDER BY day", (first, last))]
+
+  def averageTotals(self, first, last):
+    """The average daily hits and misses reported from |first| to |last|,
+    and over how many days."""
+    days = self.db.execute("SELECT COUNT(DISTINCT day) FROM totals"
+                           " WHERE day BETWEEN ? AND ?",
+                           (first, last)).fetchone()[0]
+    averages = {"hit": {}, "miss": {}}
+    for kind, domain, count in self.db.execute(
+        "SELECT kind, domain, SUM(count) FROM totals WHERE day BETWEEN ? AND ?"
+        " GROUP BY kind, domain", (first, last)):
+      averages[kind][domain] = int(round(float(count) / days))
+    return averages["hit"], averages["miss"], days
+
+  def close(self):
+    self.db.close()
+
+def openLog(infile):
+  """Open a log file, uncompressing .gz and .bz2 (rotated) logs."""
+  if infile.endswith(".gz"):
+    return gzip.open(infile, "rb")
+  if infile.endswith(".bz2"):
+    return bz2.BZ2File(infile, "r")
+  return open(infile, "rb")
+
+def shardLogs(files, shardSize=SHARD_SIZE):
+  """Split the logs into (file, start, end) byte ranges to count separately.
+  Compressed logs can't be split, they are one shard each (end is None)."""
+  shards = []
+  for infile in files:
+    if infile.endswith(".gz") or infile.endswith(".bz2"):
+      shards.append((infile, 0, None))
+      continue
+    size = os.path.getsize(infile)
+    for start in range(0, max(size, 1), shardSize):
+      shards.append((infile, start, min(start + shardSize, size)))
+  return shards
+
+def shardLines(shard):
+  """Yield the lines of a shard: those starting in its byte range."""
+  infile, start, end = shard
+  log = openLog(infile)
+  try:
+    pos = 0
+    if start:
+      # The line going over the start belongs to the previous shard.
+      log.seek(start - 1)
+      pos = start - 1 + len(log.readline())
+    while end is None or pos < end:
+      line = log.readline()
+      if not line:
+        break
+      pos += len(line)
+      yield line
+  finally:
+    log.close()
+
+def countShard(shard):
+  """Count the requests of a shard by (domain, code) and by IP."""
   domain2count = {}
   countsperIP = {}
-  regex = re.compile(r"(\d+.\d+\d.\d+).*?live.mozillamessaging.com/autoconfig/(\S*) HTTP/1.\d\" (\d*)")
-  for infile in files:
-    for line in open(infile).readlines():
-      if not line: continue
-      found = regex.search(line)
-      if not found: continue
-      ip, domain, code = found.groups()
-      if ip not in countsperIP:
-        countsperIP[ip] = 1
-      else:
-        countsperIP[ip] += 1
-      if not domain: continue
-      domain = domain.split("?")[0]
-      if (domain,code) in domain2count:
-        domain2count[(domain,code)] += 1
+  search = LOG_LINE.search
+  for line in shardLines(shard):
+    found = search(line)
+    if not found: continue
+    ip, domain, code = found.groups()
+    countsperIP[ip] = countsperIP.get(ip, 0) + 1
+    if not domain: continue
+    key = (domain.split("?")[0], code)
+    domain2count[key] = domain2count.get(key, 0) + 1
+  return domain2count, countsperIP
+
+def summarizeShard(shard, counters=COUNTERS, ipSample=IP_SAMPLE):
+  """Summarize the requests of a shard in a fixed size: the most frequent
+  (domain, code), a sample of the IPs, and how many IPs there are."""
+  domains = sketches.SpaceSaving(counters)
+  ips = sketches.SampledCounter(ipSample)
+  clients = sketches.HyperLogLog(HLL_PRECISION)
+  search = LOG_LINE.search
+  hash64 = sketches.hash64
+  for line in shardLines(shard):
+    found = search(line)
+    if not found: continue
+    ip, domain, code = found.groups()
+    hashed = hash64(ip)
+    ips.add(ip, hashed)
+    clients.add(ip, hashed)
+    if not domain: continue
+    domains.add((domain.split("?")[0], code))
+  return domains, ips, clients
+
+def mergeCounts(total, counts):
+  """Add the counts of a shard to the total."""
+  for key, count in counts.iteritems():
+    total[key] = total.get(key, 0) + count
+
+def countFileShard(count, shard):
+  """Run |count| on a shard, and tell which file the result is from."""
+  return shard[0], count(shard)
+
+def countLogs(files, jobs=None, shardSize=SHARD_SIZE, approximate=None):
+  """Count the requests of the logs on jobs processes (one per CPU by
+  default), streaming them shard by shard. The shards of all the logs share
+  the processes, but each log is counted apart: returns, by log, the
+  requests by (domain, code), the requests-per-IP histogram, and the
+  estimates: how many clients there were, how far off that and the counts
+  may be, and which part of the IPs the histogram was extrapolated from.
+
+  If |approximate| is given, as the number of (domain, code) to count and of
+  IPs to sample, the shards are summarized in that much memory instead, see
+  summarizeShard."""
+  shards = shardLogs(files, shardSize)
+  if jobs is None:
+    jobs = multiprocessing.cpu_count()
+  jobs = min(jobs, len(shards))
+  if approximate:
+    count = functools.partial(summarizeShard, counters=approximate[0],
+                              ipSample=approximate[1])
+  else:
+    count = countShard
+  count = functools.partial(countFileShard, count)
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap_unordered(count, shards)
+  else:
+    pool = None
+    results = (count(shard) for shard in shards)
+  summaries = {}
+  try:
+    for infile, result in results:
+      summary = summaries.get(infile)
+      if summary is None:
+        summaries[infile] = result
+      elif approximate:
+        for mine, theirs in zip(summary, result):
+          mine.merge(theirs)
       else:
-        domains.append(dict(domain=domain, code=code))
-        domain2count[(domain,code)] = 1
-    for domain in domains:
-      domain["count"] = domain2count[(domain["domain"],domain["code"])]
+        mergeCounts(summary[0], result[0])
+        mergeCounts(summary[1], result[1])
+  finally:
+    if pool is not None:
+      pool.terminate()
+  return dict((infile, finishCounts(summary, approximate))
+              for infile, summary in summaries.iteritems())
+
+def finishCounts(summary, approximate=None):
+  """Turn the merged shards of a log into what countLogs returns for it."""
+  if approximate:
+    domains, ips, clients = summary
+    return domains.counts, ips.histogram(), dict(
+      clients=clients.count(), clients_error=clients.relativeError(),
+      count_error=domains.maxError(), sample_rate=ips.rate())
+  domain2count, countsperIP = summary
+  return domain2count, ipHistogram(countsperIP), dict(
+    clients=len(countsperIP), clients_error=0.0, count_error=0,
+    sample_rate=1.0)
+
+def ipHistogram(countsperIP):
+  """How many IPs made each number of requests."""
+  ip_histogram = {}
+  for ip, count in countsperIP.items():
+    ip_histogram[count] = ip_histogram.setdefault(count, 0) + 1
+  return ip_histogram
+
+def gatherData(domain2count, ip_histogram, mxStore, dnsWorkers=DNS_WORKERS,
+               minTTL=MIN_TTL, lookup=True):
+  """Gather all the data. Unless |lookup|, only the MX servers in |mxStore|
+  are used, see resolveMXs."""
+  domains = [dict(domain=domain, code=code, count=count)
+             for (domain, code), count in sorted(domain2count.iteritems())]
 
   # So, now we've got all the lines, but some of the failures will actually
   # be hits on the MX, so let's try to remove those.
+  mxs = resolveMXs(mxStore, [d["domain"].split("/")[-1] for d in domains
+                             if d["code"] == "404"],
+                   dnsWorkers, minTTL, lookup)
   domainsDict = dictify(domains)
   mx_hits = [];
   for domain in domains:
@@ -76,17 +350,13 @@ def gatherData(files, mxs):
       name = values[-1]
       if len(values) > 1:
         prefix = values[-2]
-      mx = getMX(mxs, name)
+      mx = mxs[name]
       if domain["domain"] == mx or domain["domain"] == (prefix + "/" + mx):
         continue
       if mx and (mx in domainsDict or (prefix + "/" + mx) in domainsDict):
         mx_hits.append(domain["count"])
         domains.remove(domain)
 
-  ip_histogram = {}
-  for ip, count in countsperIP.items():
-    ip_histogram[count] = ip_histogram.setdefault(count, 0) + 1
-
   counts = ip_histogram.keys()
   counts.sort()
   return domains, counts, mx_hits, ip_histogram
@@ -123,44 +393,119 @@ def calculateDiffs(prevData, data):
   retval.sort(rank_by_count)
   return retval
 
-etldService = etld.etld()
-
 def getSLD(domain):
   """Get the "second level domain", e.g. "mozilla.org" or "bbc.co.uk" """
-  try:
-    sp = etldService.parse(domain) # returns ("5.4.bbc", "co.uk")
-    sld = sp[0].rsplit(".", 1)[-1]
-    tld = sp[1]
-    return sld + "." + tld
-  except etld.EtldException:
-    return domain
+  return publicsuffix.get().registered_domain(domain) or domain
 
 
 mx_queries = 0
 mx_cache_hit = 0
 
-def getMX(mxs, name):
-  """ You pass in domain |name| and it returns the hostname of the MX server.
-  It either uses the cache |mxs| or does a lookup via DNS over the Internet
-  (and populates the cache)."""
+class MXStore(object):
+  """The MX servers looked up, kept in a sqlite database until their TTL runs
+  out. "" stands for names without MX (or whose lookup failed)."""
+
+  def __init__(self, path):
+    self.db = sqlite3.connect(path)
+    self.db.execute("CREATE TABLE IF NOT EXISTS mx (name TEXT PRIMARY KEY,"
+                    " host TEXT NOT NULL, expires REAL NOT NULL)")
+    self.db.commit()
+
+  def get(self, names, now=None):
+    """Return the MX servers of the names which haven't expired, by name."""
+    if now is None:
+      now = time.time()
+    names = list(names)
+    found = {}
+    # SQLite limits the number of parameters of a query.
+    for i in range(0, len(names), 500):
+      chunk = names[i:i + 500]
+      found.update(self.db.execute(
+        "SELECT name, host FROM mx WHERE expires > ? AND name IN (%s)"
+        % ",".join("?" * len(chunk)), [now] + chunk))
+    return found
+
+  def put(self, name, host, ttl, now=None):
+    """Keep the MX server of |name| for |ttl| seconds."""
+    if now is None:
+      now = time.time()
+    self.db.execute("INSERT OR REPLACE INTO mx VALUES (?, ?, ?)",
+                    (name, host, now + ttl))
+
+  def commit(self):
+    self.db.commit()
+
+  def purge(self, now=None):
+    """Forget the expired MX servers."""
+    if now is None:
+      now = time.time()
+    self.db.execute("DELETE FROM mx WHERE expires <= ?", (now,))
+    self.db.commit()
+
+  def close(self):
+    self.db.close()
+
+def lookupMX(name):
+  """Look the MX server of domain |name| up over the Internet. Returns its
+  hostname ("" if there is none) and how many seconds to keep it."""
+  try:
+    response = DNS.DnsRequest(name.encode("utf-8"), qtype="MX").req()
+  except UnicodeError:
+    return "", NEGATIVE_TTL
+  except (DNS.DNSError, socket.error):
+    return "", ERROR_TTL
+  if response.header["status"] not in ("NOERROR", "NXDOMAIN"):
+    return "", ERROR_TTL
+  answers = [a for a in response.answers if a["typename"] == "MX"]
+  if not answers:
+    return "", NEGATIVE_TTL
+  preference, host = min(a["data"] for a in answers)
+  return host, min(a["ttl"] for a in answers)
+
+def resolveMXs(store, names, workers=DNS_WORKERS, minTTL=MIN_TTL,
+               lookup=True):
+  """Return the "second level domain" of the MX server of each of |names|.
+  The names |store| doesn't know are looked up |workers| at a time, and
+  stored as they come in, so an interrupted run doesn't look them up again.
+  Unless |lookup|, they are taken as without MX instead, and the expired
+  servers of |store| are used too.
+  """
   global mx_queries
   global mx_cache_hit
-  if name not in mxs:
-    possible_mxs = []
+  names = set(names)
+  mxs = store.get(names, None if lookup else 0)
+  mx_cache_hit += len(mxs)
+  todo = sorted(names.difference(mxs))
+  if todo and not lookup:
+    mxs.update((name, "") for name in todo)
+  elif todo:
+    # Read the resolvers once, rather than racing to in each thread.
+    if not DNS.defaults["server"]:
+      DNS.DiscoverNameServers()
+
+    def lookup(name):
+      # One bad answer mustn't stop the other lookups.
+      try:
+        return name, lookupMX(name)
+      except Exception, e:
+        print >> sys.stderr, "MX lookup of %s failed: %r" % (name, e)
+        return name, ("", ERROR_TTL)
+
+    pool = ThreadPool(min(workers, len(todo)))
     try:
-      possible_mxs = DNS.mxlookup(name.encode("utf-8"))
-      mx_queries += 1
-    except DNS.DNSError:
-      pass
-    except UnicodeError:
-      pass
-    if len(possible_mxs) < 1:
-      possible_mxs = [(0, "")]
-    mxs[name] = getSLD(possible_mxs[0][1])
-  else:
-    mx_cache_hit += 1 
-
-  return mxs[name]
+      lookups = pool.imap_unordered(lookup, todo)
+      for i, (name, (host, ttl)) in enumerate(lookups):
+        mx_queries += 1
+        if host:
+          ttl = max(ttl, minTTL)
+        store.put(name, host, ttl)
+        mxs[name] = host
+        if i % 100 == 99:
+          store.commit()
+    finally:
+      pool.terminate()
+      store.commit()
+  return dict((name, getSLD(host)) for name, host in mxs.iteritems())
 
 class Usage(Exception):
     def __init__(self, msg):
@@ -173,45 +518,121 @@ def main(argv=None):
   if argv is None:
     argv = sys.argv
 
-  usage = """%prog [options] logfile [...]
-  logfile               Apache logfile"""
+  usage = """%prog [options] [logfile ...]
+  logfile               Apache logfile, read unless it was already"""
   parser = OptionParser(usage=usage)
-  parser.add_option("-p", "--previous", dest="previous",
-                    default=None, #set below
-                    help="Where to get the cache data of the previous run"
-                         "of this script esp. DNS MX lookups, which can"
-                         "take hours.  <filename-1>.pickle by default.")
-  parser.add_option("-n", "--next", dest="next",
+  parser.add_option("-s", "--state", dest="state",
                     default=None, # set below
-                    help="Where to write the new cache data of this run of"
-                         "this script.  <filename>.pickle by default.")
-  (options, logfiles) = parser.parse_args()
-
-  if len(logfiles) < 1:
+                    help="Where to keep the daily counts between runs."
+                         "  quickparse.sqlite next to the first logfile by"
+                         " default.")
+  parser.add_option("-d", "--day", dest="day", default=None,
+                    help="The day to report, as YYYY-MM-DD.  The day of the"
+                         " last logfile by default, or the last day read.")
+  parser.add_option("-w", "--window", dest="window", type="int", default=1,
+                    help="Compare the day with the average of this many days"
+                         " before it.  %default by default.")
+  parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                    default=None, # one per CPU
+                    help="How many processes read the logs. One per CPU"
+                         " by default.")
+  parser.add_option("-m", "--mx-store", dest="mxStore",
+                    default=None, # set below
+                    help="Where to keep the MX lookups between runs."
+                         "  mx.sqlite next to the first logfile by default.")
+  parser.add_option("--dns-workers", dest="dnsWorkers", type="int",
+                    default=DNS_WORKERS,
+                    help="How many MX lookups to run at once."
+                         "  %default by default.")
+  parser.add_option("--min-ttl", dest="minTTL", type="int",
+                    default=MIN_TTL,
+                    help="Keep MX lookups for at least this many seconds."
+                         "  %default by default.")
+  parser.add_option("-a", "--approximate", dest="approximate",
+                    action="store_true", default=False,
+                    help="Read the logs in a fixed amount of memory, see"
+                         " --counters and --ip-sample.  The counts and the"
+                         " per-IP histogram are estimates then.")
+  parser.add_option("--counters", dest="counters", type="int",
+                    default=COUNTERS,
+                    help="With -a, count this many of the most requested"
+                         " domains.  %default by default.")
+  parser.add_option("--ip-sample", dest="ipSample", type="int",
+                    default=IP_SAMPLE,
+                    help="With -a, make the per-IP histogram from at most"
+                         " this many IPs.  %default by default.")
+  parser.add_option("--shard-size", dest="shardSize", type="int",
+                    default=SHARD_SIZE / 1024 / 1024,
+                    help="Split uncompressed logs in parts of this many MB"
+                         " to read them in parallel.  %default by default.")
+  (options, logfiles) = parser.parse_args(argv[1:])
+  if options.shardSize < 1:
+    parser.error("--shard-size must be at least 1 (MB)")
+
+  if len(logfiles) < 1 and not options.state:
     parser.print_usage()
     exit(1)
 
-  if not options.next:
-    options.next = os.path.splitext(logfiles[0])[0]+".pickle"
-  if not options.previous:
-    try:
-      name = os.path.splitext(logfiles[0])[0]
-      d = date(int(name[0:4]), int(name[4:6]), int(name[6:8]))
-      d -= timedelta(days=1)
-      name = d.strftime("%Y%m%d")
-      options.previous = name+".pickle"
-    except:
-      options.previous = options.next
+  directory = os.path.dirname(logfiles[0]) if logfiles else os.curdir
+  if not options.state:
+    options.state = os.path.join(directory, "quickparse.sqlite")
+  if not options.mxStore:
+    options.mxStore = os.path.join(directory, "mx.sqlite")
+
+  approximate = None
+  if options.approximate:
+    approximate = (options.counters, options.ipSample)
+  state = DailyStore(options.state)
+  # Read all the new logs at once, so small logs share the processes.
+  newLogs = []
+  for logfile in logfiles:
+    if logfile not in newLogs and not state.ingested(logfile):
+      newLogs.append(logfile)
+  if newLogs:
+    counts = countLogs(newLogs, options.jobs,
+                       options.shardSize * 1024 * 1024, approximate)
+    for logfile in newLogs:
+      domain2count, ip_histogram, estimates = counts[logfile]
+      state.ingest(logfile, logDay(logfile), domain2count, ip_histogram,
+                   estimates)
+
+  day = options.day
+  if not day:
+    day = max(logDay(f) for f in logfiles) if logfiles else state.latestDay()
+  if not day:
+    print "Nothing to report."
+    return 1
+  print "Report for %s" % day
+  print
 
-  prevHits, prevMisses, mxs = readPrevious(options.previous)
+  mxStore = MXStore(options.mxStore)
+  domains, counts, mx_hits, ip_histogram = gatherData(
+    state.domainCounts(day), state.ipHistogram(day), mxStore,
+    options.dnsWorkers, options.minTTL)
+  if not domains:
+    # No requests that day (or not read), nothing to compare.
+    print "Nothing to report."
+    mxStore.close()
+    state.close()
+    return 1
 
-  domains, counts, mx_hits, ip_histogram = gatherData(logfiles, mxs)
+  estimates = state.estimates(day)
 
   print "# of requests per single IP:"
   for c in counts[:9]:
     print "%4d %d" %(c, ip_histogram[c])
   if len(counts) > 9:
     print "%3d+" %(counts[9],), sum([ip_histogram[i] for i in counts[9:]])
+  if estimates and estimates["sample_rate"] < 1:
+    print "(estimated from 1 in %d IPs)" % round(1 / estimates["sample_rate"])
+  if estimates and estimates["logs"] > 1:
+    print "Unique clients: at most about %d (added up over %d logs)" % (
+      estimates["clients"], estimates["logs"])
+  elif estimates and estimates["clients_error"]:
+    print "Unique clients: about %d ± %.1f%% (standard error)" % (
+      estimates["clients"], 100 * estimates["clients_error"])
+  elif estimates:
+    print "Unique clients: %d" % estimates["clients"]
 
   print ""
 
@@ -234,6 +655,9 @@ def main(argv=None):
   print "MISSES: %d domains, accounting for %d failures, or %3.1f%% fail rate" % (len(misses), miss_total, 100.*miss_total/total_queries)
   print "WEIRDOS: %d domains, accounting for %d oddities, or %3.1f%% strangeness rate" % (len(weirdos), weirdo_total, 100.*weirdo_total/total_queries)
   print "\n".join("  %(domain)s (%(count)s hits, returned %(code)s)" % x for x in weirdos)
+  if estimates and estimates["count_error"]:
+    print "Only the most requested domains were counted, each count may be up"
+    print "to %d too high." % estimates["count_error"]
   print
 
 
@@ -258,6 +682,24 @@ def main(argv=None):
 
   # Calculate the fastest rising misses, and the fastest falling hits.
 
+  state.saveTotals(day, hits, misses)
+  first, last = daysBefore(day, options.window), daysBefore(day, 1)
+  for previous in state.daysWithoutTotals(first, last):
+    # The MX servers known now do for the earlier days.
+    previousDomains = gatherData(state.domainCounts(previous), {}, mxStore,
+                                 options.dnsWorkers, options.minTTL,
+                                 lookup=False)[0]
+    state.saveTotals(previous,
+      dictify(d for d in previousDomains if d["code"] in ("200","304")),
+      dictify(d for d in previousDomains if d["code"] == "404"))
+  mxStore.purge()
+  mxStore.close()
+  prevHits, prevMisses, days = state.averageTotals(first, last)
+  state.close()
+  if days > 1:
+    print "Compared with the average of %d days before." % days
+    print
+
   if prevHits:
     print "Fastest falling hits:"
     prevHits = calculateDiffs(prevHits, hits)
@@ -272,10 +714,8 @@ def main(argv=None):
     print
 
   print "# DNS Statistics lookups/cached (hit ratio)"
-  dns_ratio = 100.0 * mx_cache_hit / (mx_queries + mx_cache_hit)
+  dns_ratio = 100.0 * mx_cache_hit / max(mx_queries + mx_cache_hit, 1)
   print "%d/%d (%3.1f%%)" % (mx_queries, mx_cache_hit, dns_ratio)
- 
-  writeNext(options.next, hits, misses, mxs)
   return 0
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""Fixed size summaries of the streams quickparse reads, for the days with
+too many domains or clients to count them all. Each can be merged with
+another of the same size, so the shards of the logs can be summarized apart.
+"""
+
+import hashlib
+import math
+import struct
+
+
+def hash64(value):
+  """A 64 bits hash of a string, the same in every process."""
+  return struct.unpack("<Q", hashlib.md5(value).digest()[:8])[0]
+
+
+class SpaceSaving(object):
+  """Counts the (at most) |k| most frequent keys of a stream. A count may be
+  too high, by at most |errors[key]|, never more than total / k, and every
+  key seen more than total / k times is kept."""
+
+  def __init__(self, k):
+    self.k = k
+    self.total = 0
+    self.counts = {}
+    self.errors = {}
+    # The keys by count, and the lowest count.
+    self.buckets = {}
+    self.min = 0
+
+  def add(self, key):
+    self.total += 1
+    counts = self.counts
+    buckets = self.buckets
+    count = counts.get(key)
+    if count is not None:
+      bucket = buckets[count]
+      bucket.discard(key)
+      if not bucket:
+        del buckets[count]
+    elif len(counts) < self.k:
+      count = 0
+      self.errors[key] = 0
+      self.min = 0
+    else:
+      # Take the place of a key with the lowest count.
+      count = self.min
+      bucket = buckets[count]
+      old = bucket.pop()
+      if not bucket:
+        del buckets[count]
+      del counts[old]
+      del self.errors[old]
+      self.errors[key] = count
+    counts[key] = count + 1
+    buckets.setdefault(count + 1, set()).add(key)
+    if self.min not in buckets:
+      self.min = count + 1
+
+  def floor(self):
+    """What a key which isn't kept may have been seen at most."""
+    if len(self.counts) < self.k:
+      return 0
+    return self.min
+
+  def merge(self, other):
+    """Add the keys counted by |other|."""
+    floor, otherFloor = self.floor(), other.floor()
+    counts = {}
+    errors = {}
+    for key in set(self.counts).union(other.counts):
+      counts[key] = self.counts.get(key, floor) + \
+                    other.counts.get(key, otherFloor)
+      errors[key] = self.errors.get(key, floor) + \
+                    other.errors.get(key, otherFloor)
+    kept = sorted(counts, key=counts.get, reverse=True)[:self.k]
+    self.total += other.total
+    self.counts = dict((key, counts[key]) for key in kept)
+    self.errors = dict((key, errors[key]) for key in kept)
+    self.buckets = {}
+    for key, count in self.counts.iteritems():
+      self.buckets.setdefault(count, set()).add(key)
+    self.min = min(self.buckets) if self.buckets else 0
+
+  def maxError(self):
+    """How much too high a count may be."""
+    return max(self.errors.values()) if self.errors else 0
+
+
+class HyperLogLog(object):
+  """Estimates how many different keys a stream has, with a standard error
+  of 1.04 / sqrt(2 ** |precision|) (0.8% for 14), in 2 ** |precision|
+  bytes."""
+
+  def __init__(self, precision=14):
+    self.precision = precision
+    self.registers = bytearray(1 << precision)
+
+  def add(self, key, hashed=None):
+    """Add |key|, whose hash64 is |hashed| if it was computed already."""
+    if hashed is None:
+      hashed = hash64(key)
+    bits = 64 - self.precision
+    index = hashed >> bits
+    rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+    if rank > self.registers[index]:
+      self.registers[index] = rank
+
+  def merge(self, other):
+    for i, rank in enumerate(other.registers):
+      if rank > self.registers[i]:
+        self.registers[i] = rank
+
+  def relativeError(self):
+    return 1.04 / math.sqrt(len(self.registers))
+
+  def count(self):
+    m = len(self.registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+    zeros = self.registers.count('\0')
+    if estimate <= 2.5 * m and zeros:
+      # Few keys: count the empty registers instead.
+      estimate = m * math.log(float(m) / zeros)
+    return int(round(estimate))
+
+
+class SampledCounter(object):
+  """Counts the keys of a stream whose hash is below a threshold, lowered
+  (halved) whenever more than |size| keys would be kept. Every time a kept
+  key is seen is counted, so the sample is exact, and stands for 1 / rate()
+  keys of the stream."""
+
+  def __init__(self, size):
+    self.size = size
+    self.level = 0
+    self.counts = {}
+
+  def rate(self):
+    return 0.5 ** self.level
+
+  def _keeps(self, hashed):
+    return not self.level or not hashed >> (64 - self.level)
+
+  def add(self, key, hashed=None):
+    """Add |key|, whose hash64 is |hashed| if it was computed already."""
+    if hashed is None:
+      hashed = hash64(key)
+    if not self._keeps(hashed):
+      return
+    self.counts[key] = self.counts.get(key, 0) + 1
+    if len(self.counts) > self.size:
+      self._shrink()
+
+  def _shrink(self):
+    while len(self.counts) > self.size:
+      self.level += 1
+      self.counts = dict((key, count) for key, count in self.counts.iteritems()
+                         if self._keeps(hash64(key)))
+
+  def merge(self, other):
+    self.level = max(self.level, other.level)
+    counts = {}
+    for sample in (self.counts, other.counts):
+      for key, count in sample.iteritems():
+        counts[key] = counts.get(key, 0) + count
+    self.counts = dict((key, count) for key, count in counts.iteritems()
+                       if self._keeps(hash64(key)))
+    self._shrink()
+
+  def histogram(self):
+    """How many keys were seen each number of times, estimated from the
+    sample."""
+    histogram = {}
+    for count in self.counts.itervalues():
+      histogram[count] = histogram.get(count, 0) + 1
+    scale = 1 / self.rate()
+    return dict((count, int(round(keys * scale)))
+                for count, keys in histogram.iteritems())